@@ -0,0 +1,120 @@
+# Micro-benchmarks for the CPU-bound parts of server.py.
+#
+#   cd backend && python benchmarks.py
+#
+# Only pure functions are timed, so no MongoDB is needed; MONGO_URL just has
+# to be set for server.py to import (the Motor client connects lazily).
+import json
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmarks")
+
+import server  # noqa: E402
+
+# Baghdad, roughly
+CENTER = (33.31, 44.36)
+SPREAD_DEGREES = 0.25
+
+
+def timed(label, fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<50} {best * 1000:8.1f} ms")
+    return result
+
+
+def random_position(rng):
+    return {
+        "latitude": CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+        "longitude": CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+    }
+
+
+def bench_assignment(rng):
+    for task_count, technician_count in [(100, 100), (300, 300), (500, 300), (500, 1000)]:
+        tasks = [random_position(rng) for _ in range(task_count)]
+        technicians = [
+            {
+                "id": str(i),
+                "name": f"tech {i}",
+                "active": int(rng.integers(0, server.ASSIGNMENT_MAX_ACTIVE_TASKS)),
+                "rating": float(rng.uniform(1, 5)),
+                **random_position(rng),
+            }
+            for i in range(technician_count)
+        ]
+
+        def run():
+            cost, _ = server.assignment_costs(tasks, technicians)
+            cost = cost[:cost.shape[1]]
+            return cost, server.solve_assignment(cost)
+
+        cost, columns = timed(f"assignment {task_count} tasks x {technician_count} technicians", run)
+        assert len(set(columns.tolist())) == len(columns)
+
+
+def bench_route(rng):
+    for stop_count in [10, 50, 200]:
+        points = np.array(
+            [[p["latitude"], p["longitude"]] for p in (random_position(rng) for _ in range(stop_count + 1))]
+        )
+        path = timed(f"route {stop_count} stops (nearest neighbour + 2-opt)", lambda: server.optimize_route(points))
+        distances = server.distance_matrix(points)
+        greedy = server.nearest_neighbour_path(distances)
+        length = distances[path[:-1], path[1:]].sum()
+        greedy_length = distances[greedy[:-1], greedy[1:]].sum()
+        print(f"{'':<50} {length:8.1f} km (nearest neighbour alone {greedy_length:.1f} km)")
+
+
+def bench_wire(rng):
+    # A technician driving around, reporting every 5-15 seconds
+    for fix_count in [100, 1000]:
+        task_id = str(uuid.uuid4())
+        times = 1_760_000_000_000 + np.cumsum(rng.integers(5000, 15000, fix_count))
+        lats = CENTER[0] + np.cumsum(rng.normal(0, 0.0003, fix_count))
+        lons = CENTER[1] + np.cumsum(rng.normal(0, 0.0003, fix_count))
+        bodies = [
+            json.dumps({
+                "task_id": task_id,
+                "latitude": float(lat),
+                "longitude": float(lon),
+                "timestamp": server.datetime.fromtimestamp(int(t) / 1000, server.timezone.utc).isoformat(),
+            })
+            for t, lat, lon in zip(times, lats, lons)
+        ]
+        frame = server.encode_location_frame(task_id, times.tolist(), lats.tolist(), lons.tolist())
+
+        timed(
+            f"wire {fix_count} fixes, JSON parse",
+            lambda: [server.LocationUpdate(**json.loads(body)) for body in bodies],
+        )
+        (_, _, decoded_lats, decoded_lons), = timed(
+            f"wire {fix_count} fixes, binary parse", lambda: server.decode_location_frames(frame)
+        )
+        error_m = server.haversine_km(lats, lons, decoded_lats, decoded_lons).max() * 1000
+        json_bytes = sum(len(body) for body in bodies) / fix_count
+        print(f"{'':<50} {json_bytes:8.1f} B/fix JSON, {len(frame) / fix_count:.1f} B/fix binary, "
+              f"max error {error_m:.2f} m")
+
+
+BENCHMARKS = {
+    "assignment": bench_assignment,
+    "route": bench_route,
+    "wire": bench_wire,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    rng = np.random.default_rng(42)
+    for name in selected:
+        BENCHMARKS[name](rng)
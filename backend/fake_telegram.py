@@ -0,0 +1,76 @@
+# A local stand-in for the Telegram Bot API, for testing the notification
+# outbox and the webhook without a real bot.
+#
+#   cd backend && TELEGRAM_WEBHOOK_SECRET=test uvicorn fake_telegram:app --port 8081
+#   TELEGRAM_API_BASE=http://localhost:8081 TELEGRAM_BOT_TOKEN=test TELEGRAM_WEBHOOK_SECRET=test uvicorn server:app
+#
+# The server sends nothing to Telegram until TELEGRAM_BOT_TOKEN is set (any
+# value works here) and refuses webhook calls until TELEGRAM_WEBHOOK_SECRET is
+# set, so both processes need the same secret.
+#
+# Messages the server sends are kept in memory and listed by GET /messages.
+# POST /press plays a technician tapping one of their buttons: it builds the
+# callback query Telegram would send, posts it to the server's webhook and
+# returns the server's answer.
+import itertools
+import os
+
+import httpx
+from fastapi import FastAPI, HTTPException
+
+WEBHOOK_URL = os.environ.get("FAKE_TELEGRAM_WEBHOOK_URL", "http://localhost:8000/api/telegram/webhook")
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET", "")
+
+app = FastAPI()
+messages = []
+message_ids = itertools.count(1)
+update_ids = itertools.count(1)
+
+
+@app.post("/bot{token}/sendMessage")
+async def send_message(token: str, payload: dict):
+    message = {"message_id": next(message_ids), "chat": {"id": payload["chat_id"]}, **payload}
+    messages.append(message)
+    return {"ok": True, "result": message}
+
+
+@app.post("/bot{token}/setWebhook")
+async def set_webhook(token: str, payload: dict):
+    return {"ok": True, "result": True}
+
+
+@app.get("/messages")
+async def list_messages(chat_id: str = None):
+    return [m for m in messages if chat_id is None or str(m["chat_id"]) == chat_id]
+
+
+@app.delete("/messages")
+async def clear_messages():
+    messages.clear()
+    return {"ok": True}
+
+
+@app.post("/press")
+async def press(payload: dict):
+    """{"message_id": ..., "data": "accept:<task id>"}"""
+    message = next((m for m in messages if m["message_id"] == payload["message_id"]), None)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Unknown message")
+    buttons = [b for row in message.get("reply_markup", {}).get("inline_keyboard", []) for b in row]
+    if payload["data"] not in [b.get("callback_data") for b in buttons]:
+        raise HTTPException(status_code=400, detail="The message has no such button")
+
+    chat_id = message["chat_id"]
+    update = {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else chat_id, "is_bot": False},
+            "message": {"message_id": message["message_id"], "chat": {"id": chat_id}},
+            "data": payload["data"],
+        },
+    }
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(WEBHOOK_URL, json=update, headers=headers)
+    return {"status_code": response.status_code, "answer": response.json()}
@@ -0,0 +1,31 @@
+# Gunicorn configuration for running the API on every core.
+#
+#   cd backend && gunicorn -c gunicorn.conf.py server:app
+#
+# WEB_CONCURRENCY sets the number of worker processes (defaults to the CPU
+# count). Each worker is a separate process with its own Motor client; state
+# shared between workers lives in MongoDB:
+#   - startup tasks (default admin) run under a lock in the `locks` collection
+#   - background sweeps run only on the worker holding their `leader:*` lock
+#   - cache invalidations are fanned out through the `worker_events` capped
+#     collection, which every worker tails
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8001")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Every worker must import server.py itself so the Motor client and event loop
+# are created after the fork.
+preload_app = False
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# Addresses of the reverse proxy / ingress whose X-Forwarded-For and
+# X-Forwarded-Proto are trusted. Without it every request appears to come from
+# the proxy, and per-address rate limits are shared by all clients. Use "*"
+# only when the workers are reachable solely through the proxy.
+forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
@@ -1,8 +1,13 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, ReturnDocument, UpdateOne, monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure, PyMongoError
 import os
 import logging
 from pathlib import Path
@@ -13,71 +18,417 @@ from datetime import datetime, timezone, timedelta
 import jwt
 from passlib.context import CryptContext
 import base64
+import tempfile
+import asyncio
+import math
+import time
+import socket
+import hashlib
+import hmac
+import importlib.util
+import re
+import bisect
+import heapq
+import calendar
+import struct
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict
 
 import httpx
+import numpy as np
+import pandas as pd
+import xlsxwriter
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # Telegram Bot Configuration
-TELEGRAM_BOT_TOKEN = "8224031678:AAG149d2LhnU1YYsNpcQeDMZO7eOIiPQR70"
+# Telegram delivery and the webhook are off until it is set
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+# Point at a local fake of the Bot API in tests (see fake_telegram.py)
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+# Public URL of POST /api/telegram/webhook; registered with Telegram on startup when set
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL', '')
+# Telegram echoes it in X-Telegram-Bot-Api-Secret-Token on every webhook call;
+# the webhook is disabled until it is set
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
 
-async def send_telegram_message_with_button(chat_id: str, message: str, task_id: str):
-    """إرسال رسالة Telegram مع زر يروح مباشرة للمهمة"""
-    if not chat_id:
-        return
-    
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        
-        # رابط التطبيق مع task_id
-        app_url = f"https://tech-dispatch-37.preview.emergentagent.com/?task={task_id}"
-        
-        keyboard = {
-            "inline_keyboard": [[
-                {
-                    "text": "✅ فتح المهمة وإكمالها",
-                    "url": app_url
-                }
-            ]]
+# MongoDB connection pool Configuration
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '30000'))
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', 'zstd,snappy,zlib')
+# Read preference for read-heavy endpoints (get_tasks, get_stats, get_task_locations)
+MONGO_READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))
+
+# Compressors whose Python package is missing are dropped instead of failing
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+def available_compressors() -> List[str]:
+    return [
+        name.strip() for name in MONGO_COMPRESSORS.split(',')
+        if name.strip() in COMPRESSOR_MODULES and importlib.util.find_spec(COMPRESSOR_MODULES[name.strip()])
+    ]
+
+def read_preference_for_reads():
+    if MONGO_READ_PREFERENCE == "primary":
+        return Primary()
+    modes = {
+        "primaryPreferred": PrimaryPreferred,
+        "secondary": Secondary,
+        "secondaryPreferred": SecondaryPreferred,
+        "nearest": Nearest,
+    }
+    # maxStalenessSeconds must be at least 90 (or -1 for no bound)
+    return modes[MONGO_READ_PREFERENCE](max_staleness=MONGO_MAX_STALENESS_SECONDS)
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """عداد استخدام مجمع الاتصالات لكل خادم"""
+
+    def __init__(self):
+        self.servers = {}
+
+    def _server(self, address) -> dict:
+        key = f"{address[0]}:{address[1]}"
+        if key not in self.servers:
+            self.servers[key] = {
+                "open": 0, "checked_out": 0, "max_checked_out": 0,
+                "checkouts": 0, "checkout_failures": 0, "wait_queue_timeouts": 0
+            }
+        return self.servers[key]
+
+    def snapshot(self) -> dict:
+        return {
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "servers": {
+                key: {**stats, "utilization": round(stats["checked_out"] / MONGO_MAX_POOL_SIZE, 3)}
+                for key, stats in self.servers.items()
+            }
         }
-        
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json={
-                "chat_id": chat_id,
-                "text": message,
-                "parse_mode": "HTML",
-                "reply_markup": keyboard
-            })
-    except Exception as e:
-        print(f"Telegram error: {e}")
 
-async def send_telegram_message(chat_id: str, message: str):
-    """إرسال رسالة Telegram بسيطة بدون زر"""
-    if not chat_id:
-        return
-    
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json={
-                "chat_id": chat_id,
-                "text": message,
-                "parse_mode": "HTML"
-            })
-    except Exception as e:
-        print(f"Telegram error: {e}")
+    def pool_created(self, event):
+        self._server(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        self.servers.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._server(event.address)["open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        stats = self._server(event.address)
+        stats["open"] = max(0, stats["open"] - 1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        stats = self._server(event.address)
+        stats["checkout_failures"] += 1
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            stats["wait_queue_timeouts"] += 1
+
+    def connection_checked_out(self, event):
+        stats = self._server(event.address)
+        stats["checkouts"] += 1
+        stats["checked_out"] += 1
+        stats["max_checked_out"] = max(stats["max_checked_out"], stats["checked_out"])
+
+    def connection_checked_in(self, event):
+        stats = self._server(event.address)
+        stats["checked_out"] = max(0, stats["checked_out"] - 1)
+
+pool_metrics = PoolMetrics()
 
 # MongoDB connection
+# Created at import time, i.e. once per worker process: run gunicorn without
+# preload_app so every worker gets its own client and event loop.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    compressors=available_compressors(),
+    event_listeners=[pool_metrics]
+)
+# Tenancy
+# Several shops (tenants) share one deployment. Each tenant has its own
+# database on the shared client and connection pool, so no query can reach
+# another shop's documents and every index stays per shop. `db` and `read_db`
+# resolve to the current tenant's database: requests set the tenant from the
+# token's tid claim (or the X-Tenant header before login), and background
+# workers inherit it from the task they were started in.
+DB_NAME = os.environ['DB_NAME']
+# The original single shop keeps DB_NAME itself, so existing data needs no migration
+DEFAULT_TENANT = "default"
+TENANT_ID_PATTERN = r"^[a-z0-9][a-z0-9-]{1,19}$"
+# Requests without a token pick their tenant with this header (or ?tenant=)
+TENANT_HEADER = "x-tenant"
+TENANTS_REFRESH_SECONDS = int(os.environ.get('TENANTS_REFRESH_SECONDS', '60'))
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+def tenant_database_name(tenant_id: str) -> str:
+    return DB_NAME if tenant_id == DEFAULT_TENANT else f"{DB_NAME}__{tenant_id}"
+
+def database_tenant(database_name: str) -> Optional[str]:
+    if database_name == DB_NAME:
+        return DEFAULT_TENANT
+    prefix = f"{DB_NAME}__"
+    return database_name[len(prefix):] if database_name.startswith(prefix) else None
+
+@contextmanager
+def tenant_scope(tenant_id: str):
+    token = current_tenant.set(tenant_id)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+class TenantDatabase:
+    """قاعدة بيانات المتجر الحالي"""
+
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+        self.databases = {}
+
+    def current(self):
+        tenant_id = current_tenant.get()
+        database = self.databases.get(tenant_id)
+        if database is None:
+            database = client.get_database(tenant_database_name(tenant_id), read_preference=self.read_preference)
+            self.databases[tenant_id] = database
+        return database
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __getitem__(self, name):
+        return self.current()[name]
+
+class TenantLocal:
+    """نسخة منفصلة من factory() لكل متجر، حسب المتجر الحالي"""
+
+    def __init__(self, factory):
+        object.__setattr__(self, "factory", factory)
+        object.__setattr__(self, "instances", {})
+
+    def current(self):
+        tenant_id = current_tenant.get()
+        if tenant_id not in self.instances:
+            self.instances[tenant_id] = self.factory()
+        return self.instances[tenant_id]
+
+    def replace_current(self, instance):
+        self.instances[current_tenant.get()] = instance
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.current(), name, value)
+
+    def __len__(self):
+        return len(self.current())
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __contains__(self, item):
+        return item in self.current()
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+    def __setitem__(self, key, value):
+        self.current()[key] = value
+
+db = TenantDatabase()
+# Same database routed by MONGO_READ_PREFERENCE, for endpoints that tolerate
+# reading slightly stale data
+read_db = TenantDatabase(read_preference_for_reads())
+# Tenant registry and cross-worker events, shared by all tenants
+control_db = client[DB_NAME]
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
+# Signing keys for rotation as "kid:secret,kid:secret"; new tokens are signed
+# with JWT_ACTIVE_KID and tokens signed with any listed key stay valid.
+JWT_KEYS = dict(
+    item.split(':', 1) for item in os.environ.get('JWT_KEYS', '').split(',') if ':' in item
+) or {"default": JWT_SECRET}
+JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID', next(iter(JWT_KEYS)))
+REVOCATIONS_REFRESH_SECONDS = int(os.environ.get('REVOCATIONS_REFRESH_SECONDS', '60'))
+
+# Reports Configuration
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '2000'))
+
+# Daily rollups Configuration
+ROLLUP_INTERVAL_SECONDS = int(os.environ.get('ROLLUP_INTERVAL_SECONDS', '60'))
+
+# Rate limiting Configuration
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '10000'))
+MAX_CONCURRENT_TASK_LISTS = int(os.environ.get('MAX_CONCURRENT_TASK_LISTS', '20'))
+MAX_CONCURRENT_BROADCASTS = int(os.environ.get('MAX_CONCURRENT_BROADCASTS', '2'))
+MAX_CONCURRENT_EXPORTS = int(os.environ.get('MAX_CONCURRENT_EXPORTS', '2'))
+
+# Archive Configuration
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '200'))
+
+# Task deletion Configuration
+DELETE_BATCH_SIZE = int(os.environ.get('DELETE_BATCH_SIZE', '1000'))
+DELETE_CLEANUP_INTERVAL_SECONDS = int(os.environ.get('DELETE_CLEANUP_INTERVAL_SECONDS', '5'))
+DELETE_CLEANUP_LEASE_SECONDS = 120
+
+# Idempotency Configuration
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+# A key left "in progress" longer than this (e.g. the worker died) can be retried
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+
+# Offline sync Configuration
+SYNC_MAX_OPERATIONS = int(os.environ.get('SYNC_MAX_OPERATIONS', '5000'))
+SYNC_OP_TTL_SECONDS = int(os.environ.get('SYNC_OP_TTL_SECONDS', str(7 * 86400)))
+# Device clocks ahead of the server by more than this are clamped to server time
+SYNC_MAX_CLOCK_SKEW_SECONDS = int(os.environ.get('SYNC_MAX_CLOCK_SKEW_SECONDS', '300'))
+# Deletions are remembered this long; a phone that last synced earlier gets a full resync
+SYNC_RETENTION_SECONDS = int(os.environ.get('SYNC_RETENTION_SECONDS', str(30 * 86400)))
+# updated_at is stamped before the write commits, so each delta re-reads this far back
+SYNC_TOKEN_OVERLAP_SECONDS = int(os.environ.get('SYNC_TOKEN_OVERLAP_SECONDS', '60'))
+
+# Response cache Configuration
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')  # memory or mongo
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '30'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+
+# Multi-worker Configuration
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+WORKER_EVENTS_SIZE_BYTES = int(os.environ.get('WORKER_EVENTS_SIZE_BYTES', str(4 * 1024 * 1024)))
+
+# Task event log Configuration
+# The log is a capped collection: once full, the oldest events make room
+TASK_EVENTS_SIZE_BYTES = int(os.environ.get('TASK_EVENTS_SIZE_BYTES', str(512 * 1024 * 1024)))
+TASK_EVENTS_FLUSH_SECONDS = float(os.environ.get('TASK_EVENTS_FLUSH_SECONDS', '1'))
+TASK_EVENTS_BATCH_SIZE = int(os.environ.get('TASK_EVENTS_BATCH_SIZE', '500'))
+# Events kept in memory while the database is unreachable
+TASK_EVENTS_MAX_PENDING = int(os.environ.get('TASK_EVENTS_MAX_PENDING', '50000'))
+STARTUP_LOCK_TTL_SECONDS = 60
+
+# Customers Configuration
+CUSTOMER_BACKFILL_BATCH_SIZE = int(os.environ.get('CUSTOMER_BACKFILL_BATCH_SIZE', '500'))
+
+# Scheduler Configuration
+SCHEDULER_BATCH_SIZE = int(os.environ.get('SCHEDULER_BATCH_SIZE', '500'))
+# Upper bound on how long the scheduler sleeps; also paces the leader lease renewal
+SCHEDULER_MAX_SLEEP_SECONDS = int(os.environ.get('SCHEDULER_MAX_SLEEP_SECONDS', '30'))
+
+# Assignment engine Configuration
+# Seconds between automatic assignment rounds; 0 disables them (POST /assignments/run still works)
+ASSIGNMENT_INTERVAL_SECONDS = int(os.environ.get('ASSIGNMENT_INTERVAL_SECONDS', '60'))
+ASSIGNMENT_BATCH_SIZE = int(os.environ.get('ASSIGNMENT_BATCH_SIZE', '500'))
+# A technician is not given new tasks beyond this many active ones
+ASSIGNMENT_MAX_ACTIVE_TASKS = int(os.environ.get('ASSIGNMENT_MAX_ACTIVE_TASKS', '5'))
+# Cost weights: one active task weighs as much as LOAD_WEIGHT km of travel,
+# one rating star saves RATING_WEIGHT km
+ASSIGNMENT_LOAD_WEIGHT = float(os.environ.get('ASSIGNMENT_LOAD_WEIGHT', '5'))
+ASSIGNMENT_RATING_WEIGHT = float(os.environ.get('ASSIGNMENT_RATING_WEIGHT', '2'))
+# Distance assumed when the task site or the technician position is unknown
+ASSIGNMENT_UNKNOWN_DISTANCE_KM = float(os.environ.get('ASSIGNMENT_UNKNOWN_DISTANCE_KM', '10'))
+# Positions older than this are treated as unknown
+ASSIGNMENT_POSITION_MAX_AGE_HOURS = int(os.environ.get('ASSIGNMENT_POSITION_MAX_AGE_HOURS', '12'))
+
+# Route optimization Configuration
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', '1000'))
+# Moves of the technician smaller than this keep the cached route
+ROUTE_POSITION_PRECISION = int(os.environ.get('ROUTE_POSITION_PRECISION', '3'))  # decimals, ~100 m
+
+# Duration prediction Configuration
+DURATION_MODEL_RETRAIN_SECONDS = int(os.environ.get('DURATION_MODEL_RETRAIN_SECONDS', str(6 * 3600)))
+# How many observations a group needs before its own average outweighs the broader one
+DURATION_PRIOR_WEIGHT = float(os.environ.get('DURATION_PRIOR_WEIGHT', '5'))
+# Average driving speed used for arrival ETAs
+ETA_SPEED_KMH = float(os.environ.get('ETA_SPEED_KMH', '30'))
+
+# Geofence Configuration
+GEOFENCE_RADIUS_METERS = float(os.environ.get('GEOFENCE_RADIUS_METERS', '150'))
+# Leaving takes a larger radius than arriving, so GPS jitter at the edge does not flap
+GEOFENCE_EXIT_FACTOR = float(os.environ.get('GEOFENCE_EXIT_FACTOR', '1.5'))
+# Start an accepted task automatically when the technician arrives at the site
+GEOFENCE_AUTO_START = os.environ.get('GEOFENCE_AUTO_START', 'false').lower() == 'true'
+GEOFENCE_INDEX_REFRESH_SECONDS = int(os.environ.get('GEOFENCE_INDEX_REFRESH_SECONDS', '300'))
+# Nominatim-compatible search endpoint; empty disables geocoding of addresses
+GEOCODER_URL = os.environ.get('GEOCODER_URL', '')
+GEOCODER_COUNTRY_CODES = os.environ.get('GEOCODER_COUNTRY_CODES', 'iq')
+# Public geocoders allow about one request per second
+GEOCODER_MIN_INTERVAL_SECONDS = float(os.environ.get('GEOCODER_MIN_INTERVAL_SECONDS', '1'))
+GEOCODE_INTERVAL_SECONDS = int(os.environ.get('GEOCODE_INTERVAL_SECONDS', '30'))
+GEOCODE_BATCH_SIZE = int(os.environ.get('GEOCODE_BATCH_SIZE', '50'))
+
+# Location reporting Configuration
+# POST /locations tells the phone when to send the next fix
+LOCATION_STATIONARY_SECONDS = int(os.environ.get('LOCATION_STATIONARY_SECONDS', '60'))
+LOCATION_MOVING_MIN_SECONDS = int(os.environ.get('LOCATION_MOVING_MIN_SECONDS', '5'))
+LOCATION_MOVING_MAX_SECONDS = int(os.environ.get('LOCATION_MOVING_MAX_SECONDS', '30'))
+# Close to a task site fixes come at least this often, so arrival is detected promptly
+LOCATION_APPROACH_SECONDS = int(os.environ.get('LOCATION_APPROACH_SECONDS', '10'))
+# Moving technicians report roughly every this many meters
+LOCATION_SPACING_METERS = int(os.environ.get('LOCATION_SPACING_METERS', '100'))
+# Fixes per second one worker takes before it stretches every interval
+LOCATION_INGEST_TARGET_PER_SECOND = float(os.environ.get('LOCATION_INGEST_TARGET_PER_SECOND', '200'))
+
+# Notification delivery Configuration
+# Channels this deployment delivers through; "local" keeps messages in memory for tests
+NOTIFICATION_CHANNELS = [c.strip() for c in os.environ.get('NOTIFICATION_CHANNELS', 'app,telegram,whatsapp').split(',') if c.strip()]
+APP_URL = os.environ.get('APP_URL', 'https://tech-dispatch-37.preview.emergentagent.com')
+# WhatsApp Cloud API; an empty token disables the channel
+WHATSAPP_API_BASE = os.environ.get('WHATSAPP_API_BASE', 'https://graph.facebook.com/v20.0')
+WHATSAPP_PHONE_NUMBER_ID = os.environ.get('WHATSAPP_PHONE_NUMBER_ID', '')
+WHATSAPP_TOKEN = os.environ.get('WHATSAPP_TOKEN', '')
+WHATSAPP_COUNTRY_CODE = os.environ.get('WHATSAPP_COUNTRY_CODE', '964')
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.environ.get('OUTBOX_POLL_INTERVAL_SECONDS', '2'))
+# A claimed message is handed to another worker if not settled within this time
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_BASE_SECONDS = int(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '5'))
+OUTBOX_RETENTION_SECONDS = int(os.environ.get('OUTBOX_RETENTION_SECONDS', str(7 * 86400)))
+
+# Binary location batches Configuration
+LOCATION_BATCH_MAX_BYTES = int(os.environ.get('LOCATION_BATCH_MAX_BYTES', str(1024 * 1024)))
+
+# Task search Configuration
+SEARCH_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('SEARCH_RECONCILE_INTERVAL_SECONDS', '300'))
+
+# Event bus Configuration
+EVENT_BUS_MODE = os.environ.get('EVENT_BUS_MODE', 'auto')  # auto, change_stream or polling
+EVENT_BUS_POLL_INTERVAL_SECONDS = float(os.environ.get('EVENT_BUS_POLL_INTERVAL_SECONDS', '1'))
+# How often the resume position is saved; a restart replays at most this much
+EVENT_BUS_CHECKPOINT_SECONDS = float(os.environ.get('EVENT_BUS_CHECKPOINT_SECONDS', '5'))
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -97,9 +448,761 @@ DEFAULT_ADMIN = {
     "name": "المدير"
 }
 
+# Shared state between workers
+async def acquire_lock(name: str, ttl_seconds: int) -> bool:
+    """قفل مشترك في MongoDB بين العمال، يتجدد إذا كان العامل نفسه يملكه"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lock
+        return False
+
+async def release_lock(name: str):
+    await db.locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+# In-process caches register a clear function here; invalidations are applied
+# locally and fanned out to the other workers through the worker_events
+# capped collection.
+local_caches = {}
+
+def register_cache(name: str, invalidate_fn):
+    local_caches[name] = invalidate_fn
+
+async def invalidate_cache(name: str, key: Optional[str] = None):
+    invalidate_fn = local_caches.get(name)
+    if invalidate_fn:
+        invalidate_fn(key)
+    await publish_worker_event("cache.invalidate", {"name": name, "key": key})
+
+async def publish_worker_event(channel: str, payload: dict):
+    await control_db.worker_events.insert_one({
+        "channel": channel,
+        "payload": payload,
+        "tenant": current_tenant.get(),
+        "origin": WORKER_ID,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+
+def handle_worker_event(event: dict):
+    if event.get("origin") == WORKER_ID:
+        return
+    with tenant_scope(event.get("tenant") or DEFAULT_TENANT):
+        apply_worker_event(event)
+
+def apply_worker_event(event: dict):
+    if event.get("channel") == "auth.revoke":
+        user_id = event["payload"]["user_id"]
+        revoked_token_versions[user_id] = max(revoked_token_versions.get(user_id, 0), event["payload"]["version"])
+    elif event.get("channel") == "scheduler.push":
+        scheduler.push(event["payload"]["next_run_at"], event["payload"]["id"])
+    elif event.get("channel") == "cache.invalidate":
+        invalidate_fn = local_caches.get(event["payload"]["name"])
+        if invalidate_fn:
+            invalidate_fn(event["payload"].get("key"))
+    elif event.get("channel") == "tenant.created":
+        background_tasks.append(asyncio.create_task(activate_tenant(event["payload"]["id"])))
+
+async def ensure_worker_events_collection():
+    try:
+        await control_db.create_collection("worker_events", capped=True, size=WORKER_EVENTS_SIZE_BYTES)
+        # A tailable cursor on an empty capped collection dies immediately
+        await control_db.worker_events.insert_one({"channel": "init", "origin": WORKER_ID})
+    except CollectionInvalid:
+        pass
+
+async def worker_events_listener():
+    """متابعة أحداث العمال الآخرين عبر tailable cursor"""
+    last = await control_db.worker_events.find_one({}, sort=[("$natural", -1)])
+    last_id = last["_id"] if last else None
+    while True:
+        try:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            cursor = control_db.worker_events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for event in cursor:
+                    last_id = event["_id"]
+                    handle_worker_event(event)
+                await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Worker events listener error: {e}")
+        await asyncio.sleep(1)
+
+# Event bus
+# Every worker watches tasks, notifications and locations and hands each change
+# to its in-process subscribers in order. Task writes that should produce an
+# event set `updated_at` and `last_event` (e.g. "task.accepted"); writes that
+# leave `updated_at` alone are not published. One bus per process covers all
+# tenants: a single change stream over every tenant database, or one polling
+# loop visiting each tenant in turn; handlers run in the tenant of the event.
+class PollingState:
+    """موضع الـ polling لمتجر واحد"""
+
+    def __init__(self):
+        # Lifecycle events already delivered per task id
+        self.task_state = OrderedDict()
+        self.since = None
+        # Per collection: the newest timestamp seen and the ids seen at exactly
+        # that timestamp, so equal timestamps are neither skipped nor repeated.
+        self.cursors = None
+
+class EventBus:
+    COLLECTIONS = {
+        "tasks": "updated_at",
+        "notifications": "created_at",
+        # Server receive time; offline fixes synced later carry old device timestamps
+        "locations": "received_at",
+    }
+
+    # Task fields that mark each lifecycle transition
+    TASK_LIFECYCLE = [
+        ("created_at", "task.created"),
+        ("accepted_at", "task.accepted"),
+        ("started_at", "task.started"),
+        ("completed_at", "task.completed"),
+    ]
+    MAX_TRACKED_TASKS = 10000
+    # The change stream's checkpoint; polling checkpoints are keyed by tenant id
+    CHANGE_STREAM_CHECKPOINT = "change_stream"
+    subscribers = []
+
+    def __init__(self):
+        self.mode = None
+        self.resume_token = None
+        self.polling = TenantLocal(PollingState)
+        # checkpoint id -> monotonic time of the last save
+        self.checkpointed_at = {}
+
+    async def load_checkpoint(self, checkpoint_id: str) -> dict:
+        """Where the last run stopped, so writes made while no worker was
+        running still produce their events. Handlers are idempotent, so the
+        few events between the last checkpoint and the stop are replayed."""
+        try:
+            return await control_db.event_bus_checkpoints.find_one({"_id": checkpoint_id}) or {}
+        except PyMongoError as e:
+            logger.error(f"Event bus checkpoint read failed: {e}")
+            return {}
+
+    async def save_checkpoint(self, checkpoint_id: str, update: dict):
+        # Every worker runs the bus and saves; a lagging worker can only move
+        # the position back, which replays events instead of losing them
+        if time.monotonic() - self.checkpointed_at.get(checkpoint_id, 0.0) < EVENT_BUS_CHECKPOINT_SECONDS:
+            return
+        self.checkpointed_at[checkpoint_id] = time.monotonic()
+        try:
+            await control_db.event_bus_checkpoints.update_one({"_id": checkpoint_id}, update, upsert=True)
+        except PyMongoError as e:
+            logger.error(f"Event bus checkpoint write failed: {e}")
+
+    def subscribe(self, prefix: str, handler):
+        """تسجيل مستمع لكل الأحداث التي يبدأ نوعها بـ prefix"""
+        self.subscribers.append((prefix, handler))
+
+    async def dispatch(self, event: dict):
+        for prefix, handler in self.subscribers:
+            if not event["kind"].startswith(prefix):
+                continue
+            try:
+                await handler(event)
+            except Exception as e:
+                logger.error(f"Event handler {handler.__name__} failed for {event['kind']}: {e}")
+
+    @staticmethod
+    def to_event(collection: str, document: dict) -> dict:
+        if collection == "tasks":
+            kind = document.get("last_event") or "task.updated"
+        elif collection == "notifications":
+            kind = "notification.created"
+        else:
+            kind = "location.created"
+        document.pop("_id", None)
+        return {"kind": kind, "collection": collection, "document": document}
+
+    async def run(self):
+        if EVENT_BUS_MODE in ("auto", "change_stream"):
+            try:
+                self.mode = "change_stream"
+                await self.run_change_stream()
+            except OperationFailure as e:
+                # Standalone mongod has no oplog to open a change stream on
+                if EVENT_BUS_MODE == "change_stream":
+                    raise
+                logger.info(f"Change streams unavailable ({e.code}), event bus falling back to polling")
+        self.mode = "polling"
+        await self.run_polling()
+
+    def task_as_of_change(self, document: dict, updated: dict) -> dict:
+        """The updateLookup document is the task as it is now, possibly several
+        writes later (/sync and Telegram apply accept, start and complete back
+        to back). Overlay the fields this change wrote so the event carries its
+        own kind and timestamps, not the latest ones."""
+        document = {**document, **{field: value for field, value in updated.items() if "." not in field}}
+        if "last_event" not in updated:
+            # Setting last_event to its current value does not show up as a change
+            changed = [kind for field, kind in self.TASK_LIFECYCLE if field in updated]
+            document["last_event"] = changed[-1] if changed else "task.updated"
+        return document
+
+    async def run_change_stream(self):
+        # One stream over the whole deployment, narrowed to tenant databases
+        pipeline = [{"$match": {
+            "ns.db": {"$regex": f"^{re.escape(DB_NAME)}(__|$)"},
+            "ns.coll": {"$in": list(self.COLLECTIONS)},
+            "operationType": {"$in": ["insert", "update", "replace"]}
+        }}]
+        self.resume_token = (await self.load_checkpoint(self.CHANGE_STREAM_CHECKPOINT)).get("resume_token")
+        started = False
+        while True:
+            try:
+                async with client.watch(pipeline, full_document="updateLookup", resume_after=self.resume_token) as stream:
+                    started = True
+                    async for change in stream:
+                        self.resume_token = change["_id"]
+                        await self.dispatch_change(change)
+                        await self.save_checkpoint(self.CHANGE_STREAM_CHECKPOINT, {"$set": {"resume_token": self.resume_token}})
+            except OperationFailure as e:
+                if e.code == 286:
+                    # ChangeStreamHistoryLost: the resume point left the oplog
+                    logger.error("Change stream resume point lost, events since then are skipped")
+                    self.resume_token = None
+                    continue
+                # Failing to open the first stream means change streams are not
+                # supported here (standalone mongod); let run() switch to polling
+                if not started:
+                    raise
+                logger.error(f"Change stream interrupted: {e}")
+                await asyncio.sleep(1)
+            except PyMongoError as e:
+                logger.error(f"Change stream connection error: {e}")
+                await asyncio.sleep(1)
+
+    async def dispatch_change(self, change: dict):
+        tenant_id = database_tenant(change["ns"]["db"])
+        # Databases that share the prefix but are not registered tenants
+        if tenant_id not in tenants:
+            return
+        collection = change["ns"]["coll"]
+        document = change.get("fullDocument")
+        if not document:
+            return
+        if change["operationType"] == "update":
+            updated = change.get("updateDescription", {}).get("updatedFields", {})
+            if self.COLLECTIONS[collection] not in updated:
+                return
+            if collection == "tasks":
+                document = self.task_as_of_change(document, updated)
+        with tenant_scope(tenant_id):
+            await self.dispatch(self.to_event(collection, document))
+
+    def polled_task_events(self, document: dict) -> list:
+        """Several writes to one task between two polls show up as a single
+        document; replay the lifecycle transitions that were skipped so
+        subscribers still see created/accepted/started/completed in order."""
+        state = self.polling.current()
+        event = self.to_event("tasks", document)
+        present = [kind for field, kind in self.TASK_LIFECYCLE if document.get(field)]
+        seen = state.task_state.pop(document["id"], None)
+        if seen is None:
+            # Tasks from before the bus started only get their latest event
+            new_task = (document.get("created_at") or "") >= state.since
+            seen = set() if new_task else set(present)
+        events = [
+            {**event, "kind": kind}
+            for kind in present
+            if kind not in seen and kind != event["kind"]
+        ]
+        events.append(event)
+        seen.update(present)
+        state.task_state[document["id"]] = seen
+        if len(state.task_state) > self.MAX_TRACKED_TASKS:
+            state.task_state.popitem(last=False)
+        return events
+
+    async def attach(self):
+        """Loads the current tenant's polling position. Called when the tenant
+        is activated, before its in-memory indexes are built from a snapshot,
+        so no write can fall between the snapshot and the first poll."""
+        state = self.polling.current()
+        if state.cursors is not None:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        saved = (await self.load_checkpoint(current_tenant.get())).get("polling", {})
+        # Tasks created after the saved position get their full lifecycle
+        state.since = saved.get("tasks", now)
+        state.cursors = {name: (saved.get(name, now), set()) for name in self.COLLECTIONS}
+
+    async def run_polling(self):
+        while True:
+            await for_each_tenant("Event bus polling", self.poll)
+            await asyncio.sleep(EVENT_BUS_POLL_INTERVAL_SECONDS)
+
+    async def poll(self):
+        await self.attach()
+        cursors = self.polling.current().cursors
+        for collection, field in self.COLLECTIONS.items():
+            last_ts, seen = cursors[collection]
+            try:
+                documents = await db[collection].find(
+                    {field: {"$gte": last_ts}}
+                ).sort(field, 1).to_list(None)
+            except PyMongoError as e:
+                logger.error(f"Event bus polling error on {collection}: {e}")
+                continue
+            for document in documents:
+                key = (document.get("id"), document[field])
+                if document[field] == last_ts and key in seen:
+                    continue
+                if document[field] != last_ts:
+                    last_ts, seen = document[field], set()
+                seen.add(key)
+                if collection == "tasks":
+                    for event in self.polled_task_events(document):
+                        await self.dispatch(event)
+                else:
+                    await self.dispatch(self.to_event(collection, document))
+            cursors[collection] = (last_ts, seen)
+        await self.save_checkpoint(current_tenant.get(), {"$max": {
+            f"polling.{collection}": last_ts for collection, (last_ts, _) in cursors.items()
+        }})
+
+event_bus = EventBus()
+
+def event_notification_id(event: dict) -> str:
+    """معرف ثابت للإشعار حتى لا يكرره أكثر من عامل لنفس الحدث"""
+    task = event["document"]
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{event['kind']}:{task['id']}:{task.get('updated_at')}"))
+
+# Notification outbox
+# Every notification is one outbox document: the in-app notification and each
+# outside channel (Telegram, WhatsApp, ...) are deliveries inside it, so one
+# insert records all of them. A pool of workers claims due documents in
+# batches, hands each channel its deliveries at once and retries failures with
+# backoff; request handlers and the event bus only ever insert.
+
+class NotificationChannel:
+    """قناة إرسال؛ send تعيد لكل رسالة None عند النجاح أو نص الخطأ"""
+    name = ""
+    # Outside channels are only used for messages with text
+    external = True
+    
+    def address(self, user: dict) -> Optional[str]:
+        return None
+    
+    async def send(self, messages: list) -> list:
+        raise NotImplementedError
+
+class AppChannel(NotificationChannel):
+    name = "app"
+    external = False
+    
+    async def send(self, messages: list) -> list:
+        await insert_ignoring_duplicates(db.notifications, [
+            {
+                "id": message["id"],
+                "user_id": message["user_id"],
+                "task_id": message.get("task_id"),
+                "message": message["message"],
+                "type": message["type"],
+                "read": False,
+                "created_at": message["created_at"]
+            }
+            for message in messages
+        ])
+        return [None] * len(messages)
+
+class TelegramChannel(NotificationChannel):
+    name = "telegram"
+    
+    def address(self, user: dict) -> Optional[str]:
+        if not TELEGRAM_BOT_TOKEN:
+            return None
+        return user.get("telegram_chat_id")
+    
+    def payload(self, message: dict, address: str) -> dict:
+        payload = {"chat_id": address, "text": message["text"], "parse_mode": "HTML"}
+        if message.get("task_id"):
+            # زر يفتح المهمة مباشرة في التطبيق
+            keyboard = [[{"text": "📱 فتح المهمة", "url": f"{APP_URL}/?task={message['task_id']}"}]]
+            if message["type"] == "task_assigned":
+                # Handled by POST /telegram/webhook without opening the app.
+                # The bot is shared, so buttons of other tenants name theirs
+                tenant_suffix = "" if current_tenant.get() == DEFAULT_TENANT else f"@{current_tenant.get()}"
+                keyboard.insert(0, [
+                    {"text": label, "callback_data": f"{action}:{message['task_id']}{tenant_suffix}"}
+                    for action, (label, _) in TELEGRAM_TASK_ACTIONS.items()
+                ])
+            payload["reply_markup"] = {"inline_keyboard": keyboard}
+        return payload
+    
+    async def send(self, messages: list) -> list:
+        url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        async with httpx.AsyncClient(timeout=10) as client:
+            async def post(message):
+                try:
+                    response = await client.post(url, json=self.payload(message, message["address"]))
+                except httpx.HTTPError as e:
+                    return str(e) or type(e).__name__
+                return None if response.status_code == 200 else f"HTTP {response.status_code}: {response.text[:200]}"
+            return await asyncio.gather(*(post(message) for message in messages))
+
+class WhatsAppChannel(NotificationChannel):
+    name = "whatsapp"
+    
+    def address(self, user: dict) -> Optional[str]:
+        if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
+            return None
+        digits = re.sub(r"\D", "", normalize_search_text(user.get("whatsapp_number") or ""))
+        # The API wants international numbers; local ones are stored as 07xx...
+        if digits.startswith("00"):
+            digits = digits[2:]
+        elif digits.startswith("0"):
+            digits = WHATSAPP_COUNTRY_CODE + digits[1:]
+        return digits or None
+    
+    async def send(self, messages: list) -> list:
+        url = f"{WHATSAPP_API_BASE}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+        headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
+        async with httpx.AsyncClient(timeout=10, headers=headers) as client:
+            async def post(message):
+                try:
+                    response = await client.post(url, json={
+                        "messaging_product": "whatsapp",
+                        "to": message["address"],
+                        "type": "text",
+                        # WhatsApp has no HTML; the Telegram markup is dropped
+                        "text": {"body": re.sub(r"<[^>]+>", "", message["text"]).strip()}
+                    })
+                except httpx.HTTPError as e:
+                    return str(e) or type(e).__name__
+                return None if response.status_code == 200 else f"HTTP {response.status_code}: {response.text[:200]}"
+            return await asyncio.gather(*(post(message) for message in messages))
+
+class LocalChannel(NotificationChannel):
+    """يحتفظ بالرسائل في الذاكرة بدلاً من إرسالها؛ للاختبارات"""
+    name = "local"
+    
+    def __init__(self):
+        self.sent = []
+        # Set to an error text to make every send fail
+        self.fail_with = None
+    
+    def address(self, user: dict) -> Optional[str]:
+        return user["id"]
+    
+    async def send(self, messages: list) -> list:
+        if self.fail_with:
+            return [self.fail_with] * len(messages)
+        self.sent.extend(messages)
+        return [None] * len(messages)
+
+notification_channels = {
+    channel.name: channel
+    for channel in (AppChannel(), TelegramChannel(), WhatsAppChannel(), LocalChannel())
+    if channel.name in NOTIFICATION_CHANNELS
+}
+outbox_wakeup = asyncio.Event()
+
+async def enqueue_notification(
+    notification_id: str,
+    user_id: str,
+    message: str,
+    notification_type: str,
+    task_id: Optional[str] = None,
+    text: Optional[str] = None,
+    in_app: bool = True
+) -> bool:
+    """إضافة إشعار إلى صندوق الإرسال؛ False إذا كان مضافاً من قبل"""
+    deliveries = []
+    if in_app and "app" in notification_channels:
+        deliveries.append({"channel": "app", "address": user_id})
+    if text:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0}) or {"id": user_id}
+        for channel in notification_channels.values():
+            address = channel.address(user) if channel.external else None
+            if address:
+                deliveries.append({"channel": channel.name, "address": address})
+    if not deliveries:
+        return False
+    
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.notification_outbox.insert_one({
+            "id": notification_id,
+            "user_id": user_id,
+            "task_id": task_id,
+            "message": message,
+            "text": text,
+            "type": notification_type,
+            "deliveries": [{**delivery, "status": "pending", "attempts": 0} for delivery in deliveries],
+            "status": "pending",
+            "next_attempt_at": now,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        # Another worker already queued this notification
+        return False
+    outbox_wakeup.set()
+    return True
+
+async def claim_outbox_batch() -> list:
+    now = datetime.now(timezone.utc)
+    due = {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}}
+    candidates = await db.notification_outbox.find(due, {"_id": 0, "id": 1}) \
+        .sort("next_attempt_at", 1).limit(OUTBOX_BATCH_SIZE).to_list(OUTBOX_BATCH_SIZE)
+    if not candidates:
+        return []
+    # Claiming moves next_attempt_at past the lease, so a worker that dies
+    # mid-delivery only delays its messages. The filter is repeated, so a
+    # message another worker claimed in between is not taken twice; the token
+    # tells which of the candidates this worker got.
+    claim = str(uuid.uuid4())
+    await db.notification_outbox.update_many(
+        {**due, "id": {"$in": [message["id"] for message in candidates]}},
+        {"$set": {"next_attempt_at": (now + timedelta(seconds=OUTBOX_LEASE_SECONDS)).isoformat(), "claim": claim}}
+    )
+    return await db.notification_outbox.find({"claim": claim}, {"_id": 0}).to_list(OUTBOX_BATCH_SIZE)
+
+async def deliver_outbox_batch(batch: list):
+    by_channel = {}
+    for message in batch:
+        for delivery in message["deliveries"]:
+            if delivery["status"] == "pending":
+                by_channel.setdefault(delivery["channel"], []).append((message, delivery))
+    
+    async def deliver(channel_name, items):
+        channel = notification_channels.get(channel_name)
+        if channel is None:
+            errors = [f"Channel {channel_name} is disabled"] * len(items)
+        else:
+            try:
+                errors = await channel.send([{**message, "address": delivery["address"]} for message, delivery in items])
+            except Exception as e:
+                logger.error(f"Notification channel {channel_name} error: {e}")
+                errors = [str(e) or type(e).__name__] * len(items)
+        for (_, delivery), error in zip(items, errors):
+            delivery["attempts"] += 1
+            if error is None:
+                delivery["status"] = "sent"
+                delivery.pop("error", None)
+            else:
+                delivery["error"] = error
+                if delivery["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                    delivery["status"] = "failed"
+                    logger.warning(f"Giving up on {channel_name} delivery of {items[0][0]['id']}: {error}")
+    
+    await asyncio.gather(*(deliver(name, items) for name, items in by_channel.items()))
+    
+    now = datetime.now(timezone.utc)
+    for message in batch:
+        retrying = [delivery["attempts"] for delivery in message["deliveries"] if delivery["status"] == "pending"]
+        update = {"deliveries": message["deliveries"]}
+        if retrying:
+            # Exponential backoff on the most-tried delivery still pending
+            delay = OUTBOX_RETRY_BASE_SECONDS * 2 ** (max(retrying) - 1)
+            update["next_attempt_at"] = (now + timedelta(seconds=delay)).isoformat()
+        else:
+            sent = all(delivery["status"] == "sent" for delivery in message["deliveries"])
+            update["status"] = "sent" if sent else "failed"
+            update["expires_at"] = now + timedelta(seconds=OUTBOX_RETENTION_SECONDS)
+        await db.notification_outbox.update_one({"id": message["id"]}, {"$set": update})
+
+async def outbox_worker():
+    while True:
+        delivered = []
+
+        async def deliver_due():
+            batch = await claim_outbox_batch()
+            if batch:
+                await deliver_outbox_batch(batch)
+                delivered.append(len(batch))
+
+        await for_each_tenant("Notification outbox", deliver_due)
+        if delivered:
+            continue
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+async def notify_task_event(event: dict):
+    """إنشاء إشعارات المهام من أحداث الـ event bus بدلاً من داخل الطلب"""
+    task = event["document"]
+    
+    if event["kind"] in ("task.created", "task.assigned") and task.get("assigned_to"):
+        # Keyed on task and technician: a task created and auto-assigned between
+        # two polls arrives as both task.created and task.assigned
+        await enqueue_notification(
+            str(uuid.uuid5(uuid.NAMESPACE_URL, f"task_assigned:{task['id']}:{task['assigned_to']}")),
+            task["assigned_to"],
+            f"تم تعيين مهمة جديدة لك: {task['customer_name']}",
+            "task_assigned",
+            task_id=task["id"],
+            text=f"""
+🔔 <b>لديك مهمة جديدة!</b>
+
+👤 <b>المشترك:</b> {task['customer_name']}
+📞 <b>الهاتف:</b> {task['customer_phone']}
+📍 <b>العنوان:</b> {task['customer_address']}
+🔧 <b>العطل:</b> {task['issue_description']}
+
+⏰ <b>اضغط الزر أدناه لفتح المهمة مباشرة</b>
+            """
+        )
+    
+    elif event["kind"] == "task.accepted":
+        actor_name = task.get("accepted_by_name") or task.get("assigned_to_name")
+        message = f"قبل {actor_name} المهمة: {task['customer_name']}"
+        await enqueue_notification(
+            event_notification_id(event), task["created_by"], message, "task_accepted",
+            task_id=task["id"], text=message
+        )
+    
+    elif event["kind"] == "task.completed":
+        status_text = "بنجاح ✓" if task.get("success") is not False else "كغير مكتملة ✗"
+        duration_minutes = task.get("duration_minutes") or 0
+        duration_text = f" - المدة: {duration_minutes} دقيقة" if duration_minutes > 0 else ""
+        actor_name = task.get("completed_by_name") or task.get("assigned_to_name")
+        message = f"أنهى {actor_name} المهمة {status_text}: {task['customer_name']}{duration_text}"
+        await enqueue_notification(
+            event_notification_id(event), task["created_by"], message, "task_completed",
+            task_id=task["id"], text=message
+        )
+
+event_bus.subscribe("task.", notify_task_event)
+
+# Task event log
+# Task documents only keep the latest state; every transition the event bus
+# sees is also appended here, so reassignments and repeated taps stay visible.
+# The request handlers write nothing extra: events are buffered and written in
+# one unordered insert per flush, and each has an id derived from the event,
+# so every worker can log what its bus sees without creating duplicates.
+class TaskEventLog:
+    # A polled document can stand for several transitions; each replayed one
+    # is logged with the status it moved the task to, not the latest status
+    LIFECYCLE_STATUS = {
+        "task.created": "pending",
+        "task.accepted": "accepted",
+        "task.started": "in_progress",
+        "task.completed": "completed",
+    }
+    
+    def __init__(self):
+        self.pending = []
+        self.dropped = 0
+    
+    def record(self, event: dict):
+        task = event["document"]
+        field = next((field for field, kind in EventBus.TASK_LIFECYCLE if kind == event["kind"]), None)
+        self.pending.append({
+            "_id": event_notification_id(event),
+            "task_id": task["id"],
+            "kind": event["kind"],
+            # Lifecycle events carry their own (possibly device) time
+            "at": task.get(field) or task.get("updated_at") or task.get("created_at"),
+            "status": self.LIFECYCLE_STATUS.get(event["kind"], task.get("status")),
+            "assigned_to": task.get("assigned_to"),
+            "assigned_to_name": task.get("assigned_to_name"),
+            "logged_at": datetime.now(timezone.utc).isoformat()
+        })
+        if len(self.pending) > TASK_EVENTS_MAX_PENDING:
+            self.dropped += len(self.pending) - TASK_EVENTS_MAX_PENDING
+            del self.pending[:len(self.pending) - TASK_EVENTS_MAX_PENDING]
+        if len(self.pending) >= TASK_EVENTS_BATCH_SIZE:
+            task_events_wakeup.set()
+    
+    async def flush(self):
+        while self.pending:
+            batch = self.pending[:TASK_EVENTS_BATCH_SIZE]
+            try:
+                await insert_ignoring_duplicates(db.task_events, batch)
+            except PyMongoError as e:
+                logger.error(f"Task event log write failed, {len(self.pending)} events pending: {e}")
+                return
+            del self.pending[:len(batch)]
+
+task_event_log = TenantLocal(TaskEventLog)
+# Set when any tenant's buffer fills a batch
+task_events_wakeup = asyncio.Event()
+
+async def flush_task_event_log():
+    await task_event_log.flush()
+
+async def task_event_log_worker():
+    while True:
+        try:
+            await asyncio.wait_for(task_events_wakeup.wait(), TASK_EVENTS_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        task_events_wakeup.clear()
+        await for_each_tenant("Task event log flush", flush_task_event_log)
+
+async def log_task_event(event: dict):
+    task_event_log.record(event)
+
+event_bus.subscribe("task.", log_task_event)
+
+async def ensure_task_events_collection():
+    try:
+        await db.create_collection("task_events", capped=True, size=TASK_EVENTS_SIZE_BYTES)
+    except CollectionInvalid:
+        pass
+    await db.task_events.create_index([("task_id", 1), ("at", 1)])
+
+# Tenant registry
+# tenant id -> tenant document; the default tenant exists without a document
+tenants = {DEFAULT_TENANT: {"id": DEFAULT_TENANT, "name": DEFAULT_TENANT}}
+
+async def load_tenants():
+    async for tenant in control_db.tenants.find({}, {"_id": 0}):
+        tenants[tenant["id"]] = tenant
+
+async def activate_tenant(tenant_id: str):
+    """متجر أنشأه عامل آخر: تسجيله هنا ثم تشغيل عماله"""
+    tenant = await control_db.tenants.find_one({"id": tenant_id}, {"_id": 0})
+    if not tenant:
+        logger.error(f"Tenant {tenant_id} announced but not found in the registry")
+        return
+    tenants[tenant_id] = tenant
+    await activate_tenant_workers(tenant_id)
+
+async def tenants_worker():
+    # tenant.created reaches the other workers at once; this covers missed events
+    while True:
+        await asyncio.sleep(TENANTS_REFRESH_SECONDS)
+        try:
+            await load_tenants()
+            for tenant_id in list(tenants):
+                await activate_tenant_workers(tenant_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Tenant registry refresh error: {e}")
+
+def request_tenant(request: Request) -> str:
+    """المتجر من الـ tid في التوكن، أو من الترويسة قبل تسجيل الدخول"""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            return decode_token(authorization[7:]).get("tid", DEFAULT_TENANT)
+        except jwt.InvalidTokenError:
+            # get_current_user rejects the token; the header still picks the tenant
+            pass
+    return request.headers.get(TENANT_HEADER) or request.query_params.get("tenant") or DEFAULT_TENANT
+
 # Initialize default admin on startup
 @app.on_event("startup")
 async def create_default_admin():
+    # Only one worker runs the startup tasks; the others find the admin created
+    if not await acquire_lock("startup:default_admin", STARTUP_LOCK_TTL_SECONDS):
+        return
     # Check if admin exists
     admin = await db.users.find_one({"email": DEFAULT_ADMIN["email"]})
     if not admin:
@@ -113,8 +1216,145 @@ async def create_default_admin():
             "role": "admin",
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        await db.users.insert_one(admin_doc)
-        print(f"✓ Default admin created: {DEFAULT_ADMIN['email']}")
+        try:
+            await db.users.insert_one(admin_doc)
+            print(f"✓ Default admin created: {DEFAULT_ADMIN['email']}")
+        except DuplicateKeyError:
+            pass
+    await release_lock("startup:default_admin")
+
+@app.on_event("startup")
+async def ensure_indexes():
+    await control_db.tenants.create_index("id", unique=True)
+    await load_tenants()
+    for tenant_id in list(tenants):
+        with tenant_scope(tenant_id):
+            await ensure_tenant_indexes()
+
+async def ensure_tenant_indexes():
+    await db.users.create_index("email", unique=True)
+    await db.users.create_index("telegram_chat_id", sparse=True)
+    await db.tasks.create_index("updated_at")
+    await db.notifications.create_index("id", unique=True)
+    await db.notifications.create_index("created_at")
+    await db.notification_outbox.create_index("id", unique=True)
+    await db.notification_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.notification_outbox.create_index("claim", sparse=True)
+    await db.notification_outbox.create_index("expires_at", expireAfterSeconds=0)
+    await db.locations.create_index("timestamp")
+    await db.locations.create_index("received_at")
+    await db.locations.create_index("id", unique=True)
+    await db.sync_ops.create_index("created_at", expireAfterSeconds=SYNC_OP_TTL_SECONDS)
+    await db.sync_deletions.create_index("task_id", unique=True)
+    await db.sync_deletions.create_index([("assigned_to", 1), ("deleted_at", 1)])
+    await db.sync_deletions.create_index("created_at", expireAfterSeconds=SYNC_RETENTION_SECONDS)
+    await db.tasks.create_index([("assigned_to", 1), ("updated_at", 1)])
+    await db.response_cache.create_index("expires_at", expireAfterSeconds=0)
+    await db.response_cache.create_index("tags")
+    await db.tasks.create_index([("status", 1), ("completed_at", 1)])
+    await db.tasks_archive.create_index("id", unique=True)
+    await db.tasks_archive.create_index([("assigned_to", 1), ("completed_at", 1)])
+    await db.tasks_archive.create_index("completed_at")
+    await db.locations_archive.create_index("id", unique=True)
+    await db.locations_archive.create_index([("task_id", 1), ("timestamp", 1)])
+    await db.locations_archive.create_index([("user_id", 1), ("timestamp", 1)])
+    await db.notifications_archive.create_index("id", unique=True)
+    await db.notifications_archive.create_index("task_id")
+    await db.notifications.create_index("task_id")
+    await db.locations.create_index("task_id")
+    await db.tasks.create_index("deleted", partialFilterExpression={"deleted": True})
+    await db.deletion_jobs.create_index("id", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    # Once every token older than a revocation has expired, the entry is moot
+    await db.token_revocations.create_index("updated_at", expireAfterSeconds=JWT_EXPIRATION_HOURS * 3600)
+    await db.tasks.create_index([("assigned_to", 1), ("completed_at", 1)])
+    await db.locations.create_index([("user_id", 1), ("timestamp", 1)])
+    await db.daily_stats.create_index([("technician_id", 1), ("date", 1)], unique=True)
+    await db.daily_stats.create_index([("date", 1)])
+    await db.customers.create_index("id", unique=True)
+    await db.tasks.create_index("id", unique=True)
+    await db.schedules.create_index("id", unique=True)
+    await db.schedules.create_index([("active", 1), ("next_run_at", 1)])
+    await db.tasks.create_index([("status", 1), ("assigned_to", 1), ("created_at", 1)])
+    await db.geofence_presence.create_index([("user_id", 1), ("inside", 1)])
+    await db.geofence_events.create_index([("task_id", 1), ("at", 1)])
+    await db.customers.create_index("phone", unique=True)
+    await db.tasks.create_index([("customer_id", 1), ("created_at", -1)])
+    await db.tasks_archive.create_index([("customer_id", 1), ("created_at", -1)])
+
+# Background workers started on startup and cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_workers():
+    await ensure_worker_events_collection()
+    # One of each loop per process whatever the number of tenants; every loop
+    # visits the active tenants in turn, so a new shop adds work, not tasks
+    workers = [
+        worker_events_listener(),
+        tenants_worker(),
+        event_bus.run(),
+        task_event_log_worker(),
+        token_revocations_worker(),
+        task_search_worker(),
+        rollup_worker(),
+        archive_worker(),
+        deletion_cleanup_worker(),
+        scheduler_worker(),
+        assignment_worker(),
+        duration_model_worker(),
+        geofence_worker(),
+        geocode_worker(),
+    ] + [outbox_worker() for _ in range(OUTBOX_WORKERS)]
+    for worker in workers:
+        background_tasks.append(asyncio.create_task(worker))
+    for tenant_id in list(tenants):
+        await activate_tenant_workers(tenant_id)
+
+# Tenants the background loops of this process visit
+active_tenants = set()
+
+async def for_each_tenant(name: str, job):
+    """تشغيل job في سياق كل متجر نشط بالترتيب؛ فشل متجر لا يوقف البقية"""
+    for tenant_id in list(active_tenants):
+        with tenant_scope(tenant_id):
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{name} error for tenant {tenant_id}: {e}")
+
+async def activate_tenant_workers(tenant_id: str):
+    """ضم المتجر إلى العمال الخلفيين بعد تحميل ما يلزمه في الذاكرة"""
+    if tenant_id in active_tenants:
+        return
+    with tenant_scope(tenant_id):
+        await ensure_task_events_collection()
+        await load_token_revocations()
+        await event_bus.attach()
+        active_tenants.add(tenant_id)
+        # Background tasks inherit the tenant from the context they are created in
+        background_tasks.append(asyncio.create_task(load_tenant_state()))
+
+async def load_tenant_state():
+    """بناء حالة المتجر في الذاكرة مرة واحدة؛ الحلقات المشتركة تحدّثها بعد ذلك"""
+    # Built after the bus position is fixed so no write falls between the snapshot and the first event
+    for name, job in [
+        ("Task search index build", build_task_search_index),
+        ("Duration model training", train_duration_model),
+        ("Geofence index refresh", refresh_geofence_index),
+    ]:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"{name} error for tenant {current_tenant.get()}: {e}")
+    await backfill_customers()
+
+# Deleted tasks stay as tombstones until the background cleanup removes them
+NOT_DELETED = {"deleted": {"$ne": True}}
 
 # Models
 class UserCreate(BaseModel):
@@ -145,6 +1385,9 @@ class TaskCreate(BaseModel):
     customer_address: str
     issue_description: str
     assigned_to: Optional[str] = None
+    # Site coordinates, used by the assignment engine when known
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class Task(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -167,6 +1410,52 @@ class Task(BaseModel):
     duration_minutes: Optional[int] = None
     rating: Optional[int] = None  # 1-5 تقييم من الزبون
     rating_comment: Optional[str] = None  # تعليق الزبون
+    customer_id: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    arrived_at: Optional[str] = None
+    departed_at: Optional[str] = None
+
+class ScheduleCreate(BaseModel):
+    customer_name: str
+    customer_phone: str
+    customer_address: str
+    issue_description: str
+    assigned_to: Optional[str] = None
+    frequency: str  # daily, weekly, monthly
+    interval: int = Field(1, ge=1)  # every N days / weeks / months
+    starts_at: datetime
+    ends_at: Optional[datetime] = None
+
+class Schedule(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    customer_name: str
+    customer_phone: str
+    customer_address: str
+    issue_description: str
+    assigned_to: Optional[str] = None
+    frequency: str
+    interval: int
+    starts_at: str
+    ends_at: Optional[str] = None
+    next_run_at: Optional[str] = None
+    last_run_at: Optional[str] = None
+    runs: int = 0
+    active: bool
+    created_by: str
+    created_at: str
+
+class Customer(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    phone: str
+    name: str
+    address: str
+    created_at: str
+    task_count: int = 0
+    completed_count: int = 0
+    last_task_at: Optional[str] = None
 
 class LocationUpdate(BaseModel):
     task_id: str
@@ -198,6 +1487,16 @@ class Notification(BaseModel):
     read: bool
     created_at: str
 
+class TenantCreate(BaseModel):
+    id: str = Field(pattern=TENANT_ID_PATTERN)  # lowercase letters, digits and dashes
+    name: str
+    admin_name: str
+    admin_email: EmailStr
+    admin_password: str
+
+class BulkDeleteRequest(BaseModel):
+    task_ids: List[str]
+
 class TokenResponse(BaseModel):
     token: str
     user: User
@@ -209,25 +1508,83 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def create_token(user_id: str, role: str) -> str:
+def haversine_km(lat1, lon1, lat2, lon2):
+    """المسافة بالكيلومتر بين نقطتين (تعمل أيضاً على مصفوفات numpy)"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * np.arcsin(np.sqrt(a))
+
+def create_token(user: dict) -> str:
+    """التوكن يحمل بيانات المستخدم التي تحتاجها الـ handlers حتى لا تقرأ قاعدة البيانات"""
     expiration = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
-        "sub": user_id,
-        "role": role,
+        "sub": user["id"],
+        "role": user["role"],
+        "name": user["name"],
+        "email": user["email"],
+        "ver": user.get("token_version", 0),
+        "tid": current_tenant.get(),
         "exp": expiration
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return jwt.encode(payload, JWT_KEYS[JWT_ACTIVE_KID], algorithm=JWT_ALGORITHM, headers={"kid": JWT_ACTIVE_KID})
+
+def decode_token(token: str) -> dict:
+    kid = jwt.get_unverified_header(token).get("kid")
+    # Tokens issued before key rotation carry no kid and were signed with JWT_SECRET
+    key = JWT_KEYS.get(kid) if kid else JWT_SECRET
+    if key is None:
+        raise jwt.InvalidTokenError("Unknown signing key")
+    return jwt.decode(token, key, algorithms=[JWT_ALGORITHM])
+
+# user_id -> lowest token version still accepted. Only users who changed their
+# password or were deleted appear here, so the whole set stays in memory.
+revoked_token_versions = TenantLocal(dict)
+
+async def load_token_revocations():
+    revocations = {}
+    async for revocation in db.token_revocations.find({}):
+        revocations[revocation["_id"]] = revocation["version"]
+    revoked_token_versions.clear()
+    revoked_token_versions.update(revocations)
+
+async def revoke_tokens(user_id: str, version: int):
+    """إبطال كل توكنات المستخدم الأقدم من version في كل العمال"""
+    await db.token_revocations.update_one(
+        {"_id": user_id},
+        {"$set": {"version": version, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    revoked_token_versions[user_id] = version
+    await publish_worker_event("auth.revoke", {"user_id": user_id, "version": version})
+
+async def token_revocations_worker():
+    # worker_events delivers revocations immediately; this reload only covers
+    # events a worker may have missed
+    while True:
+        await asyncio.sleep(REVOCATIONS_REFRESH_SECONDS)
+        await for_each_tenant("Token revocations refresh", load_token_revocations)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = decode_token(token)
         user_id = payload.get("sub")
-        role = payload.get("role")
         
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         
+        if payload.get("ver", 0) < revoked_token_versions.get(user_id, 0):
+            raise HTTPException(status_code=401, detail="Token revoked")
+        
+        if "name" in payload:
+            return {
+                "id": user_id,
+                "role": payload["role"],
+                "name": payload["name"],
+                "email": payload["email"]
+            }
+        
+        # Tokens issued before claims were embedded
         user = await db.users.find_one({"id": user_id}, {"_id": 0})
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
@@ -238,63 +1595,443 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-# Auth Routes
-@api_router.post("/auth/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
-    user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password"]):
-        raise HTTPException(status_code=401, detail="البريد الإلكتروني أو كلمة السر غير صحيحة")
-    
-    token = create_token(user["id"], user["role"])
-    user_response = User(
-        id=user["id"],
-        name=user["name"],
-        email=user["email"],
-        role=user["role"],
-        created_at=user["created_at"]
-    )
-    
-    return TokenResponse(token=token, user=user_response)
+# Rate limiting
+# Token bucket budgets (tokens per second, burst) per route. Buckets are kept
+# in memory per worker process, so the effective limit is the configured one
+# multiplied by WEB_CONCURRENCY. Client addresses come from X-Forwarded-For
+# only when the proxy is listed in FORWARDED_ALLOW_IPS (gunicorn.conf.py).
+DEFAULT_RATE_LIMIT = (10.0, 50)
+ROUTE_RATE_LIMITS = {
+    # The phone sends a fix every 2 seconds, plus watchPosition callbacks
+    "POST /api/locations": (1.0, 10),
+    "GET /api/tasks": (1.0, 10),
+    "POST /api/broadcast-message": (0.1, 3),
+    # Per address; attempts are also limited per email below
+    "POST /api/auth/login": (1.0, 30),
+    # Every callback comes from Telegram's few addresses
+    "POST /api/telegram/webhook": (50.0, 200),
+    "GET /api/reports/performance": (0.2, 5),
+    "GET /api/reports/tasks/export": (0.05, 2),
+    # Keyed by email plus address, so one office behind NAT doesn't share it
+    "login attempts": (0.2, 5),
+}
 
-@api_router.get("/auth/me", response_model=User)
-async def get_me(current_user: dict = Depends(get_current_user)):
-    return User(**current_user)
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
 
-# Change Password
-class PasswordChange(BaseModel):
-    old_password: str
-    new_password: str
+    def take(self) -> float:
+        """يأخذ توكن واحد، ويرجع 0 أو عدد الثواني حتى يتوفر توكن"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
 
-@api_router.post("/auth/change-password")
-async def change_password(password_data: PasswordChange, current_user: dict = Depends(get_current_user)):
-    # Verify old password
+class RateLimiter:
+    def __init__(self, max_clients: int):
+        self.buckets = OrderedDict()
+        self.max_clients = max_clients
+        self.rejected = 0
+
+    def check(self, route: str, client_key: str) -> float:
+        rate, burst = ROUTE_RATE_LIMITS.get(route, DEFAULT_RATE_LIMIT)
+        key = (route, client_key)
+        bucket = self.buckets.pop(key, None) or TokenBucket(rate, burst)
+        self.buckets[key] = bucket
+        if len(self.buckets) > self.max_clients:
+            # Least recently seen client first
+            self.buckets.popitem(last=False)
+        retry_after = bucket.take()
+        if retry_after:
+            self.rejected += 1
+        return retry_after
+
+rate_limiter = RateLimiter(RATE_LIMIT_MAX_CLIENTS)
+
+def rate_limit_client_key(request: Request) -> str:
+    """المستخدم من الـ JWT بدون قاعدة البيانات، أو عنوان IP بدون توكن"""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            payload = decode_token(authorization[7:])
+            if payload.get("sub"):
+                return f"{current_tenant.get()}:user:{payload['sub']}"
+        except jwt.InvalidTokenError:
+            pass
+    # Each tenant gets its own budget even from a shared address
+    return f"{current_tenant.get()}:ip:{request.client.host if request.client else 'unknown'}"
+
+async def enforce_rate_limit(request: Request):
+    route = request.scope.get("route")
+    route_key = f"{request.method} {route.path if route else request.url.path}"
+    check_rate_limit(route_key, rate_limit_client_key(request))
+
+def check_rate_limit(route_key: str, client_key: str):
+    if not RATE_LIMIT_ENABLED:
+        return
+    retry_after = rate_limiter.check(route_key, client_key)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="طلبات كثيرة، يرجى المحاولة بعد قليل",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+class ConcurrencyLimiter:
+    """حد أعلى للطلبات المتزامنة؛ الطلب الزائد يُرفض فوراً بـ 429 بدل الانتظار"""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.shed = 0
+
+    def acquire(self):
+        if self.in_flight >= self.limit:
+            self.shed += 1
+            raise HTTPException(
+                status_code=429,
+                detail="الخادم مشغول، يرجى المحاولة بعد قليل",
+                headers={"Retry-After": "1"}
+            )
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    async def __call__(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def hold(self):
+        """يحجز خانة ويعيد دالة تحريرها؛ آمنة للاستدعاء أكثر من مرة"""
+        self.acquire()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+        return release
+
+    async def wrap_stream(self, stream, release):
+        """يبقي الخانة محجوزة حتى ينتهي البث، لا فقط حتى يرجع الـ handler"""
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            release()
+
+task_list_limiter = ConcurrencyLimiter("tasks_list", MAX_CONCURRENT_TASK_LISTS)
+broadcast_limiter = ConcurrencyLimiter("broadcast", MAX_CONCURRENT_BROADCASTS)
+export_limiter = ConcurrencyLimiter("export", MAX_CONCURRENT_EXPORTS)
+concurrency_limiters = [task_list_limiter, broadcast_limiter, export_limiter]
+
+# Response cache
+class MemoryCacheBackend:
+    """LRU محدود الحجم مع TTL داخل العامل"""
+
+    shared = False
+
+    def __init__(self, max_entries: int):
+        self.entries = OrderedDict()  # key -> (expires_at, tags, value)
+        self.tag_keys = {}
+        self.max_entries = max_entries
+        self.evictions = 0
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            for tag in entry[1]:
+                self.tag_keys.get(tag, set()).discard(key)
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if not entry:
+            return False, None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry[2]
+
+    async def set(self, key: str, value, tags: List[str], ttl: int):
+        self._drop(key)
+        self.entries[key] = (time.monotonic() + ttl, tags, value)
+        for tag in tags:
+            self.tag_keys.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, tag: str):
+        for key in list(self.tag_keys.pop(tag, ())):
+            self._drop(key)
+
+    def size(self) -> int:
+        return len(self.entries)
+
+class MongoCacheBackend:
+    """بديل مشترك بين العمال (مكان Redis) في مجموعة response_cache"""
+
+    shared = True
+
+    def __init__(self):
+        self.evictions = 0
+
+    async def get(self, key: str):
+        entry = await db.response_cache.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        if not entry:
+            return False, None
+        return True, entry["value"]
+
+    async def set(self, key: str, value, tags: List[str], ttl: int):
+        await db.response_cache.replace_one(
+            {"_id": key},
+            {"value": value, "tags": tags, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)},
+            upsert=True
+        )
+
+    async def invalidate_shared(self, tag: str):
+        await db.response_cache.delete_many({"tags": tag})
+
+    def size(self) -> Optional[int]:
+        return None
+
+class ResponseCache:
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation so a response loaded before an
+        # invalidation is not stored after it
+        self.generations = {}
+
+    async def get_or_load(self, key: str, tags: List[str], loader):
+        found, value = await self.backend.get(key)
+        if found:
+            self.hits += 1
+            return value
+        self.misses += 1
+        generations = [self.generations.get(tag, 0) for tag in tags]
+        value = await loader()
+        if generations == [self.generations.get(tag, 0) for tag in tags]:
+            await self.backend.set(key, value, tags, self.ttl)
+        return value
+
+    def invalidate_local(self, tag: Optional[str]):
+        if not tag:
+            return
+        self.generations[tag] = self.generations.get(tag, 0) + 1
+        if not self.backend.shared:
+            self.backend.invalidate(tag)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": RESPONSE_CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "size": self.backend.size(),
+            "evictions": self.backend.evictions
+        }
+
+# Per tenant, so one shop's entries and invalidations never touch another's
+response_cache = TenantLocal(lambda: ResponseCache(
+    MongoCacheBackend() if RESPONSE_CACHE_BACKEND == "mongo" else MemoryCacheBackend(RESPONSE_CACHE_MAX_ENTRIES),
+    RESPONSE_CACHE_TTL_SECONDS
+))
+
+register_cache("responses", lambda tag: response_cache.invalidate_local(tag))
+
+async def cached_response(route: str, current_user: dict, tags: List[str], loader, scope: Optional[str] = None):
+    """الرد من الكاش بمفتاح route + role + user (أو scope مشترك)"""
+    key = f"{route}|{current_user['role']}|{scope or current_user['id']}"
+    return await response_cache.get_or_load(key, tags, loader)
+
+async def invalidate_responses(*tags: str):
+    """يُستدعى من الـ routes التي تعدل البيانات؛ يصل لكل العمال عبر worker_events"""
+    for tag in tags:
+        if response_cache.backend.shared:
+            await response_cache.backend.invalidate_shared(tag)
+        await invalidate_cache("responses", tag)
+
+async def invalidate_responses_from_event(event: dict):
+    # Catches task writes that do not go through a route handler of this worker
+    response_cache.invalidate_local("tasks")
+    if response_cache.backend.shared:
+        await response_cache.backend.invalidate_shared("tasks")
+
+event_bus.subscribe("task.", invalidate_responses_from_event)
+
+# Tenant Routes
+@api_router.post("/tenants")
+async def create_tenant(tenant_data: TenantCreate, current_user: dict = Depends(get_current_user)):
+    """إنشاء متجر جديد بقاعدة بيانات ومدير خاصين به (لمدير المتجر الأساسي فقط)"""
+    if current_user["role"] != "admin" or current_tenant.get() != DEFAULT_TENANT:
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    tenant_doc = {
+        "id": tenant_data.id,
+        "name": tenant_data.name,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    if tenant_data.id == DEFAULT_TENANT:
+        raise HTTPException(status_code=400, detail="المتجر موجود مسبقاً")
+    try:
+        await control_db.tenants.insert_one({**tenant_doc})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="المتجر موجود مسبقاً")
+    tenants[tenant_data.id] = tenant_doc
+    
+    with tenant_scope(tenant_data.id):
+        await ensure_tenant_indexes()
+        await db.users.insert_one({
+            "id": str(uuid.uuid4()),
+            "name": tenant_data.admin_name,
+            "email": tenant_data.admin_email,
+            "password": hash_password(tenant_data.admin_password),
+            "role": "admin",
+            "created_at": tenant_doc["created_at"]
+        })
+    await activate_tenant_workers(tenant_data.id)
+    await publish_worker_event("tenant.created", {"id": tenant_data.id})
+    
+    return tenant_doc
+
+@api_router.get("/tenants")
+async def get_tenants(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin" or current_tenant.get() != DEFAULT_TENANT:
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    return list(tenants.values())
+
+# Auth Routes
+@api_router.post("/auth/login", response_model=TokenResponse)
+async def login(credentials: UserLogin, request: Request):
+    check_rate_limit("login attempts", f"{rate_limit_client_key(request)}:{credentials.email.lower()}")
+    user = await db.users.find_one({"email": credentials.email})
+    if not user or not verify_password(credentials.password, user["password"]):
+        raise HTTPException(status_code=401, detail="البريد الإلكتروني أو كلمة السر غير صحيحة")
+    
+    token = create_token(user)
+    user_response = User(
+        id=user["id"],
+        name=user["name"],
+        email=user["email"],
+        role=user["role"],
+        created_at=user["created_at"]
+    )
+    
+    return TokenResponse(token=token, user=user_response)
+
+@api_router.get("/auth/me", response_model=User)
+async def get_me(current_user: dict = Depends(get_current_user)):
+    user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "password": 0})
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return User(**user)
+
+# Change Password
+class PasswordChange(BaseModel):
+    old_password: str
+    new_password: str
+
+@api_router.post("/auth/change-password")
+async def change_password(password_data: PasswordChange, current_user: dict = Depends(get_current_user)):
+    # Verify old password
     user = await db.users.find_one({"id": current_user["id"]})
     if not user or not verify_password(password_data.old_password, user["password"]):
         raise HTTPException(status_code=400, detail="الرمز القديم غير صحيح")
     
-    # Update password
+    # Update password and invalidate every token issued before the change
     new_hashed = hash_password(password_data.new_password)
+    token_version = user.get("token_version", 0) + 1
     await db.users.update_one(
         {"id": current_user["id"]},
-        {"$set": {"password": new_hashed}}
+        {"$set": {"password": new_hashed, "token_version": token_version}}
     )
+    await revoke_tokens(current_user["id"], token_version)
     
-    return {"message": "تم تغيير الرمز بنجاح"}
+    # Fresh token so this session keeps working
+    return {"message": "تم تغيير الرمز بنجاح", "token": create_token({**user, "token_version": token_version})}
 
-# Task Routes
-@api_router.post("/tasks", response_model=Task)
-async def create_task(task_data: TaskCreate, current_user: dict = Depends(get_current_user)):
-    if current_user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+# Task transitions shared by the route handlers, offline sync and other entry points.
+# Event times may come from a device; updated_at is always server time.
+async def apply_accept(task: dict, actor: dict, at: datetime):
+    await db.tasks.update_one(
+        {"id": task["id"]},
+        {"$set": {
+            "status": "accepted",
+            "accepted_at": at.isoformat(),
+            "accepted_by_name": actor.get("name"),
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "last_event": "task.accepted"
+        }}
+    )
+
+async def apply_start(task: dict, at: datetime):
+    await db.tasks.update_one(
+        {"id": task["id"]},
+        {"$set": {
+            "status": "in_progress",
+            "started_at": at.isoformat(),
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "last_event": "task.started"
+        }}
+    )
+
+async def apply_complete(task: dict, actor: dict, report_text: str, images: Optional[List[str]], success: Optional[bool], at: datetime) -> int:
+    # Calculate duration
+    duration_minutes = 0
+    if task.get("started_at"):
+        started_at = datetime.fromisoformat(task["started_at"].replace('Z', '+00:00'))
+        duration_minutes = max(0, int((at - started_at).total_seconds() / 60))
     
-    task_id = str(uuid.uuid4())
+    previous = await db.tasks.find_one_and_update(
+        {"id": task["id"]},
+        {"$set": {
+            "status": "completed",
+            "completed_at": at.isoformat(),
+            "completed_by_name": actor.get("name"),
+            "report": report_text,
+            "report_images": images,
+            "success": success,
+            "duration_minutes": duration_minutes,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "last_event": "task.completed"
+        }},
+        projection={"_id": 0, "status": 1, "customer_id": 1}
+    )
+    # A resubmitted report must not count the visit twice
+    if previous and previous["status"] != "completed" and previous.get("customer_id"):
+        await db.customers.update_one({"id": previous["customer_id"]}, {"$inc": {"completed_count": 1}})
+    return duration_minutes
+
+async def new_task_doc(task_data: TaskCreate, created_by: str, task_id: Optional[str] = None) -> dict:
+    """مستند مهمة جديدة مرتبط بالزبون، لكل من ينشئ المهام (المدير والجدولة)"""
+    task_id = task_id or str(uuid.uuid4())
     assigned_to_name = None
+    created_at = datetime.now(timezone.utc).isoformat()
     
     if task_data.assigned_to:
         tech = await db.users.find_one({"id": task_data.assigned_to}, {"_id": 0})
         if tech:
             assigned_to_name = tech["name"]
     
+    customer = await link_customer(task_data.customer_name, task_data.customer_phone, task_data.customer_address, created_at)
+    
     task_doc = {
         "id": task_id,
         "customer_name": task_data.customer_name,
@@ -304,8 +2041,8 @@ async def create_task(task_data: TaskCreate, current_user: dict = Depends(get_cu
         "status": "pending",
         "assigned_to": task_data.assigned_to,
         "assigned_to_name": assigned_to_name,
-        "created_by": current_user["id"],
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_by": created_by,
+        "created_at": created_at,
         "accepted_at": None,
         "started_at": None,
         "completed_at": None,
@@ -314,57 +2051,290 @@ async def create_task(task_data: TaskCreate, current_user: dict = Depends(get_cu
         "success": True,
         "duration_minutes": None,
         "rating": None,
-        "rating_comment": None
+        "rating_comment": None,
+        "customer_id": customer["id"] if customer else None,
+        "latitude": task_data.latitude,
+        "longitude": task_data.longitude,
+        "updated_at": created_at,
+        "last_event": "task.created"
     }
-    
-    await db.tasks.insert_one(task_doc)
-    
-    # Create notification for assigned technician
-    if task_data.assigned_to:
-        notification_doc = {
-            "id": str(uuid.uuid4()),
-            "user_id": task_data.assigned_to,
-            "task_id": task_id,
-            "message": f"تم تعيين مهمة جديدة لك: {task_data.customer_name}",
-            "type": "task_assigned",
-            "read": False,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.notifications.insert_one(notification_doc)
-        
-        # إرسال رسالة Telegram مع رابط مباشر للمهمة
-        if tech and tech.get("telegram_chat_id"):
-            telegram_message = f"""
-🔔 <b>لديك مهمة جديدة!</b>
+    return task_doc
 
-👤 <b>المشترك:</b> {task_data.customer_name}
-📞 <b>الهاتف:</b> {task_data.customer_phone}
-📍 <b>العنوان:</b> {task_data.customer_address}
-🔧 <b>العطل:</b> {task_data.issue_description}
+# Task search
+# Each worker keeps an inverted index of the searchable task fields in memory,
+# built at startup and kept current from the event bus. Only ids are indexed;
+# the page of results is read back from Mongo.
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTER_VARIANTS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي",
+    "ة": "ه",
+    "ؤ": "و",
+    # Arabic-Indic and Persian digits
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06f0 + i): str(i) for i in range(10)},
+})
+SEARCH_TOKEN = re.compile(r"\w+")
+PHONE_QUERY = re.compile(r"[\d\s+()-]*\d{3}[\d\s+()-]*")
 
-⏰ <b>اضغط الزر أدناه لفتح المهمة مباشرة</b>
-            """
-            # إرسال الرسالة مع رابط المهمة المحددة
-            await send_telegram_message_with_button(
-                tech["telegram_chat_id"], 
-                telegram_message,
-                task_id
-            )
+def normalize_search_text(text: str) -> str:
+    """توحيد أشكال الحروف العربية وإزالة التشكيل قبل الفهرسة والبحث"""
+    return ARABIC_DIACRITICS.sub("", text or "").translate(ARABIC_LETTER_VARIANTS).lower()
+
+def search_tokens(text: str) -> List[str]:
+    return SEARCH_TOKEN.findall(normalize_search_text(text))
+
+def index_terms(text: str) -> List[str]:
+    terms = []
+    for token in search_tokens(text):
+        terms.append(token)
+        # "الشبكة" is also found by "شبكة"
+        if token.startswith("ال") and len(token) > 4:
+            terms.append(token[2:])
+    return terms
+
+def phone_digits(phone: str) -> str:
+    digits = re.sub(r"\D", "", normalize_search_text(phone))
+    # Local numbers are stored as 07xx...; match them when typed as 9647xx... too
+    if digits.startswith("964"):
+        digits = "0" + digits[3:]
+    return digits
+
+class TaskSearchIndex:
+    FIELD_WEIGHTS = {
+        "customer_name": 3.0,
+        "customer_phone": 3.0,
+        "customer_address": 1.0,
+        "issue_description": 1.0,
+    }
+    # A query token that is only a prefix of the indexed term counts for less
+    PREFIX_FACTOR = 0.5
+    # Shorter tokens match whole terms only; a single letter would expand to most of the index
+    MIN_PREFIX_LENGTH = 2
+
+    def __init__(self):
+        # term -> {task_id: weight}
+        self.postings = {}
+        # Sorted terms for prefix lookups
+        self.terms = []
+        # task_id -> (terms, assigned_to, created_at, updated_at)
+        self.tasks = {}
+
+    def add(self, task: dict):
+        indexed = self.tasks.get(task["id"])
+        # A snapshot read at startup may be older than an event already applied
+        if indexed and (task.get("updated_at") or "") < (indexed[3] or ""):
+            return
+        self.remove(task["id"])
+        if task.get("deleted"):
+            return
+        weights = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            tokens = index_terms(task.get(field))
+            if field == "customer_phone":
+                tokens.append(phone_digits(task.get(field)))
+            for token in tokens:
+                if token:
+                    weights[token] = max(weights.get(token, 0.0), weight)
+        for term, weight in weights.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                bisect.insort(self.terms, term)
+            self.postings[term][task["id"]] = weight
+        self.tasks[task["id"]] = (list(weights), task.get("assigned_to"), task.get("created_at") or "", task.get("updated_at"))
+
+    def remove(self, task_id: str):
+        indexed = self.tasks.pop(task_id, None)
+        if not indexed:
+            return
+        for term in indexed[0]:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(task_id, None)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def match(self, token: str) -> dict:
+        """task_id -> أفضل وزن لكلمة البحث (مطابقة كاملة أو بادئة)"""
+        scores = dict(self.postings.get(token, {}))
+        if len(token) < self.MIN_PREFIX_LENGTH:
+            return scores
+        start = bisect.bisect_left(self.terms, token)
+        for term in self.terms[start:]:
+            if not term.startswith(token):
+                break
+            if term == token:
+                continue
+            for task_id, weight in self.postings[term].items():
+                scores[task_id] = max(scores.get(task_id, 0.0), weight * self.PREFIX_FACTOR)
+        return scores
+
+    def search(self, query: str, assigned_to: Optional[str] = None) -> List[str]:
+        """كل الكلمات يجب أن تطابق؛ الترتيب حسب مجموع الأوزان ثم الأحدث"""
+        tokens = search_tokens(query)
+        # "0770 123 4567" is one phone number, not three words
+        if PHONE_QUERY.fullmatch(normalize_search_text(query)):
+            tokens = [phone_digits(query)]
+        if not tokens:
+            return []
+        scores = None
+        for token in dict.fromkeys(tokens):
+            matches = self.match(token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {task_id: score + matches[task_id] for task_id, score in scores.items() if task_id in matches}
+            if not scores:
+                return []
+        if assigned_to:
+            scores = {task_id: score for task_id, score in scores.items() if self.tasks[task_id][1] == assigned_to}
+        return sorted(scores, key=lambda task_id: (scores[task_id], self.tasks[task_id][2]), reverse=True)
+
+task_search_index = TenantLocal(TaskSearchIndex)
+
+async def build_task_search_index():
+    projection = {"_id": 0, "id": 1, "assigned_to": 1, "created_at": 1, "updated_at": 1, **{field: 1 for field in TaskSearchIndex.FIELD_WEIGHTS}}
+    async for task in db.tasks.find(NOT_DELETED, projection):
+        task_search_index.add(task)
+        await asyncio.sleep(0)
+    logger.info(f"Task search index built: {len(task_search_index.tasks)} tasks, {len(task_search_index.terms)} terms")
+
+async def reconcile_task_search_index():
+    """إزالة المهام التي خرجت من المجموعة بدون حدث (الأرشفة وتنظيف المحذوفات)"""
+    existing = {task["id"] async for task in db.tasks.find(NOT_DELETED, {"_id": 0, "id": 1})}
+    for task_id in [task_id for task_id in task_search_index.tasks if task_id not in existing]:
+        task_search_index.remove(task_id)
+
+async def task_search_worker():
+    # Each tenant's index is built by load_tenant_state; this only reconciles
+    while True:
+        await asyncio.sleep(SEARCH_RECONCILE_INTERVAL_SECONDS)
+        await for_each_tenant("Task search index reconcile", reconcile_task_search_index)
+
+async def index_task_from_event(event: dict):
+    task_search_index.add(event["document"])
+
+event_bus.subscribe("task.", index_task_from_event)
+
+# Task Routes
+@api_router.post("/tasks", response_model=Task)
+async def create_task(task_data: TaskCreate, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    task_doc = await new_task_doc(task_data, current_user["id"])
+    
+    # Notifications and the Telegram message are sent by notify_task_event
+    await db.tasks.insert_one(task_doc)
+    await count_customer_tasks([task_doc])
+    await invalidate_responses("tasks")
     
     return Task(**task_doc)
 
-@api_router.get("/tasks", response_model=List[Task])
+@api_router.get("/tasks", response_model=List[Task], dependencies=[Depends(task_list_limiter)])
 async def get_tasks(current_user: dict = Depends(get_current_user)):
     if current_user["role"] == "admin":
-        tasks = await db.tasks.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        tasks = await cached_response(
+            "tasks", current_user, ["tasks"],
+            lambda: read_db.tasks.find(NOT_DELETED, {"_id": 0}).sort("created_at", -1).to_list(1000),
+            scope="all"
+        )
     else:
-        tasks = await db.tasks.find({"assigned_to": current_user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        tasks = await read_db.tasks.find({**NOT_DELETED, "assigned_to": current_user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     return tasks
 
+@api_router.get("/tasks/history", response_model=List[Task])
+async def get_task_history(
+    technician_id: Optional[str] = None,
+    customer_phone: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """سجل المهام من المجموعة الحالية والأرشيف معاً"""
+    query = dict(NOT_DELETED)
+    if current_user["role"] != "admin":
+        query["assigned_to"] = current_user["id"]
+    elif technician_id:
+        query["assigned_to"] = technician_id
+    if customer_phone:
+        query["customer_phone"] = customer_phone
+    created_range = parse_report_range(date_from, date_to)
+    if created_range:
+        query["created_at"] = created_range
+    
+    pipeline = [
+        {"$match": query},
+        {"$unionWith": {"coll": "tasks_archive", "pipeline": [{"$match": query}]}},
+        {"$sort": {"created_at": -1}},
+        {"$skip": (page - 1) * page_size},
+        {"$limit": page_size},
+        {"$project": {"_id": 0}}
+    ]
+    return await read_db.tasks.aggregate(pipeline, allowDiskUse=True).to_list(page_size)
+
+@api_router.get("/tasks/search")
+async def search_tasks(
+    q: str = Query(..., min_length=1),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """البحث في المهام بالاسم والهاتف والعنوان ووصف العطل"""
+    assigned_to = None if current_user["role"] == "admin" else current_user["id"]
+    ranked = task_search_index.search(q, assigned_to)
+    page_ids = ranked[(page - 1) * page_size:page * page_size]
+    
+    tasks = await read_db.tasks.find({**NOT_DELETED, "id": {"$in": page_ids}}, {"_id": 0}).to_list(len(page_ids))
+    by_id = {task["id"]: task for task in tasks}
+    # Archived or cleaned-up tasks leave the tasks collection without an event
+    for task_id in page_ids:
+        if task_id not in by_id:
+            task_search_index.remove(task_id)
+    
+    return {
+        "total": len(ranked),
+        "page": page,
+        "page_size": page_size,
+        "tasks": [Task(**by_id[task_id]) for task_id in page_ids if task_id in by_id]
+    }
+
+@api_router.get("/tasks/route")
+async def get_task_route(technician_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """ترتيب المهام المفتوحة للموظف في مسار قصير يبدأ من آخر موقع له"""
+    if current_user["role"] != "admin":
+        technician_id = current_user["id"]
+    elif not technician_id:
+        raise HTTPException(status_code=400, detail="يرجى اختيار الموظف")
+    
+    tasks = await read_db.tasks.find(
+        {**NOT_DELETED, "assigned_to": technician_id, "status": {"$in": ["pending", "accepted", "in_progress"]}},
+        {"_id": 0}
+    ).sort("created_at", 1).to_list(ROUTE_MAX_STOPS)
+    fix = await read_db.locations.find_one({"user_id": technician_id}, {"_id": 0}, sort=[("timestamp", -1)])
+    origin = (round(fix["latitude"], ROUTE_POSITION_PRECISION), round(fix["longitude"], ROUTE_POSITION_PRECISION)) if fix else None
+    
+    located = [task for task in tasks if task.get("latitude") is not None and task.get("longitude") is not None]
+    # Without a site there is nothing to route; those keep created_at order at the end
+    unlocated = [task for task in tasks if task.get("latitude") is None or task.get("longitude") is None]
+    
+    order, legs = route_cache.get(origin, located)
+    return {
+        "technician_id": technician_id,
+        "origin": {"latitude": origin[0], "longitude": origin[1]} if origin else None,
+        "total_distance_km": round(float(sum(legs)), 2),
+        "legs_km": [round(float(leg), 2) for leg in legs],
+        "tasks": [Task(**located[i]) for i in order] + [Task(**task) for task in unlocated]
+    }
+
 @api_router.get("/tasks/{task_id}", response_model=Task)
 async def get_task(task_id: str, current_user: dict = Depends(get_current_user)):
-    task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
+    task = await find_task_with_archive(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
@@ -375,18 +2345,23 @@ async def delete_task(task_id: str, current_user: dict = Depends(get_current_use
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
     
-    task = await db.tasks.find_one({"id": task_id})
+    # One atomic write; locations and notifications are removed by the cleanup worker
+    deleted_at = datetime.now(timezone.utc).isoformat()
+    task = await db.tasks.find_one_and_update(
+        {**NOT_DELETED, "id": task_id},
+        {"$set": {
+            "deleted": True,
+            "deleted_at": deleted_at,
+            "updated_at": deleted_at,
+            "last_event": "task.deleted"
+        }},
+        projection={"_id": 1}
+    )
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
-    # Delete task
-    await db.tasks.delete_one({"id": task_id})
-    
-    # Delete related locations
-    await db.locations.delete_many({"task_id": task_id})
-    
-    # Delete related notifications
-    await db.notifications.delete_many({"task_id": task_id})
+    wake_deletion_cleanup()
+    await invalidate_responses("tasks")
     
     return {"message": "تم حذف المهمة بنجاح"}
 
@@ -395,32 +2370,15 @@ async def accept_task(task_id: str, current_user: dict = Depends(get_current_use
     if current_user["role"] != "technician":
         raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
     
-    task = await db.tasks.find_one({"id": task_id})
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id})
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
     if task["assigned_to"] != current_user["id"]:
         raise HTTPException(status_code=403, detail="هذه المهمة ليست مخصصة لك")
     
-    await db.tasks.update_one(
-        {"id": task_id},
-        {"$set": {
-            "status": "accepted",
-            "accepted_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
-    
-    # Create notification for admin
-    notification_doc = {
-        "id": str(uuid.uuid4()),
-        "user_id": task["created_by"],
-        "task_id": task_id,
-        "message": f"قبل {current_user['name']} المهمة: {task['customer_name']}",
-        "type": "task_accepted",
-        "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.notifications.insert_one(notification_doc)
+    await apply_accept(task, current_user, datetime.now(timezone.utc))
+    await invalidate_responses("tasks")
     
     return {"message": "تم قبول المهمة"}
 
@@ -429,18 +2387,12 @@ async def start_task(task_id: str, current_user: dict = Depends(get_current_user
     if current_user["role"] != "technician":
         raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
     
-    task = await db.tasks.find_one({"id": task_id})
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id})
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
-    start_time = datetime.now(timezone.utc).isoformat()
-    await db.tasks.update_one(
-        {"id": task_id},
-        {"$set": {
-            "status": "in_progress",
-            "started_at": start_time
-        }}
-    )
+    await apply_start(task, datetime.now(timezone.utc))
+    await invalidate_responses("tasks")
     
     return {"message": "تم بدء المهمة"}
 
@@ -449,46 +2401,112 @@ async def complete_task(task_id: str, report_data: TaskReport, current_user: dic
     if current_user["role"] != "technician":
         raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
     
-    task = await db.tasks.find_one({"id": task_id})
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id})
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
-    completed_at = datetime.now(timezone.utc)
+    duration_minutes = await apply_complete(
+        task, current_user, report_data.report_text, report_data.images, report_data.success, datetime.now(timezone.utc)
+    )
+    await invalidate_responses("tasks")
     
-    # Calculate duration
-    duration_minutes = 0
-    if task.get("started_at"):
-        started_at = datetime.fromisoformat(task["started_at"].replace('Z', '+00:00'))
-        duration_minutes = int((completed_at - started_at).total_seconds() / 60)
+    return {"message": "تم إنهاء المهمة بنجاح", "duration_minutes": duration_minutes}
+
+# Telegram webhook
+# The task_assigned message carries accept/start/done buttons. A tap arrives
+# here as a callback query and is answered in the webhook response itself, so
+# no second request to the Bot API is needed within Telegram's time budget.
+TELEGRAM_TASK_ACTIONS = {
+    # action: (button label, status the task must be in)
+    "accept": ("✅ قبول", "pending"),
+    "start": ("▶️ بدء", "accepted"),
+    "done": ("🏁 إنهاء", "in_progress"),
+}
+TELEGRAM_DONE_REPORT = "تم الإنهاء من Telegram"
+
+@app.on_event("startup")
+async def register_telegram_webhook():
+    if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_BOT_TOKEN:
+        return
+    if not TELEGRAM_WEBHOOK_SECRET:
+        logger.error("TELEGRAM_WEBHOOK_URL is set without TELEGRAM_WEBHOOK_SECRET; the webhook stays disabled")
+        return
+    if not await acquire_lock("startup:telegram_webhook", STARTUP_LOCK_TTL_SECONDS):
+        return
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            webhook = {
+                "url": TELEGRAM_WEBHOOK_URL,
+                "allowed_updates": ["callback_query"],
+                "secret_token": TELEGRAM_WEBHOOK_SECRET
+            }
+            response = await client.post(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/setWebhook", json=webhook)
+        if response.status_code != 200:
+            logger.error(f"Telegram setWebhook failed: HTTP {response.status_code} {response.text[:200]}")
+    except httpx.HTTPError as e:
+        logger.error(f"Telegram setWebhook error: {e}")
+    await release_lock("startup:telegram_webhook")
+
+async def handle_telegram_action(chat_id: str, data: str) -> str:
+    """تنفيذ زر المهمة؛ يعيد النص الذي يظهر للموظف في Telegram"""
+    action, _, task_id = data.partition(":")
+    if action not in TELEGRAM_TASK_ACTIONS:
+        return "إجراء غير معروف"
     
-    await db.tasks.update_one(
-        {"id": task_id},
-        {"$set": {
-            "status": "completed",
-            "completed_at": completed_at.isoformat(),
-            "report": report_data.report_text,
-            "report_images": report_data.images,
-            "success": report_data.success,
-            "duration_minutes": duration_minutes
-        }}
-    )
+    user = await db.users.find_one({"telegram_chat_id": chat_id, "role": "technician"}, {"_id": 0, "id": 1, "name": 1})
+    if not user:
+        return "هذا الحساب غير مرتبط بموظف"
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id})
+    if not task:
+        return "المهمة غير موجودة"
+    if task["assigned_to"] != user["id"]:
+        return "هذه المهمة ليست مخصصة لك"
+    # Old messages keep their buttons; a stale tap must not move the task backwards
+    if task["status"] != TELEGRAM_TASK_ACTIONS[action][1]:
+        return "لا يمكن تنفيذ هذا الإجراء في حالة المهمة الحالية"
     
-    # Create detailed notification for admin
-    status_text = "بنجاح ✓" if report_data.success else "كغير مكتملة ✗"
-    duration_text = f" - المدة: {duration_minutes} دقيقة" if duration_minutes > 0 else ""
+    now = datetime.now(timezone.utc)
+    if action == "accept":
+        await apply_accept(task, user, now)
+        reply = "تم قبول المهمة"
+    elif action == "start":
+        await apply_start(task, now)
+        reply = "تم بدء المهمة"
+    else:
+        await apply_complete(task, user, TELEGRAM_DONE_REPORT, None, True, now)
+        reply = "تم إنهاء المهمة بنجاح"
+    await invalidate_responses("tasks")
+    return reply
+
+@api_router.post("/telegram/webhook")
+async def telegram_webhook(update: dict, request: Request):
+    """استقبال ضغطات أزرار Telegram"""
+    # Without a secret anyone could forge a tap for any technician's chat id
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(
+        request.headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8"),
+        TELEGRAM_WEBHOOK_SECRET.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="غير مصرح")
     
-    notification_doc = {
-        "id": str(uuid.uuid4()),
-        "user_id": task["created_by"],
-        "task_id": task_id,
-        "message": f"أنهى {current_user['name']} المهمة {status_text}: {task['customer_name']}{duration_text}",
-        "type": "task_completed",
-        "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+    callback = update.get("callback_query")
+    if not callback:
+        return {}
+    chat_id = str(callback.get("from", {}).get("id", ""))
+    data, _, tenant_id = (callback.get("data") or "").partition("@")
+    tenant_id = tenant_id or DEFAULT_TENANT
+    if tenant_id in tenants:
+        with tenant_scope(tenant_id):
+            reply = await handle_telegram_action(chat_id, data)
+    else:
+        reply = "المتجر غير موجود"
+    # Telegram runs a method returned as the webhook response
+    return {
+        "method": "answerCallbackQuery",
+        "callback_query_id": callback["id"],
+        "text": reply
     }
-    await db.notifications.insert_one(notification_doc)
-    
-    return {"message": "تم إنهاء المهمة بنجاح", "duration_minutes": duration_minutes}
 
 # Location Routes
 @api_router.post("/locations")
@@ -496,21 +2514,48 @@ async def update_location(location_data: LocationUpdate, current_user: dict = De
     if current_user["role"] != "technician":
         raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
     
+    now = datetime.now(timezone.utc)
     location_doc = {
         "id": str(uuid.uuid4()),
         "task_id": location_data.task_id,
         "user_id": current_user["id"],
         "latitude": location_data.latitude,
         "longitude": location_data.longitude,
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "timestamp": now.isoformat()
     }
+    location_doc["received_at"] = location_doc["timestamp"]
     
     await db.locations.insert_one(location_doc)
-    return {"message": "تم تحديث الموقع"}
+    await add_fixes_to_rollups([location_doc])
+    await geofences.evaluate(current_user["id"], location_data.latitude, location_data.longitude, now)
+    next_report_seconds, min_distance_meters = await location_report_policy(
+        current_user["id"], location_data.task_id, location_data.latitude, location_data.longitude, now
+    )
+    return {
+        "message": "تم تحديث الموقع",
+        "next_report_seconds": next_report_seconds,
+        "min_distance_meters": min_distance_meters
+    }
 
 @api_router.get("/locations/{task_id}", response_model=List[Location])
-async def get_task_locations(task_id: str, current_user: dict = Depends(get_current_user)):
-    locations = await db.locations.find({"task_id": task_id}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
+async def get_task_locations(task_id: str, format: str = "json", current_user: dict = Depends(get_current_user)):
+    locations = await read_db.locations.find({"task_id": task_id}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
+    if not locations:
+        locations = await read_db.locations_archive.find({"task_id": task_id}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
+    if format == "binary":
+        # The frame header stores the task id as a UUID
+        try:
+            uuid.UUID(task_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="معرف المهمة غير صحيح")
+        # Oldest first, as one frame of the batch upload format
+        locations.reverse()
+        return Response(content=encode_location_frame(
+            task_id,
+            [iso_to_epoch_ms(location["timestamp"]) for location in locations],
+            [location["latitude"] for location in locations],
+            [location["longitude"] for location in locations]
+        ), media_type=LOCATION_BATCH_MEDIA_TYPE)
     return locations
 
 @api_router.get("/locations/technician/{user_id}/latest")
@@ -549,6 +2594,7 @@ async def create_technician(user_data: UserCreate, current_user: dict = Depends(
     }
     
     await db.users.insert_one(user_doc)
+    await invalidate_responses("users")
     
     user_response = User(
         id=user_id,
@@ -574,6 +2620,7 @@ async def delete_technician(technician_id: str, current_user: dict = Depends(get
     
     # Don't allow deleting if technician has active tasks
     active_tasks = await db.tasks.count_documents({
+        **NOT_DELETED,
         "assigned_to": technician_id,
         "status": {"$in": ["pending", "accepted", "in_progress"]}
     })
@@ -583,6 +2630,8 @@ async def delete_technician(technician_id: str, current_user: dict = Depends(get
     
     # Delete technician
     await db.users.delete_one({"id": technician_id})
+    await revoke_tokens(technician_id, tech.get("token_version", 0) + 1)
+    await invalidate_responses("users")
     
     return {"message": "تم حذف الموظف بنجاح"}
 
@@ -592,7 +2641,11 @@ async def get_technicians(current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
     
-    technicians = await db.users.find({"role": "technician"}, {"_id": 0, "password": 0}).to_list(1000)
+    technicians = await cached_response(
+        "technicians", current_user, ["users"],
+        lambda: db.users.find({"role": "technician"}, {"_id": 0, "password": 0}).to_list(1000),
+        scope="all"
+    )
     return technicians
 
 @api_router.post("/tasks/{task_id}/rate")
@@ -611,7 +2664,7 @@ async def rate_task(
     if not rating or rating < 1 or rating > 5:
         raise HTTPException(status_code=400, detail="التقييم يجب أن يكون من 1 إلى 5")
     
-    task = await db.tasks.find_one({"id": task_id})
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id})
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
@@ -622,9 +2675,12 @@ async def rate_task(
         {"id": task_id},
         {"$set": {
             "rating": rating,
-            "rating_comment": comment
+            "rating_comment": comment,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "last_event": "task.rated"
         }}
     )
+    await invalidate_responses("tasks")
     
     return {"message": "تم إضافة التقييم بنجاح"}
 
@@ -638,9 +2694,17 @@ async def get_technician_ratings(
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
     
+    return await cached_response(
+        "ratings", current_user, ["tasks"],
+        lambda: load_technician_ratings(technician_id),
+        scope=technician_id
+    )
+
+async def load_technician_ratings(technician_id: str) -> dict:
     # Get all completed tasks with ratings
     tasks = await db.tasks.find(
         {
+            **NOT_DELETED,
             "assigned_to": technician_id,
             "status": "completed",
             "rating": {"$ne": None}
@@ -665,34 +2729,1247 @@ async def get_technician_ratings(
         "tasks": tasks
     }
 
-# Notifications Routes
-@api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications(current_user: dict = Depends(get_current_user)):
-    notifications = await db.notifications.find(
-        {"user_id": current_user["id"]}, 
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    return notifications
+# Customers
+# One document per normalized phone number; tasks reference it by customer_id
+# so a customer's visits are an index lookup instead of a scan over free text.
+async def link_customer(name: str, phone: str, address: str, task_created_at: str) -> Optional[dict]:
+    """إيجاد الزبون برقم هاتفه أو إنشاؤه؛ العدادات تُحدّث بعد حفظ المهمة"""
+    normalized = phone_digits(phone)
+    if not normalized:
+        return None
+    for attempt in range(2):
+        try:
+            return await db.customers.find_one_and_update(
+                {"phone": normalized},
+                {
+                    "$setOnInsert": {
+                        "id": str(uuid.uuid4()),
+                        "phone": normalized,
+                        "created_at": task_created_at,
+                        "task_count": 0,
+                        "completed_count": 0
+                    },
+                    # The latest visit has the most recent name and address
+                    "$set": {"name": name, "address": address}
+                },
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Two tasks for a new customer at once: the other upsert created it
+            if attempt:
+                raise
 
-@api_router.patch("/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
-    await db.notifications.update_one(
-        {"id": notification_id, "user_id": current_user["id"]},
-        {"$set": {"read": True}}
-    )
-    return {"message": "تم تحديث الإشعار"}
+async def count_customer_tasks(task_docs: list):
+    """تحديث عدادات الزبائن للمهام التي حُفظت فعلاً"""
+    counters = {}
+    for task in task_docs:
+        if task.get("customer_id"):
+            count, last_task_at = counters.get(task["customer_id"], (0, task["created_at"]))
+            counters[task["customer_id"]] = (count + 1, max(last_task_at, task["created_at"]))
+    if counters:
+        await db.customers.bulk_write([
+            UpdateOne({"id": customer_id}, {"$inc": {"task_count": count}, "$max": {"last_task_at": last_task_at}})
+            for customer_id, (count, last_task_at) in counters.items()
+        ], ordered=False)
 
-@api_router.get("/notifications/unread/count")
-async def get_unread_count(current_user: dict = Depends(get_current_user)):
-    count = await db.notifications.count_documents(
-        {"user_id": current_user["id"], "read": False}
-    )
-    return {"count": count}
+async def refresh_customer_counters(customer_id: str):
+    """إعادة حساب العدادات من المهام والأرشيف"""
+    pipeline = [
+        {"$match": {**NOT_DELETED, "customer_id": customer_id}},
+        {"$unionWith": {"coll": "tasks_archive", "pipeline": [{"$match": {"customer_id": customer_id}}]}},
+        {"$group": {
+            "_id": None,
+            "task_count": {"$sum": 1},
+            "completed_count": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}},
+            "last_task_at": {"$max": "$created_at"}
+        }}
+    ]
+    counters = await db.tasks.aggregate(pipeline).to_list(1)
+    if counters:
+        counters[0].pop("_id")
+        await db.customers.update_one({"id": customer_id}, {"$set": counters[0]})
 
-@api_router.post("/broadcast-message")
-async def broadcast_message(
-    message_data: dict,
-    current_user: dict = Depends(get_current_user)
+async def backfill_customers():
+    """ربط المهام التي أنشئت قبل وجود الزبائن بزبون؛ يعمل مرة واحدة عند التشغيل"""
+    if not await acquire_lock("startup:customers_backfill", STARTUP_LOCK_TTL_SECONDS):
+        return
+    try:
+        for collection in (db.tasks, db.tasks_archive):
+            while True:
+                tasks = await collection.find(
+                    {"customer_id": {"$exists": False}},
+                    {"_id": 0, "id": 1, "customer_name": 1, "customer_phone": 1, "customer_address": 1, "created_at": 1}
+                ).sort("created_at", 1).limit(CUSTOMER_BACKFILL_BATCH_SIZE).to_list(CUSTOMER_BACKFILL_BATCH_SIZE)
+                if not tasks:
+                    break
+                await acquire_lock("startup:customers_backfill", STARTUP_LOCK_TTL_SECONDS)
+                by_phone = {}
+                for task in tasks:
+                    by_phone.setdefault(phone_digits(task.get("customer_phone")), []).append(task)
+                # Tasks without a usable phone are marked so they are not picked up again
+                unlinked = by_phone.pop("", [])
+                if unlinked:
+                    await collection.update_many({"id": {"$in": [task["id"] for task in unlinked]}}, {"$set": {"customer_id": None}})
+                for phone, group in by_phone.items():
+                    latest = group[-1]
+                    await db.customers.update_one(
+                        {"phone": phone},
+                        {
+                            "$setOnInsert": {"id": str(uuid.uuid4()), "phone": phone, "created_at": group[0]["created_at"]},
+                            "$set": {"name": latest["customer_name"], "address": latest["customer_address"]}
+                        },
+                        upsert=True
+                    )
+                    customer = await db.customers.find_one({"phone": phone}, {"_id": 0, "id": 1})
+                    await collection.update_many(
+                        {"id": {"$in": [task["id"] for task in group]}},
+                        {"$set": {"customer_id": customer["id"]}}
+                    )
+                    # Recounted rather than incremented so a rerun after a crash stays exact
+                    await refresh_customer_counters(customer["id"])
+                await asyncio.sleep(0)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Customer backfill error: {e}")
+    finally:
+        await release_lock("startup:customers_backfill")
+
+@api_router.get("/customers/{customer_id}", response_model=Customer)
+async def get_customer(customer_id: str, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    customer = await read_db.customers.find_one({"id": customer_id}, {"_id": 0})
+    if not customer:
+        raise HTTPException(status_code=404, detail="الزبون غير موجود")
+    
+    return customer
+
+@api_router.get("/customers/{customer_id}/tasks", response_model=List[Task])
+async def get_customer_tasks(
+    customer_id: str,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """كل زيارات الزبون من المهام الحالية والأرشيف، الأحدث أولاً"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    pipeline = [
+        {"$match": {**NOT_DELETED, "customer_id": customer_id}},
+        {"$unionWith": {"coll": "tasks_archive", "pipeline": [{"$match": {"customer_id": customer_id}}]}},
+        {"$sort": {"created_at": -1}},
+        {"$skip": (page - 1) * page_size},
+        {"$limit": page_size},
+        {"$project": {"_id": 0}}
+    ]
+    return await read_db.tasks.aggregate(pipeline).to_list(page_size)
+
+# Scheduled tasks
+SCHEDULE_FREQUENCIES = ("daily", "weekly", "monthly")
+
+def to_utc(moment: datetime) -> datetime:
+    # Naive datetimes from the client are taken as UTC
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+def add_months(moment: datetime, months: int) -> datetime:
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    # The 31st falls on the last day of shorter months
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+def next_run_after(schedule: dict, after: datetime) -> Optional[str]:
+    """أول موعد بعد after؛ المواعيد تحسب من starts_at حتى لا تنزاح مع الوقت"""
+    starts_at = datetime.fromisoformat(schedule["starts_at"])
+    interval = schedule["interval"]
+    if schedule["frequency"] == "monthly":
+        step = max(0, ((after.year - starts_at.year) * 12 + after.month - starts_at.month) // interval)
+        candidate = add_months(starts_at, step * interval)
+        while candidate <= after:
+            step += 1
+            candidate = add_months(starts_at, step * interval)
+    else:
+        period = timedelta(days=interval * (7 if schedule["frequency"] == "weekly" else 1))
+        step = max(0, math.floor((after - starts_at) / period) + 1)
+        candidate = starts_at + step * period
+    if schedule.get("ends_at") and candidate > datetime.fromisoformat(schedule["ends_at"]):
+        return None
+    return candidate.isoformat()
+
+class Scheduler:
+    """يعمل على العامل القائد فقط: heap بموعد كل جدول بدلاً من فحص كل الجداول في كل دورة"""
+
+    def __init__(self):
+        # (next_run_at, schedule_id); entries are checked against the database
+        # when they come due, so stale ones left by edits are simply skipped
+        self.heap = []
+        self.loaded = False
+
+    def push(self, next_run_at: str, schedule_id: str):
+        if self.loaded:
+            heapq.heappush(self.heap, (next_run_at, schedule_id))
+            scheduler_wakeup.set()
+
+    async def load(self):
+        self.heap = [
+            (schedule["next_run_at"], schedule["id"])
+            async for schedule in db.schedules.find({"active": True}, {"_id": 0, "id": 1, "next_run_at": 1})
+        ]
+        heapq.heapify(self.heap)
+        self.loaded = True
+
+    def unload(self):
+        self.heap = []
+        self.loaded = False
+
+    async def tick(self) -> float:
+        """تشغيل الجداول المستحقة إذا كان هذا العامل القائد؛ تعيد الثواني حتى الموعد التالي"""
+        try:
+            if not await acquire_lock("leader:scheduler", SCHEDULER_MAX_SLEEP_SECONDS * 3):
+                self.unload()
+                return SCHEDULER_MAX_SLEEP_SECONDS
+            if not self.loaded:
+                await self.load()
+            await self.run_due()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Scheduler error for tenant {current_tenant.get()}: {e}")
+            # Reload from the database in case the heap lost entries mid-batch
+            self.unload()
+            return SCHEDULER_MAX_SLEEP_SECONDS
+        if not self.heap:
+            return SCHEDULER_MAX_SLEEP_SECONDS
+        due_in = (datetime.fromisoformat(self.heap[0][0]) - datetime.now(timezone.utc)).total_seconds()
+        return min(SCHEDULER_MAX_SLEEP_SECONDS, max(0.0, due_in))
+
+    async def run_due(self):
+        now = datetime.now(timezone.utc)
+        while self.heap and self.heap[0][0] <= now.isoformat():
+            batch = set()
+            while self.heap and self.heap[0][0] <= now.isoformat() and len(batch) < SCHEDULER_BATCH_SIZE:
+                next_run_at, schedule_id = heapq.heappop(self.heap)
+                batch.add((schedule_id, next_run_at))
+            await self.materialize(batch, now)
+
+    async def materialize(self, batch: set, now: datetime):
+        """إنشاء مهام دفعة من الجداول المستحقة ثم تقديم موعد كل جدول"""
+        schedules = await db.schedules.find(
+            {"id": {"$in": list({schedule_id for schedule_id, _ in batch})}, "active": True},
+            {"_id": 0}
+        ).to_list(None)
+        schedules = [schedule for schedule in schedules if (schedule["id"], schedule["next_run_at"]) in batch]
+        if not schedules:
+            return
+        
+        # One task per schedule and due time, so a batch retried after a crash creates nothing twice
+        task_ids = {
+            schedule["id"]: str(uuid.uuid5(uuid.NAMESPACE_URL, f"schedule:{schedule['id']}:{schedule['next_run_at']}"))
+            for schedule in schedules
+        }
+        existing = {task["id"] async for task in db.tasks.find({"id": {"$in": list(task_ids.values())}}, {"_id": 0, "id": 1})}
+        task_docs = [
+            await new_task_doc(TaskCreate(**schedule), schedule["created_by"], task_ids[schedule["id"]])
+            for schedule in schedules
+            if task_ids[schedule["id"]] not in existing
+        ]
+        if task_docs:
+            # Notifications follow from the task.created events like any other task
+            inserted = await insert_ignoring_duplicates(db.tasks, task_docs)
+            # Tasks another worker already created were counted by that worker
+            await count_customer_tasks(inserted)
+            await invalidate_responses("tasks")
+        
+        updates = []
+        for schedule in schedules:
+            next_run_at = next_run_after(schedule, max(now, datetime.fromisoformat(schedule["next_run_at"])))
+            updates.append(UpdateOne(
+                {"id": schedule["id"], "next_run_at": schedule["next_run_at"]},
+                {"$set": {"next_run_at": next_run_at, "last_run_at": schedule["next_run_at"], "active": next_run_at is not None},
+                 "$inc": {"runs": 1}}
+            ))
+            if next_run_at:
+                heapq.heappush(self.heap, (next_run_at, schedule["id"]))
+        await db.schedules.bulk_write(updates, ordered=False)
+        logger.info(f"Scheduler created {len(task_docs)} tasks from {len(schedules)} schedules")
+
+scheduler = TenantLocal(Scheduler)
+# Set when a schedule is added or moved on any tenant
+scheduler_wakeup = asyncio.Event()
+
+async def scheduler_worker():
+    while True:
+        # Cleared before the pass so a push made during it is not missed
+        scheduler_wakeup.clear()
+        delays = []
+
+        async def tick():
+            delays.append(await scheduler.tick())
+
+        await for_each_tenant("Scheduler", tick)
+        try:
+            await asyncio.wait_for(scheduler_wakeup.wait(), timeout=min(delays, default=SCHEDULER_MAX_SLEEP_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+
+@api_router.post("/schedules", response_model=Schedule)
+async def create_schedule(schedule_data: ScheduleCreate, current_user: dict = Depends(get_current_user)):
+    """جدولة صيانة دورية تنشئ مهمة جديدة عند كل موعد"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    if schedule_data.frequency not in SCHEDULE_FREQUENCIES:
+        raise HTTPException(status_code=400, detail="التكرار يجب أن يكون يومي أو أسبوعي أو شهري")
+    starts_at = to_utc(schedule_data.starts_at)
+    ends_at = to_utc(schedule_data.ends_at) if schedule_data.ends_at else None
+    if ends_at and ends_at < starts_at:
+        raise HTTPException(status_code=400, detail="تاريخ الانتهاء قبل تاريخ البداية")
+    
+    now = datetime.now(timezone.utc)
+    schedule_doc = {
+        "id": str(uuid.uuid4()),
+        **schedule_data.model_dump(exclude={"starts_at", "ends_at"}),
+        "starts_at": starts_at.isoformat(),
+        "ends_at": ends_at.isoformat() if ends_at else None,
+        "last_run_at": None,
+        "runs": 0,
+        "created_by": current_user["id"],
+        "created_at": now.isoformat()
+    }
+    # A start time already in the past begins with the next occurrence
+    schedule_doc["next_run_at"] = starts_at.isoformat() if starts_at >= now else next_run_after(schedule_doc, now)
+    schedule_doc["active"] = schedule_doc["next_run_at"] is not None
+    
+    await db.schedules.insert_one(schedule_doc)
+    if schedule_doc["active"]:
+        scheduler.push(schedule_doc["next_run_at"], schedule_doc["id"])
+        await publish_worker_event("scheduler.push", {"id": schedule_doc["id"], "next_run_at": schedule_doc["next_run_at"]})
+    
+    return Schedule(**schedule_doc)
+
+@api_router.get("/schedules", response_model=List[Schedule])
+async def get_schedules(
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    return await read_db.schedules.find({"active": True}, {"_id": 0}).sort("next_run_at", 1).skip(
+        (page - 1) * page_size
+    ).limit(page_size).to_list(page_size)
+
+@api_router.delete("/schedules/{schedule_id}")
+async def delete_schedule(schedule_id: str, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    # The scheduler drops the heap entry when it comes due and finds the schedule inactive
+    result = await db.schedules.update_one({"id": schedule_id, "active": True}, {"$set": {"active": False}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="الجدول غير موجود")
+    
+    return {"message": "تم إيقاف الجدول"}
+
+# Assignment engine
+def solve_assignment(cost: np.ndarray) -> np.ndarray:
+    """Hungarian algorithm (shortest augmenting paths with potentials) for a
+    rows <= columns cost matrix; returns the column chosen for each row.
+    Each augmentation is O(columns) numpy work per step, so a few hundred
+    rows by a few thousand columns solve in well under a second."""
+    rows, cols = cost.shape
+    u = np.zeros(rows + 1)
+    v = np.zeros(cols + 1)
+    # owner[j]: 1-based row matched to column j (0 = free); column 0 is a sentinel
+    owner = np.zeros(cols + 1, dtype=np.int64)
+    way = np.zeros(cols + 1, dtype=np.int64)
+    for row in range(1, rows + 1):
+        owner[0] = row
+        current = 0
+        min_reduced = np.full(cols + 1, np.inf)
+        used = np.zeros(cols + 1, dtype=bool)
+        while True:
+            used[current] = True
+            reduced = cost[owner[current] - 1] - u[owner[current]] - v[1:]
+            improved = ~used[1:] & (reduced < min_reduced[1:])
+            min_reduced[1:][improved] = reduced[improved]
+            way[1:][improved] = current
+            candidates = np.where(used[1:], np.inf, min_reduced[1:])
+            following = int(np.argmin(candidates)) + 1
+            delta = candidates[following - 1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_reduced[~used] -= delta
+            current = following
+            if owner[current] == 0:
+                break
+        # Flip the alternating path back to the root
+        while current:
+            previous = way[current]
+            owner[current] = owner[previous]
+            current = previous
+    assignment = np.full(rows, -1, dtype=np.int64)
+    matched = np.nonzero(owner[1:])[0]
+    assignment[owner[1:][matched] - 1] = matched
+    return assignment
+
+def assignment_costs(tasks: list, technicians: list) -> tuple:
+    """مصفوفة التكلفة: مهمة × (موظف، ترتيب المهمة الجديدة عنده)
+
+    Every technician gets one column per task they may still take, costed
+    at their load after taking it, so filling one technician's later slots
+    costs more than spreading the work."""
+    # Missing coordinates (None) become NaN and get the unknown distance
+    task_positions = np.array([[t.get("latitude"), t.get("longitude")] for t in tasks], dtype=float).reshape(-1, 2)
+    tech_positions = np.array([[t.get("latitude"), t.get("longitude")] for t in technicians], dtype=float).reshape(-1, 2)
+    distance = haversine_km(
+        task_positions[:, None, 0], task_positions[:, None, 1],
+        tech_positions[None, :, 0], tech_positions[None, :, 1]
+    )
+    distance = np.nan_to_num(distance, nan=ASSIGNMENT_UNKNOWN_DISTANCE_KM)
+    
+    slots = np.array([
+        min(ASSIGNMENT_MAX_ACTIVE_TASKS - tech["active"], len(tasks)) for tech in technicians
+    ]).clip(min=0)
+    column_tech = np.repeat(np.arange(len(technicians)), slots)
+    # Position of each column within its technician's slots: 0, 1, 2, ...
+    column_rank = np.arange(len(column_tech)) - np.repeat(np.cumsum(slots) - slots, slots)
+    active = np.array([tech["active"] for tech in technicians], dtype=float)
+    # Unrated technicians count as average
+    rating = np.array([tech.get("rating") or 3.0 for tech in technicians], dtype=float)
+    
+    cost = (
+        distance[:, column_tech]
+        + ASSIGNMENT_LOAD_WEIGHT * (active[column_tech] + column_rank)
+        - ASSIGNMENT_RATING_WEIGHT * rating[column_tech]
+    )
+    return cost, column_tech
+
+async def load_assignment_candidates() -> list:
+    """الموظفون مع عدد مهامهم النشطة ومتوسط تقييمهم وآخر موقع معروف"""
+    technicians = await db.users.find({"role": "technician"}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    by_id = {tech["id"]: {**tech, "active": 0} for tech in technicians}
+    
+    active = await db.tasks.aggregate([
+        {"$match": {**NOT_DELETED, "assigned_to": {"$in": list(by_id)}, "status": {"$in": ["pending", "accepted", "in_progress"]}}},
+        {"$group": {"_id": "$assigned_to", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    for row in active:
+        by_id[row["_id"]]["active"] = row["count"]
+    
+    # Ratings come from the daily rollups, which also cover archived tasks
+    ratings = await db.daily_stats.aggregate([
+        {"$match": {"technician_id": {"$in": list(by_id)}}},
+        {"$group": {"_id": "$technician_id", "sum": {"$sum": "$ratings_sum"}, "count": {"$sum": "$ratings_count"}}}
+    ]).to_list(None)
+    for row in ratings:
+        if row["count"]:
+            by_id[row["_id"]]["rating"] = row["sum"] / row["count"]
+    
+    since = (datetime.now(timezone.utc) - timedelta(hours=ASSIGNMENT_POSITION_MAX_AGE_HOURS)).isoformat()
+    positions = await db.locations.aggregate([
+        {"$match": {"user_id": {"$in": list(by_id)}, "timestamp": {"$gte": since}}},
+        {"$sort": {"user_id": 1, "timestamp": -1}},
+        {"$group": {"_id": "$user_id", "latitude": {"$first": "$latitude"}, "longitude": {"$first": "$longitude"}}}
+    ]).to_list(None)
+    for row in positions:
+        by_id[row["_id"]].update(latitude=row["latitude"], longitude=row["longitude"])
+    
+    return list(by_id.values())
+
+async def assign_pending_tasks() -> list:
+    """توزيع المهام المعلقة غير المعينة على الموظفين بأقل تكلفة إجمالية"""
+    tasks = await db.tasks.find(
+        {**NOT_DELETED, "status": "pending", "assigned_to": None},
+        {"_id": 0, "id": 1, "latitude": 1, "longitude": 1}
+    ).sort("created_at", 1).limit(ASSIGNMENT_BATCH_SIZE).to_list(ASSIGNMENT_BATCH_SIZE)
+    if not tasks:
+        return []
+    technicians = await load_assignment_candidates()
+    if not technicians:
+        return []
+    
+    cost, column_tech = assignment_costs(tasks, technicians)
+    # Oldest tasks first when there are fewer free slots than tasks
+    tasks, cost = tasks[:cost.shape[1]], cost[:cost.shape[1]]
+    if not tasks:
+        return []
+    columns = solve_assignment(cost)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    assignments = []
+    updates = []
+    for task, column in zip(tasks, columns):
+        tech = technicians[column_tech[column]]
+        assignments.append({"task_id": task["id"], "technician_id": tech["id"], "technician_name": tech["name"]})
+        # An admin may have assigned or deleted the task in the meantime
+        updates.append(UpdateOne(
+            {**NOT_DELETED, "id": task["id"], "status": "pending", "assigned_to": None},
+            {"$set": {
+                "assigned_to": tech["id"],
+                "assigned_to_name": tech["name"],
+                "updated_at": now,
+                "last_event": "task.assigned"
+            }}
+        ))
+    # The task.assigned events notify the technicians through notify_task_event
+    await db.tasks.bulk_write(updates, ordered=False)
+    await invalidate_responses("tasks")
+    logger.info(f"Assigned {len(assignments)} tasks across {len(technicians)} technicians")
+    return assignments
+
+async def assignment_worker():
+    if ASSIGNMENT_INTERVAL_SECONDS <= 0:
+        return
+    while True:
+        await asyncio.sleep(ASSIGNMENT_INTERVAL_SECONDS)
+        await for_each_tenant("Assignment worker", assign_if_leader)
+
+async def assign_if_leader():
+    if await acquire_lock("leader:assignment", ASSIGNMENT_INTERVAL_SECONDS * 2):
+        await assign_pending_tasks()
+
+@api_router.post("/assignments/run")
+async def run_assignments(current_user: dict = Depends(get_current_user)):
+    """توزيع المهام غير المعينة الآن بدل انتظار الدورة التالية"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    # Not the leader lease: that one is held and renewed by whichever worker
+    # runs the periodic pass. A manual run overlapping it is harmless, the
+    # writes only assign tasks that are still unassigned.
+    if not await acquire_lock("manual:assignment", max(ASSIGNMENT_INTERVAL_SECONDS, 60) * 2):
+        raise HTTPException(status_code=409, detail="التوزيع قيد التشغيل حالياً")
+    try:
+        assignments = await assign_pending_tasks()
+    finally:
+        await release_lock("manual:assignment")
+    return {"message": "تم توزيع المهام", "assigned": len(assignments), "assignments": assignments}
+
+# Route optimization
+ROUTE_MAX_STOPS = 200
+
+def distance_matrix(points: np.ndarray) -> np.ndarray:
+    """مصفوفة المسافات بين كل نقطتين (lat, lon) دفعة واحدة"""
+    return haversine_km(points[:, None, 0], points[:, None, 1], points[None, :, 0], points[None, :, 1])
+
+def nearest_neighbour_path(distances: np.ndarray) -> np.ndarray:
+    """مسار مفتوح يبدأ من النقطة 0 ويذهب كل مرة لأقرب نقطة لم يزرها"""
+    count = len(distances)
+    path = [0]
+    visited = np.zeros(count, dtype=bool)
+    visited[0] = True
+    for _ in range(count - 1):
+        candidates = np.where(visited, np.inf, distances[path[-1]])
+        following = int(np.argmin(candidates))
+        path.append(following)
+        visited[following] = True
+    return np.array(path)
+
+def two_opt(path: np.ndarray, distances: np.ndarray, max_passes: int = 50) -> np.ndarray:
+    """Improve an open path with a fixed start by reversing segments
+    path[i..j] while that shortens it. The gain of every j for a given i is
+    computed in one numpy expression."""
+    path = path.copy()
+    count = len(path)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, count - 1):
+            before, first = path[i - 1], path[i]
+            ends = path[i + 1:]
+            after = np.append(path[i + 2:], -1)
+            # Reversing path[i..j] swaps edges (before, first) + (end, after)
+            # for (before, end) + (first, after); the last stop has no "after"
+            has_after = after >= 0
+            after_safe = np.where(has_after, after, 0)
+            gain = (
+                distances[before, first] - distances[before, ends]
+                + np.where(has_after, distances[ends, after_safe] - distances[first, after_safe], 0.0)
+            )
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                j = i + 1 + best
+                path[i:j + 1] = path[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return path
+
+def optimize_route(points: np.ndarray) -> np.ndarray:
+    """ترتيب زيارة النقاط 1..n بدءاً من النقطة 0"""
+    distances = distance_matrix(points)
+    return two_opt(nearest_neighbour_path(distances), distances)
+
+class RouteCache:
+    """Routes keyed by the technician position and the queue (task ids and
+    sites), so any change to either computes a fresh route and the old key
+    simply ages out of the LRU."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, origin: Optional[tuple], tasks: list) -> tuple:
+        """(ترتيب المهام، طول كل مرحلة بالكيلومتر)"""
+        if not tasks:
+            return [], []
+        key = (origin, tuple((task["id"], task["latitude"], task["longitude"]) for task in tasks))
+        route = self.entries.get(key)
+        if route is not None:
+            self.entries.move_to_end(key)
+            return route
+        route = self.compute(origin, tasks)
+        self.entries[key] = route
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return route
+
+    @staticmethod
+    def compute(origin: Optional[tuple], tasks: list) -> tuple:
+        sites = [(task["latitude"], task["longitude"]) for task in tasks]
+        if origin:
+            points = np.array([origin] + sites, dtype=float)
+            path = optimize_route(points)[1:]
+            stops = path - 1
+            previous = np.concatenate(([0], path[:-1]))
+        else:
+            # No fix yet: start at the oldest task
+            points = np.array(sites, dtype=float)
+            path = optimize_route(points)
+            stops = path
+            previous = np.concatenate(([path[0]], path[:-1]))
+        legs = distance_matrix(points)[previous, path]
+        return stops.tolist(), legs.tolist()
+
+route_cache = TenantLocal(lambda: RouteCache(ROUTE_CACHE_SIZE))
+
+# Duration prediction
+class DurationModel:
+    """Log-duration averages per technician, per issue keyword and per
+    (technician, keyword). A prediction starts from the overall average and
+    moves toward each narrower group as it gathers observations, so new
+    technicians and rare issues still get a sensible estimate."""
+
+    MAX_KEYWORDS = 10
+
+    def __init__(self):
+        # key -> [count, sum of log(minutes)]
+        self.overall = [0, 0.0]
+        self.by_technician = {}
+        self.by_keyword = {}
+        self.by_pair = {}
+        # Completed tasks already counted; a resubmitted report is not counted again
+        self.seen = set()
+
+    @classmethod
+    def keywords(cls, issue_description: str) -> List[str]:
+        return list(dict.fromkeys(term for term in index_terms(issue_description) if len(term) >= 3))[:cls.MAX_KEYWORDS]
+
+    def add(self, task: dict):
+        duration = task.get("duration_minutes")
+        if not duration or duration <= 0 or not task.get("assigned_to") or task["id"] in self.seen:
+            return
+        self.seen.add(task["id"])
+        value = math.log(duration)
+        groups = [self.overall, self.by_technician.setdefault(task["assigned_to"], [0, 0.0])]
+        for keyword in self.keywords(task.get("issue_description")):
+            groups.append(self.by_keyword.setdefault(keyword, [0, 0.0]))
+            groups.append(self.by_pair.setdefault((task["assigned_to"], keyword), [0, 0.0]))
+        for group in groups:
+            group[0] += 1
+            group[1] += value
+
+    @staticmethod
+    def shrink(group: Optional[list], prior: float) -> float:
+        if not group:
+            return prior
+        return (group[1] + DURATION_PRIOR_WEIGHT * prior) / (group[0] + DURATION_PRIOR_WEIGHT)
+
+    def predict(self, technician_id: Optional[str], issue_description: str) -> Optional[int]:
+        """المدة المتوقعة بالدقائق، أو None قبل وجود أي مهمة مكتملة"""
+        if not self.overall[0]:
+            return None
+        overall = self.overall[1] / self.overall[0]
+        technician = self.shrink(self.by_technician.get(technician_id), overall)
+        estimates = [
+            self.shrink(self.by_pair.get((technician_id, keyword)), self.shrink(self.by_keyword.get(keyword), technician))
+            for keyword in self.keywords(issue_description)
+        ]
+        value = sum(estimates) / len(estimates) if estimates else technician
+        return max(1, round(math.exp(value)))
+
+duration_model = TenantLocal(DurationModel)
+# tenant -> completions seen while a retrain is running, replayed onto the new model
+duration_model_backlogs = {}
+
+async def train_duration_model():
+    """تدريب الجدول من كل المهام المكتملة ثم استبداله دفعة واحدة"""
+    tenant_id = current_tenant.get()
+    model = DurationModel()
+    backlog = duration_model_backlogs[tenant_id] = []
+    projection = {"_id": 0, "id": 1, "assigned_to": 1, "issue_description": 1, "duration_minutes": 1}
+    try:
+        for collection in (read_db.tasks, read_db.tasks_archive):
+            async for task in collection.find({"status": "completed", "duration_minutes": {"$gt": 0}}, projection):
+                model.add(task)
+                await asyncio.sleep(0)
+        for task in backlog:
+            model.add(task)
+        duration_model.replace_current(model)
+    finally:
+        duration_model_backlogs.pop(tenant_id, None)
+    logger.info(f"Duration model for {tenant_id} trained on {model.overall[0]} tasks")
+
+async def update_duration_model(event: dict):
+    if event["kind"] != "task.completed":
+        return
+    duration_model.add(event["document"])
+    backlog = duration_model_backlogs.get(current_tenant.get())
+    if backlog is not None:
+        backlog.append(event["document"])
+
+event_bus.subscribe("task.completed", update_duration_model)
+
+async def duration_model_worker():
+    # Every worker serves predictions from its own table; the first one is
+    # trained by load_tenant_state
+    while True:
+        await asyncio.sleep(DURATION_MODEL_RETRAIN_SECONDS)
+        await for_each_tenant("Duration model training", train_duration_model)
+
+@api_router.get("/tasks/{task_id}/eta")
+async def get_task_eta(task_id: str, technician_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """المدة المتوقعة للمهمة ووقت وصول الموظف؛ يمكن للمدير تجربة موظف آخر قبل التعيين"""
+    task = await read_db.tasks.find_one({**NOT_DELETED, "id": task_id}, {"_id": 0})
+    if not task:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+    if current_user["role"] != "admin":
+        if task.get("assigned_to") != current_user["id"]:
+            raise HTTPException(status_code=403, detail="هذه المهمة ليست مخصصة لك")
+        technician_id = None
+    technician_id = technician_id or task.get("assigned_to")
+    
+    now = datetime.now(timezone.utc)
+    predicted = duration_model.predict(technician_id, task["issue_description"])
+    response = {
+        "task_id": task_id,
+        "technician_id": technician_id,
+        "predicted_duration_minutes": predicted,
+        "predicted_completion_at": None,
+        "travel_minutes": None,
+        "arrival_eta": None
+    }
+    if task["status"] == "completed" or not technician_id:
+        return response
+    
+    if task["status"] == "in_progress" and task.get("started_at"):
+        if predicted:
+            started_at = datetime.fromisoformat(task["started_at"].replace('Z', '+00:00'))
+            response["predicted_completion_at"] = max(now, started_at + timedelta(minutes=predicted)).isoformat()
+        return response
+    
+    # Before arriving: finish the job in progress, then drive from the latest fix
+    busy_minutes = 0
+    current = await read_db.tasks.find_one(
+        {**NOT_DELETED, "assigned_to": technician_id, "status": "in_progress", "id": {"$ne": task_id}},
+        {"_id": 0, "issue_description": 1, "started_at": 1}
+    )
+    if current and current.get("started_at"):
+        started_at = datetime.fromisoformat(current["started_at"].replace('Z', '+00:00'))
+        expected = duration_model.predict(technician_id, current["issue_description"]) or 0
+        busy_minutes = max(0.0, expected - (now - started_at).total_seconds() / 60)
+    
+    fix = await read_db.locations.find_one({"user_id": technician_id}, {"_id": 0}, sort=[("timestamp", -1)])
+    if fix and task.get("latitude") is not None and task.get("longitude") is not None:
+        distance = float(haversine_km(fix["latitude"], fix["longitude"], task["latitude"], task["longitude"]))
+        response["travel_minutes"] = round(distance / ETA_SPEED_KMH * 60)
+        arrival = now + timedelta(minutes=busy_minutes + response["travel_minutes"])
+        response["arrival_eta"] = arrival.isoformat()
+        if predicted:
+            response["predicted_completion_at"] = (arrival + timedelta(minutes=predicted)).isoformat()
+    
+    return response
+
+# Geofences
+# Open tasks with known coordinates sit in a grid of cells about one exit
+# radius wide, so each GPS fix only looks at the few cells around it. Whether
+# a technician is inside a task's fence is shared state in geofence_presence;
+# each worker keeps a local view and only touches the database when its view
+# says the technician crossed a fence. The index also knows the status of every
+# open task, which the location reporting policy uses.
+OPEN_TASK_STATUSES = ["pending", "accepted", "in_progress"]
+
+class GeofenceIndex:
+    def __init__(self):
+        self.cell_degrees = GEOFENCE_RADIUS_METERS * GEOFENCE_EXIT_FACTOR / 111320
+        # (row, column) -> {task_id: (latitude, longitude, assigned_to)}
+        self.cells = {}
+        # Every open task, with or without coordinates: task_id -> (cell or None, updated_at, status)
+        self.tasks = {}
+        # user_id -> task ids this worker believes the technician is inside
+        self.inside = {}
+
+    def cell_of(self, latitude: float, longitude: float) -> tuple:
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def add(self, task: dict):
+        indexed = self.tasks.get(task["id"])
+        if indexed and (task.get("updated_at") or "") < (indexed[1] or ""):
+            return
+        self.remove(task["id"])
+        if task.get("deleted") or task.get("status") not in OPEN_TASK_STATUSES or not task.get("assigned_to"):
+            return
+        cell = None
+        if task.get("latitude") is not None and task.get("longitude") is not None:
+            cell = self.cell_of(task["latitude"], task["longitude"])
+            self.cells.setdefault(cell, {})[task["id"]] = (task["latitude"], task["longitude"], task["assigned_to"])
+        self.tasks[task["id"]] = (cell, task.get("updated_at"), task["status"])
+
+    def status_of(self, task_id: str) -> Optional[str]:
+        indexed = self.tasks.get(task_id)
+        return indexed[2] if indexed else None
+
+    def remove(self, task_id: str):
+        indexed = self.tasks.pop(task_id, None)
+        if not indexed or indexed[0] is None:
+            return
+        cell = self.cells.get(indexed[0])
+        if cell is not None:
+            cell.pop(task_id, None)
+            if not cell:
+                del self.cells[indexed[0]]
+
+    def nearby(self, user_id: str, latitude: float, longitude: float) -> dict:
+        """task_id -> المسافة بالمتر لمهام الموظف القريبة من الموقع"""
+        row, column = self.cell_of(latitude, longitude)
+        # A degree of longitude shrinks with latitude, so more columns cover the radius
+        span = math.ceil(1 / max(math.cos(math.radians(latitude)), 0.01))
+        distances = {}
+        for r in range(row - 1, row + 2):
+            for c in range(column - span, column + span + 1):
+                for task_id, (task_latitude, task_longitude, assigned_to) in self.cells.get((r, c), {}).items():
+                    if assigned_to == user_id:
+                        distances[task_id] = float(haversine_km(latitude, longitude, task_latitude, task_longitude)) * 1000
+        return distances
+
+    async def local_view(self, user_id: str) -> set:
+        if user_id not in self.inside:
+            self.inside[user_id] = {
+                presence["task_id"]
+                async for presence in db.geofence_presence.find({"user_id": user_id, "inside": True}, {"task_id": 1})
+            }
+        return self.inside[user_id]
+
+    async def evaluate(self, user_id: str, latitude: float, longitude: float, at: datetime):
+        """مقارنة الموقع بحدود مهام الموظف وتسجيل الوصول والمغادرة"""
+        distances = self.nearby(user_id, latitude, longitude)
+        # Loaded even for a far fix: after a refresh, or on a worker that has
+        # not seen this technician yet, the view is empty until read back
+        inside = await self.local_view(user_id)
+        if not distances and not inside:
+            return
+        for task_id in set(distances) | inside:
+            distance = distances.get(task_id, math.inf)
+            if task_id in inside and distance > GEOFENCE_RADIUS_METERS * GEOFENCE_EXIT_FACTOR:
+                inside.discard(task_id)
+                await self.cross(user_id, task_id, "departure", latitude, longitude, at)
+            elif task_id not in inside and distance <= GEOFENCE_RADIUS_METERS:
+                inside.add(task_id)
+                await self.cross(user_id, task_id, "arrival", latitude, longitude, at)
+
+    async def cross(self, user_id: str, task_id: str, kind: str, latitude: float, longitude: float, at: datetime):
+        # Only the worker whose conditional write succeeds records the crossing
+        presence_id = f"{task_id}:{user_id}"
+        presence = {"task_id": task_id, "user_id": user_id, "inside": kind == "arrival", "updated_at": at.isoformat()}
+        try:
+            if kind == "arrival":
+                result = await db.geofence_presence.update_one(
+                    {"_id": presence_id, "inside": {"$ne": True}}, {"$set": presence}, upsert=True
+                )
+                claimed = result.modified_count or result.upserted_id
+            else:
+                result = await db.geofence_presence.update_one({"_id": presence_id, "inside": True}, {"$set": presence})
+                claimed = result.modified_count
+        except DuplicateKeyError:
+            # Already inside according to another worker
+            claimed = False
+        if not claimed:
+            return
+        
+        await db.geofence_events.insert_one({
+            "id": str(uuid.uuid4()),
+            "task_id": task_id,
+            "user_id": user_id,
+            "type": kind,
+            "latitude": latitude,
+            "longitude": longitude,
+            "at": at.isoformat()
+        })
+        if kind == "departure":
+            await db.tasks.update_one({"id": task_id}, {"$set": {"departed_at": at.isoformat()}})
+            return
+        await db.tasks.update_one({"id": task_id, "arrived_at": None}, {"$set": {"arrived_at": at.isoformat()}})
+        if GEOFENCE_AUTO_START:
+            task = await db.tasks.find_one({**NOT_DELETED, "id": task_id, "status": "accepted"})
+            if task:
+                await apply_start(task, at)
+                await invalidate_responses("tasks")
+
+geofences = TenantLocal(GeofenceIndex)
+
+async def index_geofence_from_event(event: dict):
+    geofences.add(event["document"])
+
+event_bus.subscribe("task.", index_geofence_from_event)
+
+async def refresh_geofence_index():
+    open_ids = set()
+    projection = {"_id": 0, "id": 1, "status": 1, "assigned_to": 1, "latitude": 1, "longitude": 1, "updated_at": 1}
+    async for task in db.tasks.find({**NOT_DELETED, "status": {"$in": OPEN_TASK_STATUSES}}, projection):
+        geofences.add(task)
+        open_ids.add(task["id"])
+        await asyncio.sleep(0)
+    # Closed tasks whose event this worker missed, e.g. cleaned-up tombstones
+    for task_id in [task_id for task_id in geofences.tasks if task_id not in open_ids]:
+        geofences.remove(task_id)
+    # Re-read presence from the database so local views cannot drift for long
+    geofences.inside.clear()
+
+async def geofence_worker():
+    # The first load is done by load_tenant_state
+    while True:
+        await asyncio.sleep(GEOFENCE_INDEX_REFRESH_SECONDS)
+        await for_each_tenant("Geofence index refresh", refresh_geofence_index)
+
+async def geocode_address(address: str) -> Optional[tuple]:
+    """إحداثيات العنوان؛ كل عنوان يُطلب من خدمة الترميز مرة واحدة فقط"""
+    key = " ".join(search_tokens(address))
+    if not key:
+        return None
+    cached = await db.geocode_cache.find_one({"_id": key})
+    if cached:
+        return (cached["latitude"], cached["longitude"]) if cached.get("latitude") is not None else None
+    
+    params = {"q": address, "format": "json", "limit": 1}
+    if GEOCODER_COUNTRY_CODES:
+        params["countrycodes"] = GEOCODER_COUNTRY_CODES
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.get(GEOCODER_URL, params=params, headers={"User-Agent": "maintenance-dispatch/1.0"})
+    response.raise_for_status()
+    results = response.json()
+    coordinates = (float(results[0]["lat"]), float(results[0]["lon"])) if results else None
+    # Misses are cached too, so an address the geocoder cannot find is not retried
+    await db.geocode_cache.update_one(
+        {"_id": key},
+        {"$set": {
+            "latitude": coordinates[0] if coordinates else None,
+            "longitude": coordinates[1] if coordinates else None,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
+    await asyncio.sleep(GEOCODER_MIN_INTERVAL_SECONDS)
+    return coordinates
+
+async def geocode_pending_tasks() -> int:
+    tasks = await db.tasks.find(
+        {**NOT_DELETED, "status": {"$in": OPEN_TASK_STATUSES}, "latitude": None, "geocoded_at": {"$exists": False}},
+        {"_id": 0, "id": 1, "customer_address": 1}
+    ).limit(GEOCODE_BATCH_SIZE).to_list(GEOCODE_BATCH_SIZE)
+    for task in tasks:
+        coordinates = await geocode_address(task["customer_address"])
+        now = datetime.now(timezone.utc).isoformat()
+        update = {"geocoded_at": now}
+        if coordinates:
+            # Published on the bus so every worker's geofence index picks the site up
+            update.update(latitude=coordinates[0], longitude=coordinates[1], updated_at=now, last_event="task.geocoded")
+        await db.tasks.update_one({"id": task["id"], "latitude": None}, {"$set": update})
+    return len(tasks)
+
+async def geocode_worker():
+    if not GEOCODER_URL:
+        return
+    while True:
+        await asyncio.sleep(GEOCODE_INTERVAL_SECONDS)
+        await for_each_tenant("Geocoding", geocode_if_leader)
+
+async def geocode_if_leader():
+    if await acquire_lock("leader:geocoder", GEOCODE_INTERVAL_SECONDS * 2 + GEOCODE_BATCH_SIZE * 10):
+        await geocode_pending_tasks()
+
+@api_router.get("/tasks/{task_id}/geofence-events")
+async def get_geofence_events(task_id: str, current_user: dict = Depends(get_current_user)):
+    """أوقات وصول الموظف لموقع المهمة ومغادرته"""
+    if current_user["role"] != "admin":
+        task = await db.tasks.find_one({"id": task_id, "assigned_to": current_user["id"]}, {"_id": 1})
+        if not task:
+            raise HTTPException(status_code=403, detail="هذه المهمة ليست مخصصة لك")
+    
+    return await read_db.geofence_events.find({"task_id": task_id}, {"_id": 0}).sort("at", 1).to_list(1000)
+
+@api_router.get("/tasks/{task_id}/events")
+async def get_task_events(task_id: str, current_user: dict = Depends(get_current_user)):
+    """سجل تغييرات حالة المهمة بالترتيب"""
+    if current_user["role"] != "admin":
+        task = await db.tasks.find_one({"id": task_id, "assigned_to": current_user["id"]}, {"_id": 1})
+        if not task:
+            raise HTTPException(status_code=403, detail="هذه المهمة ليست مخصصة لك")
+    
+    return await read_db.task_events.find(
+        {"task_id": task_id}, {"_id": 0, "logged_at": 0}
+    ).sort("at", 1).to_list(1000)
+
+# Binary location batches
+# A batch is a sequence of frames, one per task. Each frame has a fixed header
+# with the task id and the first fix, then one small record per following fix
+# holding the differences from the fix before it:
+#
+#   header  <BB16sHqii  version, layout, task uuid, count, first time (ms),
+#                       first latitude, first longitude (1e-7 degrees)
+#   narrow  <Hhh        +time (100 ms), +latitude, +longitude (1e-6 degrees)
+#   wide    <iii        +time (ms), +latitude, +longitude (1e-7 degrees)
+#
+# The encoder uses narrow records (6 bytes per fix) whenever the fixes are in
+# time order and close enough together, and wide ones (12 bytes) otherwise.
+# The first fix is always exact; with narrow records each later fix is
+# rounded to the nearest 100 ms and 1e-6 degrees, without the rounding
+# adding up along the frame.
+LOCATION_BATCH_MEDIA_TYPE = "application/x-location-batch"
+LOCATION_FRAME_VERSION = 1
+LOCATION_FRAME_HEADER = struct.Struct("<BB16sHqii")
+LOCATION_LAYOUT_NARROW, LOCATION_LAYOUT_WIDE = 0, 1
+LOCATION_RECORDS = {
+    LOCATION_LAYOUT_NARROW: np.dtype([("time", "<u2"), ("latitude", "<i2"), ("longitude", "<i2")]),
+    LOCATION_LAYOUT_WIDE: np.dtype([("time", "<i4"), ("latitude", "<i4"), ("longitude", "<i4")]),
+}
+# Record units, as multiples of the header units (ms, 1e-7 degrees)
+LOCATION_RECORD_SCALES = {LOCATION_LAYOUT_NARROW: (100, 10), LOCATION_LAYOUT_WIDE: (1, 1)}
+
+def iso_to_epoch_ms(value: str) -> int:
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+def encode_location_frame(task_id: str, times_ms: list, latitudes: list, longitudes: list) -> bytes:
+    """ترميز مواقع مهمة واحدة في إطار ثنائي مضغوط"""
+    count = len(times_ms)
+    if count > 0xFFFF:
+        raise ValueError("Too many fixes for one frame")
+    task_bytes = uuid.UUID(task_id).bytes
+    if not count:
+        return LOCATION_FRAME_HEADER.pack(LOCATION_FRAME_VERSION, LOCATION_LAYOUT_WIDE, task_bytes, 0, 0, 0, 0)
+    
+    # Header units (ms, 1e-7 degrees); the header carries the first fix as is
+    exact = [
+        np.rint(np.asarray(times_ms, dtype=np.float64)).astype(np.int64),
+        np.rint(np.asarray(latitudes, dtype=np.float64) * 1e7).astype(np.int64),
+        np.rint(np.asarray(longitudes, dtype=np.float64) * 1e7).astype(np.int64),
+    ]
+    for layout in (LOCATION_LAYOUT_NARROW, LOCATION_LAYOUT_WIDE):
+        time_scale, degree_scale = LOCATION_RECORD_SCALES[layout]
+        records = LOCATION_RECORDS[layout]
+        # Offsets from the first fix are rounded, not each value, so the
+        # decoder's running sum lands within half a record unit of every fix
+        deltas = [
+            np.diff(np.rint((values - values[0]) / scale).astype(np.int64))
+            for values, scale in zip(exact, (time_scale, degree_scale, degree_scale))
+        ]
+        fits = all(
+            np.all((delta >= np.iinfo(records[field]).min) & (delta <= np.iinfo(records[field]).max))
+            for field, delta in zip(records.names, deltas)
+        )
+        if fits:
+            break
+    
+    body = np.empty(count - 1, dtype=records)
+    for field, delta in zip(records.names, deltas):
+        body[field] = delta
+    header = LOCATION_FRAME_HEADER.pack(
+        LOCATION_FRAME_VERSION, layout, task_bytes, count,
+        int(exact[0][0]), int(exact[1][0]), int(exact[2][0])
+    )
+    return header + body.tobytes()
+
+def decode_location_frames(payload: bytes) -> list:
+    """[(task_id, times_ms, latitudes, longitudes)] لكل إطار في الدفعة؛ ValueError إذا كانت تالفة"""
+    frames = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < LOCATION_FRAME_HEADER.size:
+            raise ValueError("Truncated frame header")
+        version, layout, task_bytes, count, time0, lat0, lon0 = LOCATION_FRAME_HEADER.unpack_from(payload, offset)
+        if version != LOCATION_FRAME_VERSION or layout not in LOCATION_RECORDS:
+            raise ValueError("Unknown frame format")
+        offset += LOCATION_FRAME_HEADER.size
+        records = LOCATION_RECORDS[layout]
+        size = max(count - 1, 0) * records.itemsize
+        if len(payload) - offset < size:
+            raise ValueError("Truncated frame body")
+        body = np.frombuffer(payload, dtype=records, count=max(count - 1, 0), offset=offset)
+        offset += size
+        if not count:
+            frames.append((str(uuid.UUID(bytes=task_bytes)), np.empty(0, np.int64), np.empty(0), np.empty(0)))
+            continue
+        time_scale, degree_scale = LOCATION_RECORD_SCALES[layout]
+        times = time0 + np.concatenate(([0], np.cumsum(body["time"], dtype=np.int64) * time_scale))
+        lats = (lat0 + np.concatenate(([0], np.cumsum(body["latitude"], dtype=np.int64) * degree_scale))) / 1e7
+        lons = (lon0 + np.concatenate(([0], np.cumsum(body["longitude"], dtype=np.int64) * degree_scale))) / 1e7
+        frames.append((str(uuid.UUID(bytes=task_bytes)), times, lats, lons))
+    return frames
+
+@api_router.post("/locations/batch")
+async def upload_location_batch(request: Request, current_user: dict = Depends(get_current_user)):
+    """رفع عدة مواقع دفعة واحدة بالصيغة الثنائية (application/x-location-batch)"""
+    if current_user["role"] != "technician":
+        raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
+    
+    payload = await request.body()
+    if len(payload) > LOCATION_BATCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="الدفعة كبيرة جداً")
+    try:
+        frames = decode_location_frames(payload)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="صيغة الدفعة غير صحيحة")
+    
+    now = datetime.now(timezone.utc)
+    latest_allowed = now + timedelta(seconds=SYNC_MAX_CLOCK_SKEW_SECONDS)
+    documents = []
+    fixes = []
+    for task_id, times, lats, lons in frames:
+        for time_ms, latitude, longitude in zip(times.tolist(), lats.tolist(), lons.tolist()):
+            at = min(datetime.fromtimestamp(time_ms / 1000, timezone.utc), latest_allowed)
+            documents.append({
+                # A retried upload maps to the same rows
+                "id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{current_user['id']}:{task_id}:{time_ms}")),
+                "task_id": task_id,
+                "user_id": current_user["id"],
+                "latitude": latitude,
+                "longitude": longitude,
+                "timestamp": at.isoformat(),
+                "received_at": now.isoformat()
+            })
+            fixes.append((at, task_id, latitude, longitude))
+    if not documents:
+        return {"message": "تم تحديث الموقع", "received": 0}
+    
+    await add_fixes_to_rollups(await insert_ignoring_duplicates(db.locations, documents))
+    fixes.sort(key=lambda fix: fix[0])
+    for at, task_id, latitude, longitude in fixes:
+        await geofences.evaluate(current_user["id"], latitude, longitude, at)
+    _, task_id, latitude, longitude = fixes[-1]
+    next_report_seconds, min_distance_meters = await location_report_policy(current_user["id"], task_id, latitude, longitude, now)
+    return {
+        "message": "تم تحديث الموقع",
+        "received": len(documents),
+        "next_report_seconds": next_report_seconds,
+        "min_distance_meters": min_distance_meters
+    }
+
+# Location reporting rate
+class IngestMeter:
+    """Fixes per second received by this worker over the last few seconds."""
+
+    WINDOW_SECONDS = 10
+
+    def __init__(self):
+        self.buckets = OrderedDict()
+
+    def record(self, now: float):
+        second = int(now)
+        self.buckets[second] = self.buckets.get(second, 0) + 1
+        while next(iter(self.buckets)) <= second - self.WINDOW_SECONDS:
+            self.buckets.popitem(last=False)
+
+    def rate(self) -> float:
+        return sum(self.buckets.values()) / self.WINDOW_SECONDS
+
+location_ingest = IngestMeter()
+# user_id -> (latitude, longitude, monotonic time, speed m/s, interval given)
+# of the last fix this worker saw
+last_fixes = OrderedDict()
+MAX_TRACKED_FIXES = 10000
+
+async def location_report_policy(user_id: str, task_id: str, latitude: float, longitude: float, now: datetime) -> tuple:
+    """(ثواني حتى الموقع التالي، أقل مسافة بالمتر تستدعي إرساله قبل ذلك)
+
+    Stationary technicians and those working on site report every minute,
+    moving ones about every LOCATION_SPACING_METERS, and the whole schedule
+    stretches when this worker takes more fixes than it is sized for."""
+    clock = time.monotonic()
+    location_ingest.record(clock)
+    
+    previous = last_fixes.pop(user_id, None)
+    # Workers take the phone's fixes in turn. Well past the interval this
+    # worker gave (a fix due on time arrives a little after it), the fix before
+    # this one most likely went to another worker and only the database has it
+    if previous is None or clock - previous[2] > previous[4] * 1.5:
+        fix = await db.locations.find_one(
+            {"user_id": user_id, "received_at": {"$lt": now.isoformat()}}, {"_id": 0}, sort=[("received_at", -1)]
+        )
+        if fix:
+            elapsed = (now - datetime.fromisoformat(fix["received_at"])).total_seconds()
+            previous = (fix["latitude"], fix["longitude"], clock - elapsed, previous[3] if previous else None)
+    speed = None
+    if previous:
+        elapsed = clock - previous[2]
+        moved = float(haversine_km(previous[0], previous[1], latitude, longitude)) * 1000
+        # Fixes a moment apart say little about speed; keep the earlier estimate
+        speed = moved / elapsed if elapsed >= 1 else previous[3]
+    if speed is None:
+        interval, min_distance = LOCATION_MOVING_MAX_SECONDS / 3, LOCATION_SPACING_METERS
+    elif speed < 1:
+        interval, min_distance = LOCATION_STATIONARY_SECONDS, LOCATION_SPACING_METERS / 2
+    else:
+        interval = min(max(LOCATION_SPACING_METERS / speed, LOCATION_MOVING_MIN_SECONDS), LOCATION_MOVING_MAX_SECONDS)
+        min_distance = LOCATION_SPACING_METERS
+    
+    status = geofences.status_of(task_id)
+    if status == "in_progress" and (speed or 0) < 3:
+        # Working on site
+        interval, min_distance = LOCATION_STATIONARY_SECONDS, LOCATION_SPACING_METERS / 2
+    elif status in ("pending", "accepted") and task_id in geofences.nearby(user_id, latitude, longitude):
+        # Within a few hundred meters of the site
+        interval = min(interval, LOCATION_APPROACH_SECONDS)
+        min_distance = min(min_distance, GEOFENCE_RADIUS_METERS / 2)
+    
+    load = max(1.0, location_ingest.rate() / LOCATION_INGEST_TARGET_PER_SECOND)
+    interval = min(interval * min(load, 4.0), LOCATION_STATIONARY_SECONDS * 2)
+    last_fixes[user_id] = (latitude, longitude, clock, speed, interval)
+    if len(last_fixes) > MAX_TRACKED_FIXES:
+        last_fixes.popitem(last=False)
+    return round(interval), round(min_distance)
+
+# Notifications Routes
+@api_router.get("/notifications", response_model=List[Notification])
+async def get_notifications(current_user: dict = Depends(get_current_user)):
+    notifications = await db.notifications.find(
+        {"user_id": current_user["id"]}, 
+        {"_id": 0}
+    ).sort("created_at", -1).to_list(100)
+    return notifications
+
+@api_router.patch("/notifications/{notification_id}/read")
+async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
+    await db.notifications.update_one(
+        {"id": notification_id, "user_id": current_user["id"]},
+        {"$set": {"read": True}}
+    )
+    return {"message": "تم تحديث الإشعار"}
+
+@api_router.get("/notifications/unread/count")
+async def get_unread_count(current_user: dict = Depends(get_current_user)):
+    count = await db.notifications.count_documents(
+        {"user_id": current_user["id"], "read": False}
+    )
+    return {"count": count}
+
+@api_router.post("/broadcast-message", dependencies=[Depends(broadcast_limiter)])
+async def broadcast_message(
+    message_data: dict,
+    current_user: dict = Depends(get_current_user)
 ):
     """إرسال رسالة جماعية للموظفين"""
     if current_user["role"] != "admin":
@@ -707,30 +3984,31 @@ async def broadcast_message(
     if not technician_ids:
         raise HTTPException(status_code=400, detail="يرجى اختيار موظف واحد على الأقل")
     
-    sent_count = 0
-    failed_count = 0
-    
-    for tech_id in technician_ids:
-        tech = await db.users.find_one({"id": tech_id, "role": "technician"}, {"_id": 0})
-        if tech and tech.get("telegram_chat_id"):
-            try:
-                formatted_message = f"""
+    formatted_message = f"""
 📢 <b>رسالة من الإدارة</b>
 
 {message_text}
 
 <i>من: {current_user['name']}</i>
                 """
-                await send_telegram_message(tech["telegram_chat_id"], formatted_message)
-                sent_count += 1
-            except:
-                failed_count += 1
+    
+    # Queued for the outbox workers, which deliver them later; technicians
+    # without an outside channel are counted as failed
+    queued_count = 0
+    failed_count = 0
+    for tech_id in technician_ids:
+        tech = await db.users.find_one({"id": tech_id, "role": "technician"}, {"_id": 0, "id": 1})
+        queued = tech and await enqueue_notification(
+            str(uuid.uuid4()), tech_id, message_text, "broadcast", text=formatted_message, in_app=False
+        )
+        if queued:
+            queued_count += 1
         else:
             failed_count += 1
     
     return {
-        "message": "تم إرسال الرسائل",
-        "sent": sent_count,
+        "message": "تمت جدولة الرسائل للإرسال",
+        "queued": queued_count,
         "failed": failed_count
     }
 
@@ -738,34 +4016,989 @@ async def broadcast_message(
 @api_router.get("/stats")
 async def get_stats(current_user: dict = Depends(get_current_user)):
     if current_user["role"] == "admin":
-        total_tasks = await db.tasks.count_documents({})
-        pending_tasks = await db.tasks.count_documents({"status": "pending"})
-        in_progress_tasks = await db.tasks.count_documents({"status": "in_progress"})
-        completed_tasks = await db.tasks.count_documents({"status": "completed"})
-        total_technicians = await db.users.count_documents({"role": "technician"})
-        
-        return {
-            "total_tasks": total_tasks,
-            "pending_tasks": pending_tasks,
-            "in_progress_tasks": in_progress_tasks,
-            "completed_tasks": completed_tasks,
-            "total_technicians": total_technicians
+        return await cached_response("stats", current_user, ["tasks", "users"], load_admin_stats, scope="all")
+    return await cached_response("stats", current_user, ["tasks"], lambda: load_technician_stats(current_user["id"]))
+
+async def load_admin_stats() -> dict:
+    # Everything in the archive is completed; its metadata count is O(1)
+    archived_tasks = await read_db.tasks_archive.estimated_document_count()
+    total_tasks = await read_db.tasks.count_documents(NOT_DELETED) + archived_tasks
+    pending_tasks = await read_db.tasks.count_documents({**NOT_DELETED, "status": "pending"})
+    in_progress_tasks = await read_db.tasks.count_documents({**NOT_DELETED, "status": "in_progress"})
+    completed_tasks = await read_db.tasks.count_documents({**NOT_DELETED, "status": "completed"}) + archived_tasks
+    total_technicians = await read_db.users.count_documents({"role": "technician"})
+    
+    return {
+        "total_tasks": total_tasks,
+        "pending_tasks": pending_tasks,
+        "in_progress_tasks": in_progress_tasks,
+        "completed_tasks": completed_tasks,
+        "total_technicians": total_technicians
+    }
+
+async def load_technician_stats(user_id: str) -> dict:
+    my_archived = await read_db.tasks_archive.count_documents({"assigned_to": user_id})
+    my_tasks = await read_db.tasks.count_documents({**NOT_DELETED, "assigned_to": user_id}) + my_archived
+    my_completed = await read_db.tasks.count_documents({**NOT_DELETED, "assigned_to": user_id, "status": "completed"}) + my_archived
+    my_pending = await read_db.tasks.count_documents({**NOT_DELETED, "assigned_to": user_id, "status": "pending"})
+    my_in_progress = await read_db.tasks.count_documents({**NOT_DELETED, "assigned_to": user_id, "status": "in_progress"})
+    
+    return {
+        "my_tasks": my_tasks,
+        "my_completed": my_completed,
+        "my_pending": my_pending,
+        "my_in_progress": my_in_progress
+    }
+
+# Reports
+REPORT_PERIOD_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m",
+}
+
+EXPORT_COLUMNS = [
+    "id", "customer_name", "customer_phone", "customer_address", "issue_description",
+    "status", "assigned_to", "assigned_to_name", "created_at", "accepted_at",
+    "started_at", "completed_at", "success", "duration_minutes", "rating",
+    "rating_comment", "report"
+]
+
+def parse_report_range(date_from: Optional[str], date_to: Optional[str]) -> dict:
+    """تحويل فترة التقرير إلى شرط على completed_at (to شامل لليوم كاملاً)"""
+    condition = {}
+    try:
+        if date_from:
+            condition["$gte"] = datetime.fromisoformat(date_from).isoformat()
+        if date_to:
+            end = datetime.fromisoformat(date_to)
+            if len(date_to) == 10:
+                end += timedelta(days=1)
+            condition["$lt"] = end.isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="صيغة التاريخ غير صحيحة")
+    return condition
+
+def build_report_match(date_from: Optional[str], date_to: Optional[str], technician_id: Optional[str]) -> dict:
+    match = {**NOT_DELETED, "status": "completed"}
+    completed_range = parse_report_range(date_from, date_to)
+    if completed_range:
+        match["completed_at"] = completed_range
+    if technician_id:
+        match["assigned_to"] = technician_id
+    return match
+
+def duration_summary(durations: list) -> dict:
+    values = np.array([d for d in durations if d is not None], dtype=float)
+    if values.size == 0:
+        return {"mean_duration": None, "p50_duration": None, "p90_duration": None, "p95_duration": None}
+    p50, p90, p95 = np.percentile(values, [50, 90, 95])
+    return {
+        "mean_duration": round(float(values.mean()), 1),
+        "p50_duration": round(float(p50), 1),
+        "p90_duration": round(float(p90), 1),
+        "p95_duration": round(float(p95), 1)
+    }
+
+@api_router.get("/reports/performance")
+async def get_performance_report(
+    period: str = "month",
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    technician_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """تقرير أداء الموظفين لكل يوم/أسبوع/شهر"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    if period not in REPORT_PERIOD_FORMATS:
+        raise HTTPException(status_code=400, detail="الفترة يجب أن تكون day أو week أو month")
+    
+    # completed_at is stored as an ISO string; parse the first 19 chars so the
+    # microsecond/offset suffix never trips $dateFromString.
+    completed_date = {
+        "$dateFromString": {
+            "dateString": {"$substrBytes": ["$completed_at", 0, 19]},
+            "format": "%Y-%m-%dT%H:%M:%S"
+        }
+    }
+    pipeline = [
+        {"$match": build_report_match(date_from, date_to, technician_id)},
+        {"$unionWith": {"coll": "tasks_archive", "pipeline": [{"$match": build_report_match(date_from, date_to, technician_id)}]}},
+        # So $last is the name on the latest task, for technicians since removed
+        {"$sort": {"completed_at": 1}},
+        {"$group": {
+            "_id": {
+                "technician_id": "$assigned_to",
+                "period": {"$dateToString": {"format": REPORT_PERIOD_FORMATS[period], "date": completed_date}}
+            },
+            "technician_name": {"$last": "$assigned_to_name"},
+            "completed": {"$sum": 1},
+            "successful": {"$sum": {"$cond": [{"$eq": ["$success", False]}, 0, 1]}},
+            "durations": {"$push": "$duration_minutes"},
+            "average_rating": {"$avg": "$rating"},
+            "total_ratings": {"$sum": {"$cond": [{"$gt": ["$rating", None]}, 1, 0]}}
+        }},
+        {"$sort": {"_id.period": 1, "_id.technician_id": 1}}
+    ]
+    
+    rows = []
+    async for group in db.tasks.aggregate(pipeline, allowDiskUse=True):
+        row = {
+            "period": group["_id"]["period"],
+            "technician_id": group["_id"]["technician_id"],
+            "technician_name": group.get("technician_name"),
+            "completed": group["completed"],
+            "successful": group["successful"],
+            "failed": group["completed"] - group["successful"],
+            "success_rate": round(group["successful"] * 100 / group["completed"], 1),
+            "average_rating": round(group["average_rating"], 1) if group.get("average_rating") is not None else None,
+            "total_ratings": group["total_ratings"]
         }
+        row.update(duration_summary(group["durations"]))
+        rows.append(row)
+    
+    # Current names; tasks keep the name the technician had when assigned
+    names = {
+        user["id"]: user["name"]
+        async for user in db.users.find(
+            {"id": {"$in": list({row["technician_id"] for row in rows})}}, {"_id": 0, "id": 1, "name": 1}
+        )
+    }
+    for row in rows:
+        row["technician_name"] = names.get(row["technician_id"], row["technician_name"])
+    
+    return {"period": period, "rows": rows}
+
+async def iter_export_chunks(match: dict):
+    chunk = []
+    # Archived tasks were completed before everything still in db.tasks, so
+    # reading the archive first keeps the export in completed_at order
+    for collection in (db.tasks_archive, db.tasks):
+        cursor = collection.find(match, {"_id": 0, "report_images": 0}).sort("completed_at", 1).batch_size(EXPORT_CHUNK_SIZE)
+        async for task in cursor:
+            chunk.append(task)
+            if len(chunk) >= EXPORT_CHUNK_SIZE:
+                yield pd.DataFrame(chunk, columns=EXPORT_COLUMNS)
+                chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=EXPORT_COLUMNS)
+
+async def stream_csv_export(match: dict):
+    # BOM so Excel detects UTF-8 and renders Arabic text correctly
+    yield "\ufeff".encode("utf-8")
+    header = True
+    async for frame in iter_export_chunks(match):
+        yield frame.to_csv(index=False, header=header).encode("utf-8")
+        header = False
+    if header:
+        yield pd.DataFrame(columns=EXPORT_COLUMNS).to_csv(index=False).encode("utf-8")
+
+async def stream_xlsx_export(match: dict):
+    # xlsxwriter's constant_memory mode flushes each row to disk as it is written,
+    # so only the current chunk is held in memory. Rows must then be written
+    # strictly in order, which pandas' to_excel (column by column) does not do.
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {
+            "constant_memory": True,
+            # Customer-entered text is data, never a formula or link
+            "strings_to_formulas": False,
+            "strings_to_urls": False
+        })
+        worksheet = workbook.add_worksheet("tasks")
+        worksheet.write_row(0, 0, EXPORT_COLUMNS)
+        row = 1
+        async for frame in iter_export_chunks(match):
+            # Native Python values, with missing ones left as empty cells
+            for values in frame.astype(object).where(frame.notna(), None).values.tolist():
+                worksheet.write_row(row, 0, values)
+                row += 1
+        workbook.close()
+        output.seek(0)
+        while True:
+            data = output.read(64 * 1024)
+            if not data:
+                break
+            yield data
+
+@api_router.get("/reports/tasks/export")
+async def export_tasks(
+    format: str = "csv",
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    technician_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """تصدير المهام المكتملة إلى CSV أو XLSX"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    if format not in ("csv", "xlsx"):
+        raise HTTPException(status_code=400, detail="صيغة التصدير يجب أن تكون csv أو xlsx")
+    
+    match = build_report_match(date_from, date_to, technician_id)
+    filename = f"tasks-{datetime.now(timezone.utc).strftime('%Y%m%d')}"
+    
+    # Held until the whole file has been streamed. The background task also
+    # runs when the client disconnects before the body is ever iterated, so
+    # the slot cannot leak; release is one-shot so the two paths don't double count.
+    release = export_limiter.hold()
+    if format == "csv":
+        return StreamingResponse(
+            export_limiter.wrap_stream(stream_csv_export(match), release),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'},
+            background=BackgroundTask(release)
+        )
+    return StreamingResponse(
+        export_limiter.wrap_stream(stream_xlsx_export(match), release),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.xlsx"'},
+        background=BackgroundTask(release)
+    )
+
+# Daily Rollups
+# Task figures are recomputed from the event bus by the leader; distance is
+# added by the request that inserted the fixes, so it is counted exactly once
+# however many workers see the location events.
+# (technician_id, "YYYY-MM-DD") pairs whose task figures must be recomputed
+pending_rollups = TenantLocal(set)
+
+def mark_rollup(technician_id: Optional[str], timestamp: Optional[str]):
+    if technician_id and timestamp:
+        pending_rollups.add((technician_id, timestamp[:10]))
+
+async def mark_rollup_from_event(event: dict):
+    document = event["document"]
+    if event["kind"] in ("task.completed", "task.rated"):
+        mark_rollup(document.get("assigned_to"), document.get("completed_at"))
+
+event_bus.subscribe("task.", mark_rollup_from_event)
+
+DAILY_STATS_LOCATION_PROJECTION = {"_id": 0, "id": 1, "latitude": 1, "longitude": 1, "timestamp": 1}
+
+def path_km(fixes: list) -> float:
+    """طول المسار بالكيلومتر للمواقع مرتبة حسب الوقت"""
+    if len(fixes) < 2:
+        return 0.0
+    lat = np.array([f["latitude"] for f in fixes])
+    lon = np.array([f["longitude"] for f in fixes])
+    return float(haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum())
+
+def day_bounds(day: str) -> tuple:
+    return f"{day}T00:00:00", (datetime.fromisoformat(day) + timedelta(days=1)).strftime("%Y-%m-%dT00:00:00")
+
+def empty_task_figures() -> dict:
+    return {
+        "tasks_completed": 0,
+        "tasks_failed": 0,
+        "total_duration_minutes": 0,
+        "ratings_count": 0,
+        "ratings_sum": 0,
+        "average_rating": None
+    }
+
+async def add_fixes_to_rollups(fixes: list):
+    """إضافة مسافة المواقع الجديدة إلى daily_stats بدون إعادة قراءة اليوم كله"""
+    by_day = {}
+    for fix in fixes:
+        by_day.setdefault((fix["user_id"], fix["timestamp"][:10]), []).append(fix)
+    
+    for (technician_id, day), new_fixes in by_day.items():
+        start, end = day_bounds(day)
+        first = min(fix["timestamp"] for fix in new_fixes)
+        last = max(fix["timestamp"] for fix in new_fixes)
+        # The path only changes between the fixes around the new ones; offline
+        # uploads can land in the middle of the day, not just at its end
+        before = await db.locations.find_one(
+            {"user_id": technician_id, "timestamp": {"$gte": start, "$lt": first}},
+            DAILY_STATS_LOCATION_PROJECTION, sort=[("timestamp", -1)]
+        )
+        after = await db.locations.find_one(
+            {"user_id": technician_id, "timestamp": {"$gt": last, "$lt": end}},
+            DAILY_STATS_LOCATION_PROJECTION, sort=[("timestamp", 1)]
+        )
+        between = await db.locations.find(
+            {"user_id": technician_id, "timestamp": {"$gte": first, "$lte": last}},
+            DAILY_STATS_LOCATION_PROJECTION
+        ).sort("timestamp", 1).to_list(None)
+        window = [fix for fix in (before, *between, after) if fix]
+        new_ids = {fix["id"] for fix in new_fixes}
+        added_km = path_km(window) - path_km([fix for fix in window if fix["id"] not in new_ids])
+        await db.daily_stats.update_one(
+            {"technician_id": technician_id, "date": day},
+            {
+                "$inc": {"distance_km": added_km, "location_fixes": len(new_fixes)},
+                "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+                "$setOnInsert": empty_task_figures()
+            },
+            upsert=True
+        )
+
+async def compute_daily_stats(technician_id: str, day: str, include_locations: bool = False) -> dict:
+    """إعادة حساب صف daily_stats لموظف في يوم محدد؛ المسافة فقط مع include_locations"""
+    start, end = day_bounds(day)
+    
+    tasks = []
+    fixes = []
+    # Old days may already be (partly) in the archive
+    for tasks_collection, locations_collection in ((db.tasks, db.locations), (db.tasks_archive, db.locations_archive)):
+        tasks += await tasks_collection.find(
+            {**NOT_DELETED, "assigned_to": technician_id, "status": "completed", "completed_at": {"$gte": start, "$lt": end}},
+            {"_id": 0, "success": 1, "duration_minutes": 1, "rating": 1}
+        ).to_list(None)
+        if include_locations:
+            fixes += await locations_collection.find(
+                {"user_id": technician_id, "timestamp": {"$gte": start, "$lt": end}},
+                DAILY_STATS_LOCATION_PROJECTION
+            ).to_list(None)
+    
+    ratings = [t["rating"] for t in tasks if t.get("rating") is not None]
+    failed = sum(1 for t in tasks if t.get("success") is False)
+    row = {
+        "technician_id": technician_id,
+        "date": day,
+        "tasks_completed": len(tasks) - failed,
+        "tasks_failed": failed,
+        "total_duration_minutes": sum(t.get("duration_minutes") or 0 for t in tasks),
+        "ratings_count": len(ratings),
+        "ratings_sum": sum(ratings),
+        "average_rating": round(sum(ratings) / len(ratings), 1) if ratings else None,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    update = {"$set": row}
+    if include_locations:
+        fixes.sort(key=lambda fix: fix["timestamp"])
+        row["distance_km"] = round(path_km(fixes), 3)
+        row["location_fixes"] = len(fixes)
     else:
-        my_tasks = await db.tasks.count_documents({"assigned_to": current_user["id"]})
-        my_completed = await db.tasks.count_documents({"assigned_to": current_user["id"], "status": "completed"})
-        my_pending = await db.tasks.count_documents({"assigned_to": current_user["id"], "status": "pending"})
-        my_in_progress = await db.tasks.count_documents({"assigned_to": current_user["id"], "status": "in_progress"})
+        update["$setOnInsert"] = {"distance_km": 0.0, "location_fixes": 0}
+    await db.daily_stats.update_one(
+        {"technician_id": technician_id, "date": day},
+        update,
+        upsert=True
+    )
+    return row
+
+async def process_pending_rollups():
+    while pending_rollups:
+        technician_id, day = pending_rollups.pop()
+        try:
+            await compute_daily_stats(technician_id, day)
+        except Exception as e:
+            logger.error(f"Rollup failed for {technician_id} on {day}: {e}")
+
+async def rollup_worker():
+    """تحديث daily_stats دورياً للموظفين الذين تغيرت بياناتهم"""
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+        await for_each_tenant("Rollup worker", roll_up_if_leader)
+
+async def roll_up_if_leader():
+    # Every worker sees every event on the bus, so only the leader
+    # recomputes; the others just drop their marks.
+    if await acquire_lock("leader:rollups", ROLLUP_INTERVAL_SECONDS * 3):
+        await process_pending_rollups()
+    else:
+        pending_rollups.clear()
+
+@api_router.get("/stats/daily")
+async def get_daily_stats(
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    technician_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """الإحصائيات اليومية المحسوبة مسبقاً لكل موظف"""
+    query = {}
+    if current_user["role"] != "admin":
+        query["technician_id"] = current_user["id"]
+    elif technician_id:
+        query["technician_id"] = technician_id
+    
+    date_range = {}
+    if date_from:
+        date_range["$gte"] = date_from[:10]
+    if date_to:
+        date_range["$lte"] = date_to[:10]
+    if date_range:
+        query["date"] = date_range
+    
+    rows = await db.daily_stats.find(query, {"_id": 0}).sort([("date", 1), ("technician_id", 1)]).to_list(5000)
+    for row in rows:
+        # Summed with $inc fix by fix, so stored unrounded
+        row["distance_km"] = round(row.get("distance_km") or 0.0, 3)
+    return rows
+
+@api_router.post("/stats/daily/rebuild")
+async def rebuild_daily_stats(
+    date_from: str = Query(..., alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    current_user: dict = Depends(get_current_user)
+):
+    """إعادة بناء الإحصائيات اليومية لفترة سابقة"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    match = build_report_match(date_from, date_to, None)
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": {"technician_id": "$assigned_to", "day": {"$substrBytes": ["$completed_at", 0, 10]}}}}
+    ]
+    location_match = {"timestamp": match.get("completed_at", {})}
+    location_pipeline = [
+        {"$match": location_match if location_match["timestamp"] else {}},
+        {"$group": {"_id": {"technician_id": "$user_id", "day": {"$substrBytes": ["$timestamp", 0, 10]}}}}
+    ]
+    keys = set()
+    for collection, groups in (
+        (db.tasks, pipeline),
+        (db.tasks_archive, pipeline),
+        (db.locations, location_pipeline),
+        (db.locations_archive, location_pipeline),
+    ):
+        async for group in collection.aggregate(groups, allowDiskUse=True):
+            # Tasks never assigned have no technician row
+            if group["_id"]["technician_id"]:
+                keys.add((group["_id"]["technician_id"], group["_id"]["day"]))
+    # Computed right here rather than through pending_rollups, which only the
+    # leader worker drains
+    background_tasks.append(asyncio.create_task(rebuild_rollups(keys)))
+    
+    return {"message": "تمت جدولة إعادة البناء", "queued": len(keys)}
+
+async def rebuild_rollups(keys: set):
+    for technician_id, day in sorted(keys, key=lambda key: key[1]):
+        try:
+            await compute_daily_stats(technician_id, day, include_locations=True)
+        except Exception as e:
+            logger.error(f"Rollup rebuild failed for {technician_id} on {day}: {e}")
+
+# Metrics
+@api_router.get("/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    """مؤشرات تشغيل هذا العامل"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    return {
+        "worker_id": WORKER_ID,
+        "mongo_pool": pool_metrics.snapshot(),
+        "event_bus": {"mode": event_bus.mode},
+        "response_cache": response_cache.stats(),
+        "rate_limiter": {
+            "tracked_clients": len(rate_limiter.buckets),
+            "rejected": rate_limiter.rejected
+        },
+        "concurrency": {
+            limiter.name: {"in_flight": limiter.in_flight, "limit": limiter.limit, "shed": limiter.shed}
+            for limiter in concurrency_limiters
+        }
+    }
+
+# Archive
+async def find_task_with_archive(task_id: str) -> Optional[dict]:
+    task = await db.tasks.find_one({**NOT_DELETED, "id": task_id}, {"_id": 0})
+    if not task:
+        task = await db.tasks_archive.find_one({"id": task_id}, {"_id": 0})
+    return task
+
+async def copy_to_archive(source, target, query: dict):
+    """نسخ دفعات إلى مجموعة الأرشيف؛ النسخ المكررة من محاولة سابقة تُتجاهل"""
+    batch = []
+    async for document in source.find(query, {"_id": 0}).batch_size(ARCHIVE_BATCH_SIZE * 10):
+        batch.append(document)
+        if len(batch) >= ARCHIVE_BATCH_SIZE * 10:
+            await insert_ignoring_duplicates(target, batch)
+            batch = []
+    if batch:
+        await insert_ignoring_duplicates(target, batch)
+
+async def insert_ignoring_duplicates(collection, documents: list) -> list:
+    """إدراج المستندات مع تجاهل المكررة، ويعيد ما أُدرج فعلاً"""
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [document for index, document in enumerate(documents) if index not in duplicates]
+    return documents
+
+async def archive_completed_tasks(older_than_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """نقل المهام المكتملة القديمة مع مواقعها وإشعاراتها إلى الأرشيف"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).isoformat()
+    archived = 0
+    while True:
+        tasks = await db.tasks.find(
+            {**NOT_DELETED, "status": "completed", "completed_at": {"$lt": cutoff}},
+            {"_id": 0}
+        ).sort("completed_at", 1).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not tasks:
+            break
+        task_ids = [task["id"] for task in tasks]
+        archived_at = datetime.now(timezone.utc).isoformat()
         
+        # Copy everything before deleting anything so an interrupted pass is
+        # simply repeated on the next run
+        await copy_to_archive(db.locations, db.locations_archive, {"task_id": {"$in": task_ids}})
+        await copy_to_archive(db.notifications, db.notifications_archive, {"task_id": {"$in": task_ids}})
+        await insert_ignoring_duplicates(db.tasks_archive, [{**task, "archived_at": archived_at} for task in tasks])
+        
+        await db.tasks.delete_many({"id": {"$in": task_ids}})
+        await db.locations.delete_many({"task_id": {"$in": task_ids}})
+        await db.notifications.delete_many({"task_id": {"$in": task_ids}})
+        archived += len(task_ids)
+    
+    if archived:
+        await invalidate_responses("tasks")
+        logger.info(f"Archived {archived} completed tasks older than {older_than_days} days")
+    return archived
+
+async def archive_worker():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+        await for_each_tenant("Archive worker", archive_if_leader)
+
+async def archive_if_leader():
+    if await acquire_lock("leader:archiver", ARCHIVE_INTERVAL_SECONDS * 2):
+        await archive_completed_tasks()
+
+@api_router.post("/archive/run")
+async def run_archive(current_user: dict = Depends(get_current_user)):
+    """تشغيل الأرشفة الآن بدل انتظار الدورة التالية"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    # Not the leader lease, which the periodic archiver keeps renewed; an
+    # overlapping pass only repeats copies that are ignored as duplicates
+    if not await acquire_lock("manual:archiver", ARCHIVE_INTERVAL_SECONDS * 2):
+        raise HTTPException(status_code=409, detail="الأرشفة قيد التشغيل حالياً")
+    try:
+        archived = await archive_completed_tasks()
+    finally:
+        await release_lock("manual:archiver")
+    return {"message": "تمت الأرشفة", "archived": archived}
+
+# Task deletion
+deletion_wakeup = asyncio.Event()
+
+def wake_deletion_cleanup():
+    deletion_wakeup.set()
+
+async def delete_in_batches(collection, query: dict) -> int:
+    """حذف على دفعات صغيرة حتى لا تحجز عملية واحدة طويلة قاعدة البيانات"""
+    deleted = 0
+    while True:
+        batch = await collection.find(query, {"_id": 1}).limit(DELETE_BATCH_SIZE).to_list(DELETE_BATCH_SIZE)
+        if not batch:
+            return deleted
+        result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        deleted += result.deleted_count
+        await asyncio.sleep(0)
+
+async def claim_deleted_task() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.tasks.find_one_and_update(
+        {"deleted": True, "$or": [
+            {"cleanup_lease": {"$exists": False}},
+            {"cleanup_lease": {"$lt": now}}
+        ]},
+        {"$set": {"cleanup_owner": WORKER_ID, "cleanup_lease": now + timedelta(seconds=DELETE_CLEANUP_LEASE_SECONDS)}},
+        projection={"_id": 0, "id": 1, "status": 1, "customer_id": 1, "assigned_to": 1, "deleted_at": 1}
+    )
+
+async def cleanup_deleted_tasks() -> int:
+    """إزالة المهام المحذوفة مع مواقعها وإشعاراتها؛ يمكن لأي عامل تنفيذها"""
+    cleaned = 0
+    while True:
+        task = await claim_deleted_task()
+        if not task:
+            return cleaned
+        await delete_in_batches(db.locations, {"task_id": task["id"]})
+        await delete_in_batches(db.notifications, {"task_id": task["id"]})
+        if task.get("assigned_to"):
+            # Offline phones still need to hear about the deletion after the tombstone is gone
+            await db.sync_deletions.update_one(
+                {"task_id": task["id"]},
+                {"$setOnInsert": {
+                    "assigned_to": task["assigned_to"],
+                    "deleted_at": task.get("deleted_at") or datetime.now(timezone.utc).isoformat(),
+                    "created_at": datetime.now(timezone.utc)
+                }},
+                upsert=True
+            )
+        result = await db.tasks.delete_one({"id": task["id"], "deleted": True})
+        if result.deleted_count and task.get("customer_id"):
+            await db.customers.update_one(
+                {"id": task["customer_id"]},
+                {"$inc": {"task_count": -1, "completed_count": -1 if task.get("status") == "completed" else 0}}
+            )
+        cleaned += 1
+
+async def deletion_cleanup_worker():
+    while True:
+        try:
+            await asyncio.wait_for(deletion_wakeup.wait(), timeout=DELETE_CLEANUP_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        deletion_wakeup.clear()
+        await for_each_tenant("Deletion cleanup", cleanup_deleted_tasks)
+
+@api_router.post("/tasks/bulk-delete")
+async def bulk_delete_tasks(delete_data: BulkDeleteRequest, current_user: dict = Depends(get_current_user)):
+    """حذف عدة مهام دفعة واحدة مع متابعة التقدم"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    if not delete_data.task_ids:
+        raise HTTPException(status_code=400, detail="يرجى اختيار مهمة واحدة على الأقل")
+    
+    deleted_at = datetime.now(timezone.utc).isoformat()
+    result = await db.tasks.update_many(
+        {**NOT_DELETED, "id": {"$in": delete_data.task_ids}},
+        {"$set": {
+            "deleted": True,
+            "deleted_at": deleted_at,
+            "updated_at": deleted_at,
+            "last_event": "task.deleted"
+        }}
+    )
+    
+    job_id = str(uuid.uuid4())
+    await db.deletion_jobs.insert_one({
+        "id": job_id,
+        "task_ids": delete_data.task_ids,
+        "total": result.modified_count,
+        "created_by": current_user["id"],
+        "created_at": deleted_at
+    })
+    wake_deletion_cleanup()
+    await invalidate_responses("tasks")
+    
+    return {"message": "تم حذف المهام", "job_id": job_id, "deleted": result.modified_count}
+
+@api_router.get("/tasks/deletion-jobs/{job_id}")
+async def get_deletion_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """تقدم تنظيف المهام المحذوفة"""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="الصلاحية للمدير فقط")
+    
+    job = await db.deletion_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="العملية غير موجودة")
+    
+    # Tombstones disappear as the cleanup finishes each task
+    remaining = await db.tasks.count_documents({"id": {"$in": job["task_ids"]}, "deleted": True})
+    return {
+        "id": job["id"],
+        "total": job["total"],
+        "cleaned": max(0, job["total"] - remaining),
+        "remaining": remaining,
+        "done": remaining == 0,
+        "created_at": job["created_at"]
+    }
+
+# Idempotency keys
+async def claim_idempotency_key(key_id: str, request_hash: str):
+    """يرجع None إذا حُجز المفتاح لهذا الطلب، أو السجل المحفوظ سابقاً"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": key_id,
+            "status": "in_progress",
+            "request_hash": request_hash,
+            "created_at": now,
+            "locked_at": now
+        })
+        return None
+    except DuplicateKeyError:
+        pass
+    
+    record = await db.idempotency_keys.find_one({"_id": key_id})
+    if record and record["status"] == "in_progress" and record["request_hash"] == request_hash:
+        # Take over a key abandoned by a request that never finished
+        taken = await db.idempotency_keys.update_one(
+            {"_id": key_id, "status": "in_progress", "locked_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}},
+            {"$set": {"locked_at": now}}
+        )
+        if taken.modified_count:
+            return None
+    return record or await claim_idempotency_key(key_id, request_hash)
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    """إعادة الرد الأصلي لطلبات POST/PATCH المكررة بنفس Idempotency-Key"""
+    idempotency_key = request.headers.get("idempotency-key")
+    if not idempotency_key or request.method not in ("POST", "PATCH") or not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    
+    body = await request.body()
+    scope = f"{rate_limit_client_key(request)}|{request.method}|{request.url.path}|{idempotency_key}"
+    key_id = hashlib.sha256(scope.encode("utf-8")).hexdigest()
+    request_hash = hashlib.sha256(body).hexdigest()
+    
+    record = await claim_idempotency_key(key_id, request_hash)
+    if record:
+        if record["request_hash"] != request_hash:
+            return Response(
+                content='{"detail":"مفتاح Idempotency-Key مستخدم لطلب مختلف"}',
+                status_code=422,
+                media_type="application/json"
+            )
+        if record["status"] != "completed":
+            return Response(
+                content='{"detail":"الطلب قيد المعالجة"}',
+                status_code=409,
+                media_type="application/json",
+                headers={"Retry-After": "1"}
+            )
+        return Response(
+            content=record["response_body"],
+            status_code=record["response_status"],
+            media_type=record.get("media_type"),
+            headers={"Idempotent-Replayed": "true"}
+        )
+    
+    try:
+        response = await call_next(request)
+        response_body = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await db.idempotency_keys.delete_one({"_id": key_id})
+        raise
+    
+    if 200 <= response.status_code < 300:
+        await db.idempotency_keys.update_one(
+            {"_id": key_id},
+            {"$set": {
+                "status": "completed",
+                "response_status": response.status_code,
+                "response_body": response_body,
+                "media_type": response.media_type or response.headers.get("content-type")
+            }}
+        )
+    else:
+        # Only successes are replayed; a failed attempt may be retried as new
+        await db.idempotency_keys.delete_one({"_id": key_id})
+    
+    return Response(
+        content=response_body,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type
+    )
+
+# Registered after the idempotency middleware so it runs before it: every
+# database access, the idempotency keys included, happens in the right tenant
+@app.middleware("http")
+async def tenant_middleware(request: Request, call_next):
+    tenant_id = request_tenant(request)
+    if tenant_id not in tenants:
+        return Response(
+            content='{"detail":"المتجر غير موجود"}',
+            status_code=404,
+            media_type="application/json"
+        )
+    with tenant_scope(tenant_id):
+        return await call_next(request)
+
+# Offline sync
+class SyncOperation(BaseModel):
+    op_id: str
+    type: str  # location, accept, start, complete
+    task_id: str
+    device_timestamp: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    report_text: Optional[str] = None
+    images: Optional[List[str]] = None
+    success: Optional[bool] = True
+
+class SyncRequest(BaseModel):
+    sync_token: Optional[str] = None
+    operations: List[SyncOperation] = []
+
+SYNC_TASK_PROJECTION = {"_id": 0, "cleanup_owner": 0, "cleanup_lease": 0}
+
+def parse_device_timestamp(value: Optional[str], now: datetime) -> datetime:
+    if not value:
+        return now
+    try:
+        at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return now
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    if at > now + timedelta(seconds=SYNC_MAX_CLOCK_SKEW_SECONDS):
+        return now
+    return at
+
+def parse_sync_token(token: Optional[str], now: datetime) -> Optional[str]:
+    """بداية الفرق المطلوب، أو None إذا لزمت مزامنة كاملة"""
+    if not token:
+        return None
+    try:
+        issued_at = datetime.fromisoformat(token.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if issued_at.tzinfo is None:
+        issued_at = issued_at.replace(tzinfo=timezone.utc)
+    # Older than the deletion feed: deletions since then may be forgotten
+    if issued_at < now - timedelta(seconds=SYNC_RETENTION_SECONDS):
+        return None
+    return (issued_at - timedelta(seconds=SYNC_TOKEN_OVERLAP_SECONDS)).isoformat()
+
+# Status each task operation moves the task to, in lifecycle order
+SYNC_OPERATION_STATUS = {"accept": "accepted", "start": "in_progress", "complete": "completed"}
+TASK_STATUS_RANK = {"pending": 0, "accepted": 1, "in_progress": 2, "completed": 3}
+
+def sync_location_doc(operation: SyncOperation, current_user: dict, now: datetime) -> dict:
+    return {
+        # Same op always maps to the same row, so a replay cannot duplicate it
+        "id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{current_user['id']}:{operation.op_id}")),
+        "task_id": operation.task_id,
+        "user_id": current_user["id"],
+        "latitude": operation.latitude,
+        "longitude": operation.longitude,
+        "timestamp": parse_device_timestamp(operation.device_timestamp, now).isoformat(),
+        "received_at": now.isoformat()
+    }
+
+async def apply_sync_operation(operation: SyncOperation, current_user: dict, now: datetime, inserted_locations: set) -> dict:
+    at = parse_device_timestamp(operation.device_timestamp, now)
+    
+    if operation.type == "location":
+        if operation.latitude is None or operation.longitude is None:
+            return {"status": "error", "detail": "الموقع غير مكتمل"}
+        # Written by sync() in one batch; a replayed fix was not inserted again
+        if sync_location_doc(operation, current_user, now)["id"] in inserted_locations:
+            await geofences.evaluate(current_user["id"], operation.latitude, operation.longitude, at)
+        return {"status": "ok"}
+    
+    if operation.type not in SYNC_OPERATION_STATUS:
+        return {"status": "error", "detail": "نوع العملية غير معروف"}
+    task = await db.tasks.find_one({**NOT_DELETED, "id": operation.task_id})
+    if not task:
+        return {"status": "error", "detail": "المهمة غير موجودة"}
+    if task["assigned_to"] != current_user["id"]:
+        return {"status": "error", "detail": "هذه المهمة ليست مخصصة لك"}
+    # Like a stale Telegram button: an operation queued offline must not move
+    # the task backwards or repeat a step already made from another device
+    if TASK_STATUS_RANK[SYNC_OPERATION_STATUS[operation.type]] <= TASK_STATUS_RANK.get(task["status"], 0):
         return {
-            "my_tasks": my_tasks,
-            "my_completed": my_completed,
-            "my_pending": my_pending,
-            "my_in_progress": my_in_progress
+            "status": "conflict",
+            "detail": "تغيرت حالة المهمة ولا يمكن تطبيق هذه العملية",
+            "task_status": task["status"]
         }
+    
+    if operation.type == "accept":
+        await apply_accept(task, current_user, at)
+        return {"status": "ok"}
+    if operation.type == "start":
+        await apply_start(task, at)
+        return {"status": "ok"}
+    if operation.type == "complete":
+        if not operation.report_text:
+            return {"status": "error", "detail": "يرجى كتابة التقرير"}
+        duration_minutes = await apply_complete(task, current_user, operation.report_text, operation.images, operation.success, at)
+        return {"status": "ok", "duration_minutes": duration_minutes}
+
+@api_router.post("/sync")
+async def sync(sync_data: SyncRequest, current_user: dict = Depends(get_current_user)):
+    """مزامنة الموظف: رفع العمليات المخزنة بدون اتصال واستلام التغييرات منذ آخر مزامنة"""
+    if current_user["role"] != "technician":
+        raise HTTPException(status_code=403, detail="الصلاحية للموظف فقط")
+    
+    if len(sync_data.operations) > SYNC_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"الحد الأقصى {SYNC_MAX_OPERATIONS} عملية في المزامنة الواحدة")
+    
+    now = datetime.now(timezone.utc)
+    
+    # Operations already applied by an earlier (interrupted) sync are skipped
+    op_keys = [f"{current_user['id']}:{operation.op_id}" for operation in sync_data.operations]
+    done = {
+        record["_id"]: record["result"]
+        async for record in db.sync_ops.find({"_id": {"$in": op_keys}})
+    }
+    
+    # New fixes are written in one batch; geofences still see them in order below
+    new_locations = [
+        sync_location_doc(operation, current_user, now)
+        for operation, op_key in zip(sync_data.operations, op_keys)
+        if operation.type == "location" and op_key not in done
+        and operation.latitude is not None and operation.longitude is not None
+    ]
+    inserted_locations = set()
+    if new_locations:
+        inserted = await insert_ignoring_duplicates(db.locations, new_locations)
+        await add_fixes_to_rollups(inserted)
+        inserted_locations = {location["id"] for location in inserted}
+    
+    results = []
+    new_records = []
+    for operation, op_key in zip(sync_data.operations, op_keys):
+        if op_key in done:
+            results.append({"op_id": operation.op_id, **done[op_key]})
+            continue
+        result = await apply_sync_operation(operation, current_user, now, inserted_locations)
+        results.append({"op_id": operation.op_id, **result})
+        if result["status"] == "ok":
+            done[op_key] = result
+            new_records.append({"_id": op_key, "result": result, "created_at": now})
+    
+    if new_records:
+        await insert_ignoring_duplicates(db.sync_ops, new_records)
+    if any(operation.type != "location" for operation in sync_data.operations):
+        await invalidate_responses("tasks")
+    
+    # Server delta. The token is taken after applying this batch (whose
+    # outcome is already in results) but before reading. Writes stamp
+    # updated_at before they commit, so the delta reaches back an overlap
+    # window past the token; the client applies tasks by id, so repeats are harmless.
+    sync_token = datetime.now(timezone.utc).isoformat()
+    since = parse_sync_token(sync_data.sync_token, now)
+    deleted_task_ids = []
+    if since:
+        tasks = await db.tasks.find(
+            {"assigned_to": current_user["id"], "updated_at": {"$gt": since}},
+            SYNC_TASK_PROJECTION
+        ).sort("updated_at", 1).to_list(1000)
+        notifications = await db.notifications.find(
+            {"user_id": current_user["id"], "created_at": {"$gt": since}},
+            {"_id": 0}
+        ).sort("created_at", 1).to_list(1000)
+        # Tombstones already removed by the cleanup worker
+        deleted_task_ids = [
+            deletion["task_id"]
+            async for deletion in db.sync_deletions.find(
+                {"assigned_to": current_user["id"], "deleted_at": {"$gt": since}},
+                {"_id": 0, "task_id": 1}
+            )
+        ]
+    else:
+        tasks = await db.tasks.find(
+            {**NOT_DELETED, "assigned_to": current_user["id"]},
+            SYNC_TASK_PROJECTION
+        ).sort("created_at", -1).to_list(1000)
+        notifications = await db.notifications.find(
+            {"user_id": current_user["id"]},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(100)
+    
+    return {
+        "results": results,
+        "tasks": tasks,
+        "notifications": notifications,
+        "deleted_task_ids": deleted_task_ids,
+        # Full snapshot: the client should replace its task list, not merge into it
+        "reset": since is None,
+        "sync_token": sync_token
+    }
 
 # Include the router in the main app
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(enforce_rate_limit)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -784,4 +5017,9 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Events still buffered would otherwise be lost with the process
+    await for_each_tenant("Task event log flush", flush_task_event_log)
     client.close()
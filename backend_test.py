@@ -7,8 +7,40 @@ Tests all endpoints with Arabic error messages and role-based permissions
 import requests
 import json
 import sys
+import csv
+import io
+import re
+import zipfile
+import xml.etree.ElementTree as ET
 from datetime import datetime
 
+XLSX_NS = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+def read_xlsx_rows(content, width):
+    """Rows of the first sheet as strings, the way the CSV export writes them"""
+    archive = zipfile.ZipFile(io.BytesIO(content))
+    shared = []
+    if 'xl/sharedStrings.xml' in archive.namelist():
+        root = ET.fromstring(archive.read('xl/sharedStrings.xml'))
+        shared = [''.join(t.text or '' for t in si.iter(f"{{{XLSX_NS['s']}}}t")) for si in root.findall('s:si', XLSX_NS)]
+    sheet = ET.fromstring(archive.read('xl/worksheets/sheet1.xml'))
+    rows = []
+    for row in sheet.iter(f"{{{XLSX_NS['s']}}}row"):
+        values = [''] * width
+        for cell in row.findall('s:c', XLSX_NS):
+            column = 0
+            for letter in re.match(r'[A-Z]+', cell.get('r')).group():
+                column = column * 26 + ord(letter) - 64
+            kind = cell.get('t')
+            if kind == 'inlineStr':
+                value = ''.join(t.text or '' for t in cell.iter(f"{{{XLSX_NS['s']}}}t"))
+            else:
+                raw = cell.findtext('s:v', '', XLSX_NS)
+                value = shared[int(raw)] if kind == 's' else ('True' if raw == '1' else 'False') if kind == 'b' else raw
+            values[column - 1] = value
+        rows.append(values)
+    return rows
+
 class MaintenanceAPITester:
     def __init__(self, base_url="https://tech-dispatch-37.preview.emergentagent.com"):
         self.base_url = base_url
@@ -17,6 +49,7 @@ class MaintenanceAPITester:
         self.admin_user = None
         self.tech_user = None
         self.test_task_id = None
+        self.test_customer_id = None
         self.tests_run = 0
         self.tests_passed = 0
         
@@ -54,6 +87,8 @@ class MaintenanceAPITester:
                 response = requests.post(url, json=data, headers=headers, timeout=10)
             elif method == 'PATCH':
                 response = requests.patch(url, json=data, headers=headers, timeout=10)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=headers, timeout=10)
             else:
                 return False, f"Unsupported method: {method}"
                 
@@ -149,6 +184,7 @@ class MaintenanceAPITester:
         
         if success and isinstance(response, dict) and 'id' in response:
             self.test_task_id = response['id']
+            self.test_customer_id = response.get('customer_id')
             self.log_test("Create Task", True)
             print(f"   Task ID: {self.test_task_id}")
             print(f"   Status: {response['status']}")
@@ -461,6 +497,317 @@ class MaintenanceAPITester:
         else:
             self.log_test("Technician Access Restriction", False, "Technician should not access admin endpoints")
 
+    def test_performance_report(self):
+        """Test monthly technician performance report (admin only)"""
+        print("\n📈 Testing Performance Report...")
+        success, response = self.make_request(
+            'GET', 'reports/performance?period=month', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, dict) and 'rows' in response:
+            self.log_test("Performance Report", True)
+            print(f"   Report rows: {len(response['rows'])}")
+            return True
+        else:
+            self.log_test("Performance Report", False, str(response))
+            return False
+
+    def test_export_tasks_csv(self):
+        """Test streaming CSV export of completed tasks"""
+        print("\n📄 Testing Tasks CSV Export...")
+        success, response = self.make_request(
+            'GET', 'reports/tasks/export?format=csv', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, str) and 'customer_name' in response:
+            self.log_test("Tasks CSV Export", True)
+            return True
+        else:
+            self.log_test("Tasks CSV Export", False, str(response)[:200])
+            return False
+
+    def test_export_tasks_xlsx(self):
+        """Test that the XLSX export holds exactly the cells of the CSV export"""
+        print("\n📊 Testing Tasks XLSX Export...")
+        headers = {'Authorization': f'Bearer {self.admin_token}'}
+        try:
+            csv_response = requests.get(f"{self.base_url}/api/reports/tasks/export", params={'format': 'csv'}, headers=headers, timeout=60)
+            xlsx_response = requests.get(f"{self.base_url}/api/reports/tasks/export", params={'format': 'xlsx'}, headers=headers, timeout=60)
+            expected = list(csv.reader(io.StringIO(csv_response.content.decode('utf-8-sig'))))
+            actual = read_xlsx_rows(xlsx_response.content, len(expected[0]))
+        except Exception as e:
+            self.log_test("Tasks XLSX Export", False, f"Request error: {str(e)}")
+            return False
+        
+        def same(csv_value, xlsx_value):
+            if csv_value == xlsx_value:
+                return True
+            try:
+                return float(csv_value) == float(xlsx_value)
+            except ValueError:
+                return False
+        
+        mismatches = [
+            (row_index + 1, column_index + 1, csv_value, actual_row[column_index])
+            for row_index, (csv_row, actual_row) in enumerate(zip(expected, actual))
+            for column_index, csv_value in enumerate(csv_row)
+            if not same(csv_value, actual_row[column_index])
+        ]
+        if len(expected) != len(actual):
+            mismatches.append(("rows", len(expected), len(actual)))
+        
+        if xlsx_response.status_code == 200 and not mismatches:
+            self.log_test("Tasks XLSX Export", True)
+            print(f"   Rows: {len(actual)}")
+            return True
+        else:
+            self.log_test("Tasks XLSX Export", False, f"Mismatched cells: {mismatches[:5]}")
+            return False
+
+    def test_daily_stats(self):
+        """Test precomputed daily stats (admin view)"""
+        print("\n🗓️ Testing Daily Stats...")
+        success, response = self.make_request(
+            'GET', 'stats/daily', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, list):
+            self.log_test("Daily Stats", True)
+            print(f"   Daily rows: {len(response)}")
+            return True
+        else:
+            self.log_test("Daily Stats", False, str(response))
+            return False
+
+    def test_task_history(self):
+        """Test task history across hot and archived tasks"""
+        print("\n🗄️ Testing Task History...")
+        success, response = self.make_request(
+            'GET', 'tasks/history?page=1&page_size=20', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, list):
+            self.log_test("Task History", True)
+            print(f"   History page size: {len(response)}")
+            return True
+        else:
+            self.log_test("Task History", False, str(response))
+            return False
+
+    def test_task_search(self):
+        """Test task search by customer phone prefix"""
+        print("\n🔍 Testing Task Search...")
+        success, response = self.make_request(
+            'GET', 'tasks/search?q=0501&page=1&page_size=20', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response.get('tasks'), list):
+            self.log_test("Task Search", True)
+            print(f"   Matches: {response.get('total')}")
+            return True
+        else:
+            self.log_test("Task Search", False, str(response))
+            return False
+
+    def test_customer_tasks(self):
+        """Test a customer's visit history"""
+        print("\n👤 Testing Customer Tasks...")
+        if not self.test_customer_id:
+            self.log_test("Customer Tasks", False, "No customer linked to the test task")
+            return False
+        
+        success, response = self.make_request(
+            'GET', f'customers/{self.test_customer_id}/tasks', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, list) and any(t['id'] == self.test_task_id for t in response):
+            self.log_test("Customer Tasks", True)
+            print(f"   Visits: {len(response)}")
+            return True
+        else:
+            self.log_test("Customer Tasks", False, str(response))
+            return False
+
+    def test_create_schedule(self):
+        """Test creating a recurring maintenance schedule (admin only)"""
+        print("\n🗓️ Testing Create Schedule...")
+        schedule_data = {
+            "customer_name": "أحمد محمد",
+            "customer_phone": "0501234567",
+            "customer_address": "الرياض، حي النخيل، شارع الملك فهد",
+            "issue_description": "صيانة دورية لنظام التكييف",
+            "assigned_to": self.tech_user['id'] if self.tech_user else None,
+            "frequency": "monthly",
+            "interval": 1,
+            "starts_at": "2030-01-01T08:00:00Z"
+        }
+        
+        success, response = self.make_request(
+            'POST', 'schedules', 
+            schedule_data, 
+            token=self.admin_token,
+            expected_status=200
+        )
+        
+        if success and isinstance(response, dict) and response.get('next_run_at', '').startswith('2030-01-01'):
+            self.log_test("Create Schedule", True)
+            # Stop it again so repeated runs do not pile up schedules
+            self.make_request('DELETE', f"schedules/{response['id']}", token=self.admin_token)
+            return True
+        else:
+            self.log_test("Create Schedule", False, str(response))
+            return False
+
+    def test_task_route(self):
+        """Test the technician's optimized route"""
+        print("\n🗺️ Testing Task Route...")
+        success, response = self.make_request(
+            'GET', 'tasks/route', 
+            token=self.tech_token
+        )
+        
+        if success and isinstance(response.get('tasks'), list):
+            self.log_test("Task Route", True)
+            print(f"   Stops: {len(response['tasks'])}, distance: {response.get('total_distance_km')} km")
+            return True
+        else:
+            self.log_test("Task Route", False, str(response))
+            return False
+
+    def test_task_eta(self):
+        """Test duration prediction and arrival ETA for the test task"""
+        print("\n⏱️ Testing Task ETA...")
+        if not self.test_task_id:
+            self.log_test("Task ETA", False, "No test task available")
+            return False
+        
+        success, response = self.make_request(
+            'GET', f'tasks/{self.test_task_id}/eta', 
+            token=self.admin_token
+        )
+        
+        if success and 'predicted_duration_minutes' in response:
+            self.log_test("Task ETA", True)
+            print(f"   Predicted duration: {response['predicted_duration_minutes']} min, arrival: {response.get('arrival_eta')}")
+            return True
+        else:
+            self.log_test("Task ETA", False, str(response))
+            return False
+
+    def test_geofence_events(self):
+        """Test arrival/departure events for the test task"""
+        print("\n📍 Testing Geofence Events...")
+        if not self.test_task_id:
+            self.log_test("Geofence Events", False, "No test task available")
+            return False
+        
+        success, response = self.make_request(
+            'GET', f'tasks/{self.test_task_id}/geofence-events', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, list):
+            self.log_test("Geofence Events", True)
+            print(f"   Events: {[event['type'] for event in response]}")
+            return True
+        else:
+            self.log_test("Geofence Events", False, str(response))
+            return False
+
+    def test_task_events(self):
+        """Test the event timeline of the test task"""
+        print("\n🧾 Testing Task Events...")
+        if not self.test_task_id:
+            self.log_test("Task Events", False, "No test task available")
+            return False
+        
+        success, response = self.make_request(
+            'GET', f'tasks/{self.test_task_id}/events', 
+            token=self.admin_token
+        )
+        
+        if success and isinstance(response, list):
+            self.log_test("Task Events", True)
+            print(f"   Events: {[event['kind'] for event in response]}")
+            return True
+        else:
+            self.log_test("Task Events", False, str(response))
+            return False
+
+    def test_list_tenants(self):
+        """Test that the default shop's admin sees the tenant registry"""
+        print("\n🏬 Testing Tenants List...")
+        success, response = self.make_request('GET', 'tenants', token=self.admin_token)
+        
+        if success and isinstance(response, list) and any(tenant['id'] == 'default' for tenant in response):
+            self.log_test("Tenants List", True)
+            print(f"   Tenants: {[tenant['id'] for tenant in response]}")
+            return True
+        else:
+            self.log_test("Tenants List", False, str(response))
+            return False
+
+    def test_binary_locations(self):
+        """Test the compact binary encoding of a task's locations"""
+        print("\n📦 Testing Binary Locations...")
+        if not self.test_task_id:
+            self.log_test("Binary Locations", False, "No test task available")
+            return False
+        
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/locations/{self.test_task_id}",
+                params={'format': 'binary'},
+                headers={'Authorization': f'Bearer {self.admin_token}'},
+                timeout=10
+            )
+        except Exception as e:
+            self.log_test("Binary Locations", False, f"Request error: {str(e)}")
+            return False
+        
+        # 36-byte frame header at least, even with no fixes
+        if (response.status_code == 200
+                and response.headers.get('Content-Type') == 'application/x-location-batch'
+                and len(response.content) >= 36):
+            self.log_test("Binary Locations", True)
+            print(f"   Frame size: {len(response.content)} bytes")
+            return True
+        else:
+            self.log_test("Binary Locations", False, f"Status {response.status_code}")
+            return False
+
+    def test_telegram_webhook(self):
+        """Test that a callback without Telegram's secret token is refused"""
+        print("\n🤖 Testing Telegram Webhook...")
+        update = {
+            "update_id": 1,
+            "callback_query": {
+                "id": "test-callback",
+                "from": {"id": 1, "is_bot": False},
+                "data": f"accept:{self.test_task_id}"
+            }
+        }
+        try:
+            response = requests.post(f"{self.base_url}/api/telegram/webhook", json=update, timeout=10)
+        except Exception as e:
+            self.log_test("Telegram Webhook", False, f"Request error: {str(e)}")
+            return False
+        
+        # 404 while no secret is configured, 403 for a missing or wrong one
+        if response.status_code in (403, 404):
+            self.log_test("Telegram Webhook", True)
+            print(f"   Forged callback refused with {response.status_code}")
+            return True
+        else:
+            self.log_test("Telegram Webhook", False, f"Status {response.status_code}: {response.text[:200]}")
+            return False
+
     def run_all_tests(self):
         """Run all backend API tests"""
         print("🚀 Starting Comprehensive Backend API Testing")
@@ -550,6 +897,21 @@ class MaintenanceAPITester:
         self.test_get_task_locations()
         self.test_get_admin_stats()
         self.test_get_technician_stats()
+        self.test_performance_report()
+        self.test_export_tasks_csv()
+        self.test_export_tasks_xlsx()
+        self.test_daily_stats()
+        self.test_task_history()
+        self.test_task_search()
+        self.test_customer_tasks()
+        self.test_create_schedule()
+        self.test_task_route()
+        self.test_task_eta()
+        self.test_geofence_events()
+        self.test_task_events()
+        self.test_binary_locations()
+        self.test_telegram_webhook()
+        self.test_list_tenants()
         self.test_permission_restrictions()
         
         # Print final results
@@ -292,7 +292,7 @@ _نظام إدارة الصيانة_`;
         getAuthHeaders()
       );
       
-      toast.success(`✓ تم إرسال الرسالة إلى ${response.data.sent} موظف`);
+      toast.success(`✓ ستُرسل الرسالة إلى ${response.data.queued} موظف`);
       setShowBroadcastModal(false);
       setBroadcastMessage("");
       setSelectedTechnicians([]);
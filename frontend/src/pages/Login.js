@@ -4,6 +4,8 @@ import { toast } from "sonner";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+// Shops other than the default one sign in at /?tenant=<shop id>; the token carries it afterwards
+const TENANT = new URLSearchParams(window.location.search).get("tenant") || process.env.REACT_APP_TENANT;
 
 const Login = ({ onLogin }) => {
   const [formData, setFormData] = useState({
@@ -17,7 +19,9 @@ const Login = ({ onLogin }) => {
     setLoading(true);
 
     try {
-      const response = await axios.post(`${API}/auth/login`, formData);
+      const response = await axios.post(`${API}/auth/login`, formData, {
+        headers: TENANT ? { "X-Tenant": TENANT } : {}
+      });
       
       toast.success("تم تسجيل الدخول بنجاح");
       onLogin(response.data.token, response.data.user);
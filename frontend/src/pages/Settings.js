@@ -36,7 +36,7 @@ const Settings = ({ user, onClose }) => {
     setLoading(true);
 
     try {
-      await axios.post(
+      const response = await axios.post(
         `${API}/auth/change-password`,
         {
           old_password: passwordData.old_password,
@@ -45,6 +45,8 @@ const Settings = ({ user, onClose }) => {
         getAuthHeaders()
       );
 
+      // Tokens issued before the change are revoked; keep this session alive
+      localStorage.setItem("token", response.data.token);
       toast.success("✓ تم تغيير الرمز بنجاح");
       setPasswordData({
         old_password: "",
@@ -1,13 +1,25 @@
-import { useState, useEffect, useCallback } from "react";
+import { useState, useEffect, useCallback, useRef } from "react";
 import axios from "axios";
 import { toast } from "sonner";
 import { MapPin, CheckCircle, Clock, LogOut, Play, Bell, X, Settings as SettingsIcon } from "lucide-react";
 import { playNotificationSound } from "../utils/notificationSound";
+import { isNetworkError, queueOperation, pendingOperationsCount, flushOperations } from "../utils/offlineSync";
 import Settings from "./Settings";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Until the server answers, report every 10 seconds or every 100 meters
+const DEFAULT_REPORT_POLICY = { intervalMs: 10000, minDistanceMeters: 100 };
+
+// Good enough at city scale
+const distanceMeters = (from, to) => {
+  const toRadians = (degrees) => (degrees * Math.PI) / 180;
+  const x = toRadians(to.longitude - from.longitude) * Math.cos(toRadians((from.latitude + to.latitude) / 2));
+  const y = toRadians(to.latitude - from.latitude);
+  return Math.sqrt(x * x + y * y) * 6371000;
+};
+
 const TechnicianDashboard = ({ user, onLogout }) => {
   const [tasks, setTasks] = useState([]);
   const [stats, setStats] = useState(null);
@@ -23,27 +35,69 @@ const TechnicianDashboard = ({ user, onLogout }) => {
   const [modalTasksType, setModalTasksType] = useState("");
   const [modalTasks, setModalTasks] = useState([]);
   const [showSettings, setShowSettings] = useState(false);
-
-  const getAuthHeaders = () => ({
-    headers: { Authorization: `Bearer ${localStorage.getItem("token")}` }
+  // The server tells us after each fix how long to wait and how far to move before the next one
+  const reportPolicy = useRef(DEFAULT_REPORT_POLICY);
+  const lastReport = useRef(null);
+
+  const getAuthHeaders = (idempotencyKey) => ({
+    headers: {
+      Authorization: `Bearer ${localStorage.getItem("token")}`,
+      // Lets the server replay the original response when a retry arrives twice
+      ...(idempotencyKey ? { "Idempotency-Key": idempotencyKey } : {})
+    }
   });
 
   const sendLocation = useCallback(async (taskId, position) => {
+    lastReport.current = {
+      latitude: position.coords.latitude,
+      longitude: position.coords.longitude,
+      time: Date.now()
+    };
     try {
-      await axios.post(
+      const response = await axios.post(
         `${API}/locations`,
         {
           task_id: taskId,
           latitude: position.coords.latitude,
           longitude: position.coords.longitude
         },
-        getAuthHeaders()
+        getAuthHeaders(`location-${taskId}-${position.timestamp}`)
       );
+      const { next_report_seconds, min_distance_meters } = response.data;
+      if (next_report_seconds) {
+        reportPolicy.current = {
+          intervalMs: next_report_seconds * 1000,
+          minDistanceMeters: min_distance_meters
+        };
+      }
     } catch (error) {
-      console.error("Error sending location:", error);
+      if (isNetworkError(error)) {
+        // Out of coverage: keep the fix and upload it with the next sync
+        queueOperation({
+          type: "location",
+          task_id: taskId,
+          latitude: position.coords.latitude,
+          longitude: position.coords.longitude,
+          device_timestamp: new Date(position.timestamp).toISOString()
+        });
+      } else {
+        console.error("Error sending location:", error);
+      }
     }
   }, []);
 
+  // Send a fix once the interval has passed or the technician has moved far enough
+  const reportPosition = useCallback((taskId, position) => {
+    const last = lastReport.current;
+    const { intervalMs, minDistanceMeters } = reportPolicy.current;
+    if (last) {
+      const elapsed = Date.now() - last.time;
+      const moved = distanceMeters(last, position.coords);
+      if (elapsed < intervalMs && moved < minDistanceMeters) return;
+    }
+    sendLocation(taskId, position);
+  }, [sendLocation]);
+
   useEffect(() => {
     fetchData();
     
@@ -61,7 +115,11 @@ const TechnicianDashboard = ({ user, onLogout }) => {
     
     // Check for new notifications every 5 seconds
     const interval = setInterval(fetchData, 5000);
-    return () => clearInterval(interval);
+    window.addEventListener("online", fetchData);
+    return () => {
+      clearInterval(interval);
+      window.removeEventListener("online", fetchData);
+    };
   // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []);
 
@@ -70,9 +128,9 @@ const TechnicianDashboard = ({ user, onLogout }) => {
     let intervalId;
     if (locationTracking && activeTask) {
       if (navigator.geolocation) {
-        // Continuous tracking with watchPosition (updates every 1-2 seconds)
+        // watchPosition follows the technician; reportPosition decides what is sent
         watchId = navigator.geolocation.watchPosition(
-          (position) => sendLocation(activeTask.id, position),
+          (position) => reportPosition(activeTask.id, position),
           (error) => {
             console.error("Geolocation error:", error);
             toast.error("فشل تحديث الموقع. يرجى التحقق من إعدادات الموقع.");
@@ -80,28 +138,49 @@ const TechnicianDashboard = ({ user, onLogout }) => {
           { 
             enableHighAccuracy: true, 
             maximumAge: 0, 
-            timeout: 5000,
-            distanceFilter: 5 // Send update every 5 meters
+            timeout: 5000
           }
         );
         
-        // Additional aggressive polling every 2 seconds for real-time tracking
+        // watchPosition goes quiet while standing still; make sure a fix is
+        // still sent when the server's interval runs out
         intervalId = setInterval(() => {
+          const last = lastReport.current;
+          if (last && Date.now() - last.time < reportPolicy.current.intervalMs) return;
           navigator.geolocation.getCurrentPosition(
-            (position) => sendLocation(activeTask.id, position),
+            (position) => reportPosition(activeTask.id, position),
             (error) => console.error("Geolocation polling error:", error),
-            { enableHighAccuracy: true, maximumAge: 0 }
+            { enableHighAccuracy: true, maximumAge: reportPolicy.current.intervalMs / 2 }
           );
-        }, 2000); // Every 2 seconds
+        }, 1000);
       }
     }
     return () => {
       if (watchId) navigator.geolocation.clearWatch(watchId);
       if (intervalId) clearInterval(intervalId);
     };
-  }, [locationTracking, activeTask, sendLocation]);
+  }, [locationTracking, activeTask, reportPosition]);
 
   const fetchData = async () => {
+    // No point polling without coverage; the "online" event triggers a refresh
+    if (!navigator.onLine) {
+      return;
+    }
+
+    if (pendingOperationsCount() > 0) {
+      try {
+        const synced = await flushOperations(API, getAuthHeaders());
+        (synced?.failed || []).forEach((operation) => {
+          const label = operation.type === "location" ? "موقع" : "تحديث مهمة";
+          toast.error(`تعذر رفع ${label} محفوظ بدون اتصال: ${operation.detail || "خطأ غير معروف"}`, {
+            duration: 8000
+          });
+        });
+      } catch (error) {
+        console.error("Error syncing offline operations:", error);
+      }
+    }
+
     try {
       const [tasksRes, statsRes, notifRes, unreadRes] = await Promise.all([
         axios.get(`${API}/tasks`, getAuthHeaders()),
@@ -228,7 +307,7 @@ const TechnicianDashboard = ({ user, onLogout }) => {
     }
 
     try {
-      await axios.patch(`${API}/tasks/${task.id}/accept`, {}, getAuthHeaders());
+      await axios.patch(`${API}/tasks/${task.id}/accept`, {}, getAuthHeaders(`accept-${task.id}`));
       toast.success("تم قبول المهمة بنجاح");
       fetchData();
     } catch (error) {
@@ -238,7 +317,7 @@ const TechnicianDashboard = ({ user, onLogout }) => {
 
   const handleStartTask = async (task) => {
     try {
-      await axios.patch(`${API}/tasks/${task.id}/start`, {}, getAuthHeaders());
+      await axios.patch(`${API}/tasks/${task.id}/start`, {}, getAuthHeaders(`start-${task.id}`));
       setActiveTask(task);
       setLocationTracking(true);
       toast.success("تم بدء المهمة - جاري تتبع موقعك");
@@ -263,7 +342,7 @@ const TechnicianDashboard = ({ user, onLogout }) => {
           images: [],
           success: taskSuccess 
         },
-        getAuthHeaders()
+        getAuthHeaders(`complete-${activeTask.id}`)
       );
       toast.success(taskSuccess ? "✓ تم إنهاء المهمة بنجاح" : "⚠️ تم تسجيل المهمة كغير مكتملة");
       setActiveTask(null);
@@ -273,7 +352,23 @@ const TechnicianDashboard = ({ user, onLogout }) => {
       setTaskSuccess(true);
       fetchData();
     } catch (error) {
-      toast.error("فشل إنهاء المهمة");
+      if (isNetworkError(error)) {
+        queueOperation({
+          type: "complete",
+          task_id: activeTask.id,
+          report_text: report,
+          images: [],
+          success: taskSuccess
+        });
+        toast.success("لا يوجد اتصال - سيتم إرسال التقرير تلقائياً عند عودة الاتصال");
+        setActiveTask(null);
+        setLocationTracking(false);
+        setShowReportModal(false);
+        setReport("");
+        setTaskSuccess(true);
+      } else {
+        toast.error("فشل إنهاء المهمة");
+      }
     }
   };
 
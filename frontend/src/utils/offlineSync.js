@@ -0,0 +1,49 @@
+import axios from "axios";
+
+// Operations recorded while the phone is out of coverage, uploaded in one
+// batch to POST /sync when the connection returns.
+const QUEUE_KEY = "offlineOperations";
+const SYNC_TOKEN_KEY = "syncToken";
+
+const readQueue = () => JSON.parse(localStorage.getItem(QUEUE_KEY) || "[]");
+
+export const isNetworkError = (error) => !error.response;
+
+export const queueOperation = (operation) => {
+  const queue = readQueue();
+  queue.push({
+    op_id: `${Date.now()}-${Math.random().toString(36).slice(2)}`,
+    device_timestamp: new Date().toISOString(),
+    ...operation
+  });
+  localStorage.setItem(QUEUE_KEY, JSON.stringify(queue));
+};
+
+export const pendingOperationsCount = () => readQueue().length;
+
+export const flushOperations = async (api, config) => {
+  const queue = readQueue();
+  if (queue.length === 0) {
+    return null;
+  }
+
+  const response = await axios.post(
+    `${api}/sync`,
+    { sync_token: localStorage.getItem(SYNC_TOKEN_KEY), operations: queue },
+    config
+  );
+
+  // Keep anything queued while the upload was in flight
+  localStorage.setItem(QUEUE_KEY, JSON.stringify(readQueue().slice(queue.length)));
+  localStorage.setItem(SYNC_TOKEN_KEY, response.data.sync_token);
+
+  // Rejected operations (task deleted or reassigned, missing report...) would
+  // fail the same way on every retry, so they are dropped and reported instead
+  const failed = response.data.results
+    .filter((result) => result.status !== "ok")
+    .map((result) => ({
+      ...queue.find((operation) => operation.op_id === result.op_id),
+      detail: result.detail
+    }));
+  return { ...response.data, failed };
+};
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+# server.py reads these at import time; no connection is made until a query runs
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "maintenance_tests")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """In-memory MongoDB behind server.db for the default tenant"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", server.TenantDatabase())
+    monkeypatch.setattr(server, "read_db", server.TenantDatabase())
+    monkeypatch.setattr(server, "control_db", client[server.DB_NAME])
+    return server.db
+
+
+@pytest.fixture
+async def api(database, monkeypatch):
+    """The API over ASGI, without the startup tasks and background workers"""
+    httpx = pytest.importorskip("httpx")
+    monkeypatch.setattr(server, "tenants", {server.DEFAULT_TENANT: {"id": server.DEFAULT_TENANT}})
+    monkeypatch.setattr(server, "rate_limiter", server.RateLimiter(server.RATE_LIMIT_MAX_CLIENTS))
+    transport = httpx.ASGITransport(app=server.app, client=("203.0.113.7", 50000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+async def create_user(database, user_id, name, email, role):
+    user = {
+        "id": user_id,
+        "name": name,
+        "email": email,
+        "role": role,
+        "password": server.hash_password("secret"),
+        "created_at": "2026-01-01T00:00:00+00:00",
+    }
+    await database.users.insert_one(dict(user))
+    return {"Authorization": f"Bearer {server.create_token(user)}"}
+
+
+@pytest.fixture
+async def technician(database):
+    """A technician account; returns the Authorization header for it"""
+    return await create_user(database, "tech-1", "علي", "ali@example.com", "technician")
+
+
+@pytest.fixture
+async def admin(database):
+    """An admin account; returns the Authorization header for it"""
+    return await create_user(database, "admin-1", "المدير", "admin@example.com", "admin")
@@ -0,0 +1,38 @@
+import itertools
+
+import numpy as np
+
+import server
+
+
+def brute_force_cost(cost):
+    rows, cols = cost.shape
+    return min(
+        cost[np.arange(rows), list(columns)].sum()
+        for columns in itertools.permutations(range(cols), rows)
+    )
+
+
+def test_solution_is_optimal_on_small_matrices():
+    rng = np.random.default_rng(41)
+    for rows, cols in [(1, 1), (2, 2), (3, 5), (4, 4), (5, 7), (6, 6)]:
+        for _ in range(20):
+            cost = rng.integers(0, 100, size=(rows, cols)).astype(float)
+
+            assignment = server.solve_assignment(cost)
+
+            assert len(set(assignment.tolist())) == rows
+            assert cost[np.arange(rows), assignment].sum() == brute_force_cost(cost)
+
+
+def test_greedy_choice_is_not_taken():
+    # Row 0's cheapest column is the only good one for row 1
+    cost = np.array([[1.0, 2.0], [1.0, 100.0]])
+
+    assert server.solve_assignment(cost).tolist() == [1, 0]
+
+
+def test_fractional_costs():
+    cost = np.array([[0.5, 0.25, 0.75], [0.3, 0.9, 0.1]])
+
+    assert server.solve_assignment(cost).tolist() == [1, 2]
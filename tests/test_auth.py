@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+
+import server
+
+
+@pytest.fixture
+def revocations(database, monkeypatch):
+    revoked = server.TenantLocal(dict)
+    monkeypatch.setattr(server, "revoked_token_versions", revoked)
+    return revoked
+
+
+def change_password(api, headers, new_password="changed"):
+    return api.post(
+        "/api/auth/change-password",
+        json={"old_password": "secret", "new_password": new_password},
+        headers=headers,
+    )
+
+
+@pytest.mark.anyio
+async def test_password_change_revokes_older_tokens(api, technician, revocations):
+    response = await change_password(api, technician)
+    assert response.status_code == 200
+
+    old = await api.get("/api/auth/me", headers=technician)
+    assert old.status_code == 401
+    fresh = {"Authorization": f"Bearer {response.json()['token']}"}
+    assert (await api.get("/api/auth/me", headers=fresh)).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_revocation_reaches_a_worker_that_starts_later(api, technician, revocations):
+    await change_password(api, technician)
+    revocations.clear()
+
+    await server.load_token_revocations()
+
+    assert (await api.get("/api/auth/me", headers=technician)).status_code == 401
+
+
+@pytest.mark.anyio
+async def test_embedded_claims_need_no_user_lookup(api, database, technician, revocations):
+    await database.users.delete_many({})
+
+    # Only routes that read the user themselves notice it is gone
+    assert (await api.get("/api/tasks", headers=technician)).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_tokens_signed_with_a_retired_key_stay_valid(api, database, monkeypatch, revocations):
+    monkeypatch.setattr(server, "JWT_KEYS", {"old": "old-secret", "new": "new-secret"})
+    monkeypatch.setattr(server, "JWT_ACTIVE_KID", "new")
+    claims = {
+        "sub": "tech-1",
+        "role": "technician",
+        "name": "علي",
+        "email": "ali@example.com",
+        "ver": 0,
+        "exp": datetime.now(timezone.utc) + timedelta(hours=1),
+    }
+
+    def token(kid, secret):
+        return {"Authorization": f"Bearer {jwt.encode(claims, secret, algorithm='HS256', headers={'kid': kid})}"}
+
+    assert (await api.get("/api/tasks", headers=token("old", "old-secret"))).status_code == 200
+    assert (await api.get("/api/tasks", headers=token("gone", "old-secret"))).status_code == 401
+    assert (await api.get("/api/tasks", headers=token("new", "old-secret"))).status_code == 401
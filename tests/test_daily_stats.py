@@ -0,0 +1,74 @@
+import uuid
+
+import pytest
+
+import server
+
+DAY = "2026-10-12"
+
+
+def fix(minute, latitude, longitude=44.36, user_id="tech-1"):
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "task_id": "task-1",
+        "latitude": latitude,
+        "longitude": longitude,
+        "timestamp": f"{DAY}T08:{minute:02d}:00+00:00",
+    }
+
+
+async def insert_fixes(database, fixes):
+    await database.locations.insert_many(fixes)
+    await server.add_fixes_to_rollups(fixes)
+
+
+async def stored_distance(database):
+    row = await database.daily_stats.find_one({"technician_id": "tech-1", "date": DAY})
+    return row["distance_km"], row["location_fixes"]
+
+
+@pytest.mark.anyio
+async def test_fixes_add_their_segments(database):
+    fixes = [fix(minute, 33.30 + minute / 1000) for minute in range(5)]
+    for one in fixes:
+        await insert_fixes(database, [one])
+
+    distance, count = await stored_distance(database)
+    assert distance == pytest.approx(server.path_km(fixes))
+    assert count == 5
+
+
+@pytest.mark.anyio
+async def test_offline_fixes_in_the_middle_of_the_day(database):
+    await insert_fixes(database, [fix(0, 33.30), fix(30, 33.31)])
+    # Uploaded later, taken between the two fixes above
+    offline = [fix(10, 33.30, 44.37), fix(20, 33.31, 44.37)]
+    await insert_fixes(database, offline)
+
+    path = sorted([fix(0, 33.30), fix(30, 33.31), *offline], key=lambda one: one["timestamp"])
+    distance, count = await stored_distance(database)
+    assert distance == pytest.approx(server.path_km(path))
+    assert count == 4
+
+
+@pytest.mark.anyio
+async def test_task_recompute_keeps_the_distance(database):
+    await insert_fixes(database, [fix(0, 33.30), fix(5, 33.31)])
+    before, _ = await stored_distance(database)
+
+    await server.compute_daily_stats("tech-1", DAY)
+
+    assert await stored_distance(database) == (before, 2)
+
+
+@pytest.mark.anyio
+async def test_rebuild_reads_archived_fixes(database):
+    archived = [fix(0, 33.30), fix(5, 33.31)]
+    await database.locations_archive.insert_many(archived)
+
+    await server.rebuild_rollups({("tech-1", DAY)})
+
+    distance, count = await stored_distance(database)
+    assert distance == round(server.path_km(archived), 3)
+    assert count == 2
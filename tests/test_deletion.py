@@ -0,0 +1,59 @@
+import pytest
+
+import server
+
+
+async def insert_task(database, task_id):
+    await database.tasks.insert_one({
+        "id": task_id,
+        "customer_name": "زبون",
+        "customer_phone": "07701234567",
+        "customer_address": "بغداد",
+        "issue_description": "انقطاع",
+        "status": "pending",
+        "assigned_to": "tech-1",
+        "created_by": "admin-1",
+        "created_at": "2026-10-19T08:00:00+00:00",
+        "updated_at": "2026-10-19T08:00:00+00:00",
+    })
+    await database.locations.insert_one({"id": f"{task_id}-fix", "task_id": task_id, "user_id": "tech-1"})
+
+
+@pytest.fixture
+async def tasks(api, database, admin):
+    await insert_task(database, "kept")
+    await insert_task(database, "removed")
+    response = await api.post("/api/tasks/bulk-delete", json={"task_ids": ["removed"]}, headers=admin)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+@pytest.mark.anyio
+async def test_tombstones_are_excluded_before_cleanup(api, technician, tasks):
+    listed = await api.get("/api/tasks", headers=technician)
+
+    assert [task["id"] for task in listed.json()] == ["kept"]
+    assert (await api.get("/api/tasks/removed", headers=technician)).status_code == 404
+
+
+@pytest.mark.anyio
+async def test_cleanup_removes_the_task_and_its_locations(api, database, admin, tasks):
+    assert await server.cleanup_deleted_tasks() == 1
+
+    assert await database.tasks.find_one({"id": "removed"}) is None
+    assert [fix["task_id"] async for fix in database.locations.find({})] == ["kept"]
+    job = await api.get(f"/api/tasks/deletion-jobs/{tasks['job_id']}", headers=admin)
+    assert job.json()["done"] is True
+
+
+@pytest.mark.anyio
+async def test_offline_phone_hears_about_deletion_after_cleanup(api, database, admin, technician):
+    await insert_task(database, "removed")
+    first = await api.post("/api/sync", json={"operations": []}, headers=technician)
+    await api.post("/api/tasks/bulk-delete", json={"task_ids": ["removed"]}, headers=admin)
+    await server.cleanup_deleted_tasks()
+
+    delta = await api.post("/api/sync", json={"sync_token": first.json()["sync_token"], "operations": []}, headers=technician)
+
+    assert delta.json()["reset"] is False
+    assert delta.json()["deleted_task_ids"] == ["removed"]
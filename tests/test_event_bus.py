@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def events(database, monkeypatch):
+    received = []
+
+    async def record(event):
+        received.append((server.current_tenant.get(), event["kind"], event["document"]["id"]))
+
+    monkeypatch.setattr(server.EventBus, "subscribers", [("task.", record)])
+    monkeypatch.setattr(server, "EVENT_BUS_POLL_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(server, "EVENT_BUS_CHECKPOINT_SECONDS", 0)
+    monkeypatch.setattr(server, "active_tenants", {server.DEFAULT_TENANT})
+    monkeypatch.setattr(server, "tenants", {server.DEFAULT_TENANT: {"id": server.DEFAULT_TENANT}})
+    return received
+
+
+async def run_bus_briefly():
+    bus = server.EventBus()
+    task = asyncio.create_task(bus.run_polling())
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def new_task(task_id: str, created_at: datetime) -> dict:
+    return {
+        "id": task_id,
+        "status": "pending",
+        "created_at": created_at.isoformat(),
+        "updated_at": created_at.isoformat(),
+        "last_event": "task.created",
+    }
+
+
+@pytest.mark.anyio
+async def test_polling_resumes_after_restart(database, events):
+    await run_bus_briefly()
+
+    # Written while no worker was running
+    await database.tasks.insert_one(new_task("offline", datetime.now(timezone.utc) + timedelta(seconds=1)))
+    await run_bus_briefly()
+
+    assert ("default", "task.created", "offline") in events
+
+
+@pytest.mark.anyio
+async def test_first_start_skips_existing_tasks(database, events):
+    await database.tasks.insert_one(new_task("old", datetime.now(timezone.utc) - timedelta(days=1)))
+    await run_bus_briefly()
+
+    assert events == []
+
+
+@pytest.mark.anyio
+async def test_one_polling_loop_serves_every_tenant(database, events):
+    server.tenants["shop2"] = {"id": "shop2"}
+    server.active_tenants.add("shop2")
+    bus = server.EventBus()
+    for tenant_id in server.active_tenants:
+        with server.tenant_scope(tenant_id):
+            await bus.attach()
+
+    created_at = datetime.now(timezone.utc) + timedelta(seconds=1)
+    await database.tasks.insert_one(new_task("here", created_at))
+    with server.tenant_scope("shop2"):
+        await database.tasks.insert_one(new_task("there", created_at))
+    await server.for_each_tenant("Event bus polling", bus.poll)
+
+    assert sorted(events) == [("default", "task.created", "here"), ("shop2", "task.created", "there")]
+
+
+@pytest.mark.anyio
+async def test_change_stream_dispatches_in_the_tenant_of_the_database(events):
+    server.tenants["shop2"] = {"id": "shop2"}
+    bus = server.EventBus()
+
+    def change(database_name, task_id):
+        return {
+            "ns": {"db": database_name, "coll": "tasks"},
+            "operationType": "insert",
+            "fullDocument": new_task(task_id, datetime.now(timezone.utc)),
+        }
+
+    await bus.dispatch_change(change(server.DB_NAME, "here"))
+    await bus.dispatch_change(change(f"{server.DB_NAME}__shop2", "there"))
+    # Same prefix but not a registered tenant
+    await bus.dispatch_change(change(f"{server.DB_NAME}__unknown", "nowhere"))
+    await bus.dispatch_change(change("other_app", "elsewhere"))
+
+    assert events == [("default", "task.created", "here"), ("shop2", "task.created", "there")]
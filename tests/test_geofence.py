@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+SITE = (33.3128, 44.3615)
+ARRIVED_AT = datetime(2026, 10, 19, 8, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def geofences(database, monkeypatch):
+    index = server.TenantLocal(server.GeofenceIndex)
+    monkeypatch.setattr(server, "geofences", index)
+    return index
+
+
+async def insert_task(database):
+    await database.tasks.insert_one({
+        "id": "task-1",
+        "status": "in_progress",
+        "assigned_to": "tech-1",
+        "latitude": SITE[0],
+        "longitude": SITE[1],
+        "arrived_at": None,
+        "departed_at": None,
+        "updated_at": ARRIVED_AT.isoformat(),
+    })
+
+
+@pytest.mark.anyio
+async def test_arrival_and_departure(database, geofences):
+    await insert_task(database)
+    await server.refresh_geofence_index()
+
+    await geofences.evaluate("tech-1", SITE[0], SITE[1], ARRIVED_AT)
+    await geofences.evaluate("tech-1", SITE[0] + 0.01, SITE[1], ARRIVED_AT + timedelta(minutes=30))
+
+    kinds = [event["type"] async for event in database.geofence_events.find({}).sort("at", 1)]
+    assert kinds == ["arrival", "departure"]
+
+
+@pytest.mark.anyio
+async def test_far_fix_after_refresh_records_departure(database, geofences):
+    await insert_task(database)
+    await server.refresh_geofence_index()
+    await geofences.evaluate("tech-1", SITE[0], SITE[1], ARRIVED_AT)
+
+    # The periodic refresh drops the local presence view
+    await server.refresh_geofence_index()
+    # About 11 km away, well outside the cells around the site
+    departed_at = ARRIVED_AT + timedelta(minutes=45)
+    await geofences.evaluate("tech-1", SITE[0] + 0.1, SITE[1], departed_at)
+
+    presence = await database.geofence_presence.find_one({"_id": "task-1:tech-1"})
+    assert presence["inside"] is False
+    task = await database.tasks.find_one({"id": "task-1"})
+    assert task["departed_at"] == departed_at.isoformat()
+
+
+@pytest.mark.anyio
+async def test_far_fix_on_worker_without_view(database, geofences):
+    await insert_task(database)
+    await database.geofence_presence.insert_one(
+        {"_id": "task-1:tech-1", "task_id": "task-1", "user_id": "tech-1", "inside": True}
+    )
+    await server.refresh_geofence_index()
+
+    await geofences.evaluate("tech-1", SITE[0] + 0.1, SITE[1], ARRIVED_AT)
+
+    presence = await database.geofence_presence.find_one({"_id": "task-1:tech-1"})
+    assert presence["inside"] is False
@@ -0,0 +1,45 @@
+import pytest
+
+FIX = {"latitude": 33.3128, "longitude": 44.3615, "task_id": "task-1"}
+
+
+def post_fix(api, technician, key, body=FIX):
+    return api.post("/api/locations", json=body, headers={**technician, "Idempotency-Key": key})
+
+
+@pytest.mark.anyio
+async def test_retry_is_replayed_without_writing_again(api, database, technician):
+    first = await post_fix(api, technician, "fix-1")
+    retry = await post_fix(api, technician, "fix-1")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert await database.locations.count_documents({}) == 1
+
+
+@pytest.mark.anyio
+async def test_new_key_is_a_new_request(api, database, technician):
+    await post_fix(api, technician, "fix-1")
+    response = await post_fix(api, technician, "fix-2")
+
+    assert "Idempotent-Replayed" not in response.headers
+    assert await database.locations.count_documents({}) == 2
+
+
+@pytest.mark.anyio
+async def test_key_reused_for_a_different_body_is_rejected(api, database, technician):
+    await post_fix(api, technician, "fix-1")
+    response = await post_fix(api, technician, "fix-1", {**FIX, "latitude": 33.4})
+
+    assert response.status_code == 422
+    assert await database.locations.count_documents({}) == 1
+
+
+@pytest.mark.anyio
+async def test_failed_request_can_be_retried(api, database, technician):
+    invalid = {"latitude": "north", "longitude": 44.3615}
+    assert (await post_fix(api, technician, "fix-1", invalid)).status_code == 422
+
+    assert (await post_fix(api, technician, "fix-1", invalid)).status_code == 422
+    assert await database.idempotency_keys.count_documents({}) == 0
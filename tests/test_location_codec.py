@@ -0,0 +1,77 @@
+import struct
+import uuid
+
+import numpy as np
+import pytest
+
+import server
+
+TASK_ID = str(uuid.UUID(int=1))
+START_MS = 1_792_400_000_000
+
+
+def layout(frame):
+    return struct.unpack_from("<BB", frame)[1]
+
+
+def round_trip(times_ms, latitudes, longitudes):
+    frame = server.encode_location_frame(TASK_ID, times_ms, latitudes, longitudes)
+    [(task_id, times, lats, lons)] = server.decode_location_frames(frame)
+    assert task_id == TASK_ID
+    return frame, times, lats, lons
+
+
+def test_single_fix_is_exact():
+    frame, times, lats, lons = round_trip([START_MS], [33.3128456], [44.3615123])
+
+    assert len(frame) == server.LOCATION_FRAME_HEADER.size
+    assert times.tolist() == [START_MS]
+    assert lats.tolist() == [33.3128456]
+    assert lons.tolist() == [44.3615123]
+
+
+def test_close_fixes_use_narrow_records_within_rounding():
+    times_ms = [START_MS + 2037 * step for step in range(50)]
+    latitudes = [33.3128456 + 0.0000137 * step for step in range(50)]
+    longitudes = [44.3615123 - 0.0000093 * step for step in range(50)]
+
+    frame, times, lats, lons = round_trip(times_ms, latitudes, longitudes)
+
+    assert layout(frame) == server.LOCATION_LAYOUT_NARROW
+    # Half a record unit, without drifting along the frame
+    assert np.max(np.abs(times - times_ms)) <= 50
+    assert np.max(np.abs(lats - latitudes)) <= 0.5e-6 + 1e-12
+    assert np.max(np.abs(lons - longitudes)) <= 0.5e-6 + 1e-12
+
+
+def test_out_of_order_fixes_use_exact_wide_records():
+    times_ms = [START_MS, START_MS + 4000, START_MS + 2000]
+    latitudes = [33.3128456, 33.3129001, 33.3128702]
+    longitudes = [44.3615123, 44.3616004, 44.3615550]
+
+    frame, times, lats, lons = round_trip(times_ms, latitudes, longitudes)
+
+    assert layout(frame) == server.LOCATION_LAYOUT_WIDE
+    assert times.tolist() == times_ms
+    assert np.allclose(lats, latitudes, rtol=0, atol=1e-9)
+    assert np.allclose(lons, longitudes, rtol=0, atol=1e-9)
+
+
+def test_distant_fixes_use_wide_records():
+    # A ten-minute gap overflows the narrow time field
+    times_ms = [START_MS, START_MS + 600_000]
+    latitudes = [33.3128456, 33.4128456]
+    longitudes = [44.3615123, 44.3615123]
+
+    frame, times, lats, _ = round_trip(times_ms, latitudes, longitudes)
+
+    assert layout(frame) == server.LOCATION_LAYOUT_WIDE
+    assert times.tolist() == times_ms
+    assert np.allclose(lats, latitudes, rtol=0, atol=1e-9)
+
+
+@pytest.mark.anyio
+async def test_binary_export_rejects_a_task_id_that_is_not_a_uuid(api, technician):
+    response = await api.get("/api/locations/not-a-uuid", params={"format": "binary"}, headers=technician)
+
+    assert response.status_code == 400
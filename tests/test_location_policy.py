@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+NOW = datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def policy(database, monkeypatch):
+    monkeypatch.setattr(server, "last_fixes", OrderedDict())
+    monkeypatch.setattr(server, "location_ingest", server.IngestMeter())
+    monkeypatch.setattr(server, "geofences", server.TenantLocal(server.GeofenceIndex))
+    return server.location_report_policy
+
+
+@pytest.mark.anyio
+async def test_stale_cached_fix_is_replaced_by_the_latest_stored_one(database, policy):
+    # This worker last saw the technician two minutes ago, about 5 km away
+    server.last_fixes["tech-1"] = (33.36, 44.36, time.monotonic() - 120, 40.0, 20)
+    # Another worker took the fix ten seconds ago, a few meters from here
+    await database.locations.insert_one({
+        "user_id": "tech-1",
+        "latitude": 33.31,
+        "longitude": 44.36,
+        "received_at": (NOW - timedelta(seconds=10)).isoformat(),
+    })
+
+    interval, _ = await policy("tech-1", "task-1", 33.31001, 44.36, NOW)
+
+    # Standing still, not driving at 40 m/s
+    assert interval == server.LOCATION_STATIONARY_SECONDS
+
+
+@pytest.mark.anyio
+async def test_recent_cached_fix_is_used_without_a_query(database, policy):
+    server.last_fixes["tech-1"] = (33.31, 44.36, time.monotonic() - 10, None, 20)
+    # Never read: the cached fix is within the interval this worker gave
+    await database.locations.insert_one({
+        "user_id": "tech-1",
+        "latitude": 33.40,
+        "longitude": 44.36,
+        "received_at": (NOW - timedelta(seconds=5)).isoformat(),
+    })
+
+    interval, _ = await policy("tech-1", "task-1", 33.31001, 44.36, NOW)
+
+    assert interval == server.LOCATION_STATIONARY_SECONDS
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def worker(database, monkeypatch):
+    def become(worker_id):
+        monkeypatch.setattr(server, "WORKER_ID", worker_id)
+    return become
+
+
+@pytest.mark.anyio
+async def test_only_one_worker_holds_a_lock(database, worker):
+    worker("a")
+    assert await server.acquire_lock("leader:rollups", 60)
+    # Renewed by its owner
+    assert await server.acquire_lock("leader:rollups", 60)
+
+    worker("b")
+    assert not await server.acquire_lock("leader:rollups", 60)
+
+
+@pytest.mark.anyio
+async def test_expired_lock_is_taken_over(database, worker):
+    worker("a")
+    await server.acquire_lock("leader:rollups", 60)
+    await database.locks.update_one(
+        {"_id": "leader:rollups"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+
+    worker("b")
+    assert await server.acquire_lock("leader:rollups", 60)
+    assert (await database.locks.find_one({"_id": "leader:rollups"}))["owner"] == "b"
+
+
+@pytest.mark.anyio
+async def test_release_only_frees_own_lock(database, worker):
+    worker("a")
+    await server.acquire_lock("manual:archiver", 60)
+
+    worker("b")
+    await server.release_lock("manual:archiver")
+    assert not await server.acquire_lock("manual:archiver", 60)
+
+    worker("a")
+    await server.release_lock("manual:archiver")
+    worker("b")
+    assert await server.acquire_lock("manual:archiver", 60)
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+from pymongo import monitoring
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+import server
+
+ADDRESS = ("mongo-1", 27017)
+
+
+def event(**fields):
+    return SimpleNamespace(address=ADDRESS, **fields)
+
+
+def test_reads_stay_on_the_primary_by_default(monkeypatch):
+    monkeypatch.setattr(server, "MONGO_READ_PREFERENCE", "primary")
+
+    assert server.read_preference_for_reads() == Primary()
+
+
+def test_secondary_reads_are_bounded_by_staleness(monkeypatch):
+    monkeypatch.setattr(server, "MONGO_READ_PREFERENCE", "secondaryPreferred")
+    monkeypatch.setattr(server, "MONGO_MAX_STALENESS_SECONDS", 120)
+
+    preference = server.read_preference_for_reads()
+
+    assert preference == SecondaryPreferred(max_staleness=120)
+
+
+def test_compressors_without_their_package_are_dropped(monkeypatch):
+    monkeypatch.setattr(server, "MONGO_COMPRESSORS", "zstd, zlib, lz4")
+    monkeypatch.setattr(server.importlib.util, "find_spec", lambda module: module == "zlib")
+
+    assert server.available_compressors() == ["zlib"]
+
+
+def test_pool_metrics_track_checkouts_and_timeouts(monkeypatch):
+    monkeypatch.setattr(server, "MONGO_MAX_POOL_SIZE", 4)
+    metrics = server.PoolMetrics()
+
+    metrics.pool_created(event())
+    metrics.connection_checked_out(event())
+    metrics.connection_checked_out(event())
+    metrics.connection_checked_in(event())
+    metrics.connection_check_out_failed(event(reason=monitoring.ConnectionCheckOutFailedReason.TIMEOUT))
+
+    stats = metrics.snapshot()["servers"]["mongo-1:27017"]
+    assert stats["checkouts"] == 2
+    assert stats["checked_out"] == 1
+    assert stats["max_checked_out"] == 2
+    assert stats["wait_queue_timeouts"] == 1
+    assert stats["utilization"] == 0.25
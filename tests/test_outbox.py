@@ -0,0 +1,57 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def channel(database, monkeypatch):
+    local = server.LocalChannel()
+    monkeypatch.setattr(server, "notification_channels", {"local": local})
+    return local
+
+
+@pytest.mark.anyio
+async def test_concurrent_claims_do_not_share_messages(database, channel):
+    for number in range(5):
+        await server.enqueue_notification(f"n{number}", "tech-1", "رسالة", "broadcast", text="رسالة")
+
+    first, second = await asyncio.gather(server.claim_outbox_batch(), server.claim_outbox_batch())
+
+    claimed = [message["id"] for message in first + second]
+    assert sorted(claimed) == [f"n{number}" for number in range(5)]
+    assert await server.claim_outbox_batch() == []
+
+
+@pytest.mark.anyio
+async def test_delivered_batch_is_marked_sent(database, channel):
+    await server.enqueue_notification("n1", "tech-1", "رسالة", "broadcast", text="رسالة")
+
+    await server.deliver_outbox_batch(await server.claim_outbox_batch())
+
+    message = await database.notification_outbox.find_one({"id": "n1"})
+    assert message["status"] == "sent"
+    assert [sent["id"] for sent in channel.sent] == ["n1"]
+
+
+@pytest.mark.anyio
+async def test_completion_names_who_completed_the_task(database, channel):
+    now = datetime.now(timezone.utc).isoformat()
+    task = {
+        "id": "task-1",
+        "customer_name": "زبون",
+        "created_by": "admin-1",
+        "assigned_to": "tech-1",
+        "assigned_to_name": "علي",
+        "completed_by_name": "حسن",
+        "success": True,
+        "updated_at": now,
+    }
+
+    await server.notify_task_event({"kind": "task.completed", "document": task})
+
+    message = await database.notification_outbox.find_one({"user_id": "admin-1"})
+    assert "حسن" in message["text"]
+    assert "علي" not in message["text"]
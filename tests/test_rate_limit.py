@@ -0,0 +1,29 @@
+import pytest
+
+import server
+
+
+def login(api, email):
+    return api.post("/api/auth/login", json={"email": email, "password": "wrong"})
+
+
+@pytest.mark.anyio
+async def test_login_attempts_are_limited_after_the_burst(api):
+    _, burst = server.ROUTE_RATE_LIMITS["login attempts"]
+    for _ in range(burst):
+        assert (await login(api, "tech@example.com")).status_code == 401
+
+    response = await login(api, "tech@example.com")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+@pytest.mark.anyio
+async def test_login_attempts_are_counted_per_email(api):
+    _, burst = server.ROUTE_RATE_LIMITS["login attempts"]
+    for _ in range(burst + 1):
+        await login(api, "tech@example.com")
+
+    # Same address, as for everyone behind one proxy or NAT
+    assert (await login(api, "other@example.com")).status_code == 401
+    assert (await login(api, "TECH@example.com")).status_code == 429
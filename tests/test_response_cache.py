@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def cache(database, monkeypatch):
+    responses = server.TenantLocal(lambda: server.ResponseCache(server.MemoryCacheBackend(100), 60))
+    monkeypatch.setattr(server, "response_cache", responses)
+    return responses
+
+
+class Loader:
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return {"total_tasks": self.calls}
+
+
+@pytest.mark.anyio
+async def test_second_read_is_served_from_the_cache(cache):
+    loader = Loader()
+    admin = {"id": "admin-1", "role": "admin"}
+
+    first = await server.cached_response("stats", admin, ["tasks"], loader, scope="all")
+    second = await server.cached_response("stats", admin, ["tasks"], loader, scope="all")
+
+    assert first == second == {"total_tasks": 1}
+    assert loader.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@pytest.mark.anyio
+async def test_write_invalidates_tagged_responses(cache):
+    loader = Loader()
+    admin = {"id": "admin-1", "role": "admin"}
+    await server.cached_response("stats", admin, ["tasks"], loader, scope="all")
+
+    await server.invalidate_responses("tasks")
+
+    assert await server.cached_response("stats", admin, ["tasks"], loader, scope="all") == {"total_tasks": 2}
+
+
+@pytest.mark.anyio
+async def test_invalidation_from_another_worker_is_applied(cache):
+    loader = Loader()
+    admin = {"id": "admin-1", "role": "admin"}
+    await server.cached_response("stats", admin, ["tasks"], loader, scope="all")
+
+    server.handle_worker_event({
+        "channel": "cache.invalidate",
+        "payload": {"name": "responses", "key": "tasks"},
+        "tenant": server.DEFAULT_TENANT,
+        "origin": "another-worker",
+    })
+
+    assert await server.cached_response("stats", admin, ["tasks"], loader, scope="all") == {"total_tasks": 2}
+
+
+@pytest.mark.anyio
+async def test_response_loaded_across_an_invalidation_is_not_stored(cache):
+    loaded = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_loader():
+        loaded.set()
+        await release.wait()
+        return "stale"
+
+    admin = {"id": "admin-1", "role": "admin"}
+    reading = asyncio.create_task(server.cached_response("stats", admin, ["tasks"], slow_loader, scope="all"))
+    await loaded.wait()
+    cache.invalidate_local("tasks")
+    release.set()
+    assert await reading == "stale"
+
+    assert await server.cached_response("stats", admin, ["tasks"], Loader(), scope="all") == {"total_tasks": 1}
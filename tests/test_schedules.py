@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+import server
+
+
+def schedule(starts_at, frequency="monthly", interval=1, ends_at=None):
+    return {"starts_at": starts_at, "frequency": frequency, "interval": interval, "ends_at": ends_at}
+
+
+def at(value):
+    return datetime.fromisoformat(value)
+
+
+def test_month_end_is_clamped_in_shorter_months():
+    monthly = schedule("2026-01-31T09:00:00+00:00")
+
+    assert server.next_run_after(monthly, at("2026-01-31T09:00:00+00:00")) == "2026-02-28T09:00:00+00:00"
+    assert server.next_run_after(monthly, at("2026-04-01T00:00:00+00:00")) == "2026-04-30T09:00:00+00:00"
+
+
+def test_clamping_does_not_drift():
+    # After a short month the 31st comes back, counted from starts_at
+    monthly = schedule("2026-01-31T09:00:00+00:00")
+
+    assert server.next_run_after(monthly, at("2026-02-28T09:00:00+00:00")) == "2026-03-31T09:00:00+00:00"
+
+
+def test_leap_year_february():
+    monthly = schedule("2027-12-31T09:00:00+00:00", interval=2)
+
+    assert server.next_run_after(monthly, at("2027-12-31T09:00:00+00:00")) == "2028-02-29T09:00:00+00:00"
+
+
+def test_weekly_runs_strictly_after():
+    weekly = schedule("2026-10-05T08:00:00+00:00", frequency="weekly")
+
+    assert server.next_run_after(weekly, at("2026-10-05T08:00:00+00:00")) == "2026-10-12T08:00:00+00:00"
+    assert server.next_run_after(weekly, at("2026-10-04T00:00:00+00:00")) == "2026-10-05T08:00:00+00:00"
+
+
+def test_no_run_after_the_end():
+    daily = schedule("2026-10-01T08:00:00+00:00", frequency="daily", ends_at="2026-10-03T00:00:00+00:00")
+
+    assert server.next_run_after(daily, at("2026-10-01T08:00:00+00:00")) == "2026-10-02T08:00:00+00:00"
+    assert server.next_run_after(daily, at("2026-10-02T08:00:00+00:00")) is None
+    assert server.next_run_after(daily, datetime(2026, 10, 2, 9, tzinfo=timezone.utc)) is None
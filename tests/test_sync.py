@@ -0,0 +1,66 @@
+import pytest
+
+import server
+
+
+async def insert_task(database, status):
+    await database.tasks.insert_one({
+        "id": "task-1",
+        "status": status,
+        "assigned_to": "tech-1",
+        "customer_name": "زبون",
+        "created_by": "admin-1",
+        "created_at": "2026-10-19T08:00:00+00:00",
+        "updated_at": "2026-10-19T08:00:00+00:00",
+    })
+
+
+def operation(op_id, kind, **fields):
+    return {"op_id": op_id, "type": kind, "task_id": "task-1", **fields}
+
+
+async def sync(api, technician, operations):
+    response = await api.post("/api/sync", json={"operations": operations}, headers=technician)
+    assert response.status_code == 200, response.text
+    return {result["op_id"]: result for result in response.json()["results"]}
+
+
+@pytest.mark.anyio
+async def test_operations_that_do_not_advance_the_task_conflict(api, database, technician):
+    # Accepted from Telegram while the phone was offline
+    await insert_task(database, "accepted")
+
+    results = await sync(api, technician, [operation("a", "accept"), operation("s", "start")])
+
+    assert results["a"]["status"] == "conflict"
+    assert results["a"]["task_status"] == "accepted"
+    assert results["s"]["status"] == "ok"
+    task = await database.tasks.find_one({"id": "task-1"})
+    assert task["status"] == "in_progress"
+
+
+@pytest.mark.anyio
+async def test_completed_task_is_not_moved_back(api, database, technician):
+    await insert_task(database, "completed")
+
+    results = await sync(api, technician, [operation("s", "start")])
+
+    assert results["s"]["status"] == "conflict"
+    assert (await database.tasks.find_one({"id": "task-1"}))["status"] == "completed"
+
+
+@pytest.mark.anyio
+async def test_replayed_locations_are_written_once(api, database, technician):
+    await database.locations.create_index("id", unique=True)
+    fixes = [
+        operation(f"fix-{number}", "location", latitude=33.3 + number / 1000, longitude=44.4)
+        for number in range(3)
+    ]
+
+    await sync(api, technician, fixes)
+    # The response was lost; the phone uploads the same batch again
+    await server.db.sync_ops.delete_many({})
+    results = await sync(api, technician, fixes)
+
+    assert all(result["status"] == "ok" for result in results.values())
+    assert await database.locations.count_documents({}) == 3
@@ -0,0 +1,72 @@
+import server
+
+
+def task(task_id, created_at="2026-10-01T08:00:00+00:00", **fields):
+    return {
+        "id": task_id,
+        "customer_name": "",
+        "customer_phone": "",
+        "customer_address": "",
+        "issue_description": "",
+        "assigned_to": "tech-1",
+        "created_at": created_at,
+        "updated_at": created_at,
+        **fields,
+    }
+
+
+def test_normalization_unifies_letter_forms_diacritics_and_digits():
+    assert server.normalize_search_text("أحمَد") == server.normalize_search_text("احمد")
+    assert server.normalize_search_text("مكتبة") == "مكتبه"
+    assert server.normalize_search_text("مستشفى") == "مستشفي"
+    assert server.normalize_search_text("٠٧٧٠") == "0770"
+    assert server.normalize_search_text("Router") == "router"
+
+
+def test_phone_numbers_match_in_local_and_international_form():
+    assert server.phone_digits("+964 770 123 4567") == server.phone_digits("0770-123-4567") == "07701234567"
+
+
+def test_search_ignores_spelling_variants():
+    index = server.TaskSearchIndex()
+    index.add(task("t1", customer_name="أحمد علي", customer_address="شارع المكتبة"))
+
+    assert index.search("احمد") == ["t1"]
+    assert index.search("مكتبه") == ["t1"]
+    assert index.search("ٱحمَد علي") == ["t1"]
+
+
+def test_every_word_must_match():
+    index = server.TaskSearchIndex()
+    index.add(task("t1", customer_name="أحمد علي"))
+    index.add(task("t2", customer_name="أحمد حسن"))
+
+    assert index.search("أحمد حسن") == ["t2"]
+    assert index.search("أحمد كريم") == []
+
+
+def test_ranking_by_field_weight_then_prefix():
+    index = server.TaskSearchIndex()
+    index.add(task("issue", issue_description="Network down", created_at="2026-10-02T08:00:00+00:00"))
+    index.add(task("prefix", customer_name="Networks Ltd"))
+    index.add(task("name", customer_name="Network"))
+
+    # Name 3.0, name prefix 3.0 * 0.5, issue 1.0
+    assert index.search("network") == ["name", "prefix", "issue"]
+
+
+def test_phone_query_is_one_token():
+    index = server.TaskSearchIndex()
+    index.add(task("t1", customer_phone="07701234567"))
+
+    assert index.search("0770 123 4567") == ["t1"]
+    assert index.search("+9647701234567") == ["t1"]
+
+
+def test_older_snapshot_does_not_overwrite_a_newer_event():
+    index = server.TaskSearchIndex()
+    index.add(task("t1", customer_name="جديد", updated_at="2026-10-02T00:00:00+00:00"))
+    index.add(task("t1", customer_name="قديم", updated_at="2026-10-01T00:00:00+00:00"))
+
+    assert index.search("جديد") == ["t1"]
+    assert index.search("قديم") == []